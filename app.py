@@ -7,7 +7,7 @@ from werkzeug.utils import secure_filename
 import mimetypes
 
 from auth import authenticate_user, create_user, delete_user, get_user_stats, get_admin_stats
-from mailer import EmailSender
+from mailer import SENDER_BACKENDS, DEFAULT_BACKEND, PIXEL_TAG, create_sender
 
 # Constants
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx'}
@@ -103,7 +103,7 @@ def send_email():
     if request.method == 'POST':
         if not request.form.get('recipients') or not request.form.get('subject') or not request.form.get('body'):
             flash('Please fill in all required fields')
-            return render_template('send_email.html')
+            return render_template('send_email.html', backends=SENDER_BACKENDS, default_backend=DEFAULT_BACKEND)
 
         recipients = request.form['recipients'].split(',')
         subject = request.form['subject']
@@ -136,14 +136,15 @@ def send_email():
             # Generate campaign ID
             campaign_id = str(uuid.uuid4())
             
-            # Add tracking pixel
-            tracking_pixel = f'<img src="http://45.141.122.177:8080/track?campaign_id={campaign_id}" width="1" height="1" style="display:none;">'
-            full_body = body + '\n\n' + tracking_pixel
+            # Add tracking pixel; its URL is filled in per recipient
+            full_body = body + '\n\n' + PIXEL_TAG
 
-            # Send emails
-            sender = EmailSender()  # Assuming EmailSender is modified to use environment variables
+            # Send emails with the selected backend
+            backend = request.form.get('backend', DEFAULT_BACKEND)
+            sender = create_sender(os.environ.get('MAILER_USERNAME', ''), os.environ.get('MAILER_PASSWORD', ''),
+                                   backend=backend)
             email_list = [(recipient.strip(), subject, full_body, campaign_id, attachments) for recipient in recipients]
-            results = sender.send_emails_threaded(email_list)
+            summary = sender.send_emails(email_list, keep_results=False)
 
             # Clean up attachments
             for attachment in attachments:
@@ -151,14 +152,12 @@ def send_email():
                     os.remove(attachment)
 
             # Return results
-            successful = sum(1 for result in results if result[0])
-            failed = len(results) - successful
-            flash(f'Campaign sent! {successful} emails sent successfully, {failed} failed.')
+            flash(f'Campaign sent! {summary.sent} emails sent successfully, {summary.failed} failed.')
 
         except Exception as e:
             flash(f'Error sending emails: {str(e)}')
 
-    return render_template('send_email.html')
+    return render_template('send_email.html', backends=SENDER_BACKENDS, default_backend=DEFAULT_BACKEND)
 
 @app.route('/admin/users', methods=['GET', 'POST', 'DELETE'])
 @admin_required
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import weakref
+from collections import deque
+
+import aiosmtplib
+
+import mailer
+from mailer import EmailSender
+
+# Concurrent SMTP conversations allowed per provider host within one event loop
+PROVIDER_CONCURRENCY = {
+    'smtp.gmail.com': 20,
+    'smtp.mail.yahoo.com': 10,
+    'smtp.live.com': 10,
+    'smtp.aol.com': 10
+}
+DEFAULT_PROVIDER_CONCURRENCY = 10
+
+# Provider semaphores, one set per running event loop
+_provider_semaphores = weakref.WeakKeyDictionary()
+
+def get_provider_semaphore(host):
+    """
+    Get the semaphore limiting concurrent conversations with an SMTP host
+
+    :param host: SMTP server host name
+    :return: asyncio.Semaphore shared by all senders on the current loop
+    """
+    semaphores = _provider_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(PROVIDER_CONCURRENCY.get(host, DEFAULT_PROVIDER_CONCURRENCY))
+    return semaphores[host]
+
+class _ItemSource(object):
+    def __init__(self, batches):
+        """
+        Numbered emails handed out to the connection workers one at a time
+
+        Batches are read, and their pixel tokens issued, on a worker thread so
+        neither the email list nor the tracking database blocks the event loop.
+
+        :param batches: Iterator of lists of (index, email_details) pairs
+        """
+        self.batches = batches
+        self.ready = deque()
+        self.lock = asyncio.Lock()
+        self.exhausted = False
+
+    async def next(self):
+        """
+        :return: Next (index, email_details) pair, or None when the list is exhausted
+        """
+        async with self.lock:
+            if not self.ready and not self.exhausted:
+                batch = await asyncio.get_running_loop().run_in_executor(None, next, self.batches, None)
+                if batch is None:
+                    self.exhausted = True
+                else:
+                    self.ready.extend(batch)
+            return self.ready.popleft() if self.ready else None
+
+    def drain(self):
+        """
+        Take the pairs read from the list but not handed out yet
+
+        :return: List of (index, email_details) pairs
+        """
+        items = list(self.ready)
+        self.ready.clear()
+        return items
+
+class AsyncEmailSender(EmailSender):
+    def __init__(self, username, password, max_connections=50, **kwargs):
+        """
+        Email sender driving many SMTP conversations on a single event loop
+
+        :param username: Email address to send from
+        :param password: Email account password
+        :param max_connections: Maximum number of open SMTP connections
+        :param kwargs: SMTP options accepted by EmailSender
+        """
+        kwargs.setdefault('max_workers', max_connections)
+        EmailSender.__init__(self, username, password, **kwargs)
+        self.max_connections = kwargs['max_workers']
+
+    def _setup_connections(self, queue_size):
+        """
+        Connections are opened by the connection workers, so there is no
+        worker queue or thread pool to create
+        """
+        self.opened_count = 0
+
+    def _close_connections(self):
+        """
+        Connection workers close their own connections when they finish
+        """
+
+    @property
+    def connections_opened(self):
+        """
+        Number of SMTP connections opened so far
+        """
+        return self.opened_count
+
+    async def _connect(self):
+        """
+        Open and authenticate a new SMTP connection
+
+        :return: aiosmtplib.SMTP connection object
+        """
+        host, port = self._get_smtp_settings()
+        try:
+            smtp = aiosmtplib.SMTP(hostname=host, port=port, start_tls=False)
+            await smtp.connect()
+            if self.use_tls:
+                await smtp.starttls()
+            await smtp.login(self.username, self.password)
+            self.opened_count += 1
+            return smtp
+        except Exception as e:
+            logging.error('SMTP connection error: {}'.format(e))
+            raise
+
+    async def _close(self, smtp):
+        """
+        Close a connection, ignoring errors from an already dropped connection
+        """
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+
+    def _item_source(self, email_list):
+        """
+        Shared source of numbered emails for the connection workers
+
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments[, merge_fields])
+        :return: _ItemSource object
+        """
+        return _ItemSource(self._iter_batches(email_list))
+
+    async def _connection_worker(self, source, semaphore):
+        """
+        Send queued emails over one SMTP connection until the list is exhausted
+
+        The provider slot is held for the whole life of the connection, so no
+        more connections are open against a provider than its limit allows;
+        workers beyond the limit wait for a slot and usually find the list
+        already drained.
+
+        :param source: _ItemSource shared by the workers
+        :param semaphore: Provider concurrency semaphore
+        """
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            smtp = None
+            message_count = 0
+            try:
+                while not mailer.STOP_THREADS:
+                    item = await source.next()
+                    if item is None:
+                        break
+                    index, email_details = item
+                    recipient, subject, body, campaign_id, attachments = email_details[:5]
+                    merge_fields = email_details[5] if len(email_details) > 5 else None
+                    try:
+                        # Rendering and attachment encoding would stall every other conversation
+                        message = await loop.run_in_executor(
+                            None, self.build_message, recipient, subject, body, attachments, campaign_id,
+                            merge_fields)
+                        for attempt in range(2):
+                            if smtp is None or message_count >= self.max_messages_per_connection:
+                                if smtp is not None:
+                                    await self._close(smtp)
+                                smtp = await self._connect()
+                                message_count = 0
+                            try:
+                                await smtp.sendmail(self.username, [recipient], message)
+                                break
+                            except aiosmtplib.SMTPServerDisconnected:
+                                smtp = None
+                                if attempt:
+                                    raise
+                            except (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPResponseException):
+                                # Server rejected this message but the connection is still usable
+                                raise
+                            except Exception:
+                                await self._close(smtp)
+                                smtp = None
+                                raise
+                        message_count += 1
+
+                        with self.lock:
+                            self.sent_count += 1
+                            logging.info('Email sent successfully to {}'.format(recipient))
+                        self._record(index, recipient, (True, None))
+                    except Exception as e:
+                        with self.lock:
+                            self.failed_count += 1
+                            logging.error('Error sending email to {}: {}'.format(recipient, e))
+                        self._record(index, recipient, (False, str(e)))
+            finally:
+                if smtp is not None:
+                    await self._close(smtp)
+
+    def _record_unsent(self, source):
+        """
+        Record emails already read from the list but never sent because sending was interrupted
+        """
+        for index, email_details in source.drain():
+            with self.lock:
+                self.failed_count += 1
+            self._record(index, email_details[0], (False, 'Sending interrupted'))
+
+    async def send_emails_async(self, email_list, keep_results=True):
+        """
+        Send multiple emails concurrently on the running event loop
+
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments[, merge_fields])
+        :param keep_results: Collect a SendResult per email in submission order
+        :return: SendSummary object
+        """
+        mailer.STOP_THREADS = False
+        self._start_campaign(keep_results)
+
+        host, _ = self._get_smtp_settings()
+        semaphore = get_provider_semaphore(host)
+        source = self._item_source(email_list)
+        await asyncio.gather(*[self._connection_worker(source, semaphore)
+                               for _ in range(self.max_connections)])
+        self._record_unsent(source)
+        return self._finish_campaign()
+
+    def send_emails(self, email_list, keep_results=True):
+        """
+        Send multiple emails on a new event loop
+
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments[, merge_fields])
+        :param keep_results: Collect a SendResult per email in submission order
+        :return: SendSummary object
+        """
+        return asyncio.run(self.send_emails_async(email_list, keep_results))
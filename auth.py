@@ -4,10 +4,11 @@ from functools import wraps
 import os
 from typing import Optional, Tuple
 
+import storage
+
 def get_db_connection():
-    """Get database connection"""
-    db_path = os.path.join(os.path.dirname(__file__), 'mailer.db')
-    return sqlite3.connect(db_path)
+    """Get the current thread's database connection; roll back instead of closing it"""
+    return storage.get_connection(storage.MAILER_DB_PATH)
 
 def hash_password(password: str) -> str:
     """Hash a password using SHA-256"""
@@ -28,7 +29,7 @@ def authenticate_user(username: str, password: str) -> Optional[Tuple[int, bool]
         result = cursor.fetchone()
         return result if result else None
     finally:
-        conn.close()
+        conn.rollback()
 
 def create_user(admin_username: str, admin_password: str, new_username: str, new_password: str) -> bool:
     """
@@ -58,7 +59,7 @@ def create_user(admin_username: str, admin_password: str, new_username: str, new
         # Username already exists
         return False
     finally:
-        conn.close()
+        conn.rollback()
 
 def delete_user(admin_username: str, admin_password: str, username_to_delete: str) -> bool:
     """
@@ -86,7 +87,7 @@ def delete_user(admin_username: str, admin_password: str, username_to_delete: st
         conn.commit()
         return cursor.rowcount > 0
     finally:
-        conn.close()
+        conn.rollback()
 
 def get_user_stats(user_id: int) -> dict:
     """Get statistics for a specific user"""
@@ -113,7 +114,7 @@ def get_user_stats(user_id: int) -> dict:
             'open_rate': (total_opens / total_emails * 100) if total_emails > 0 else 0
         }
     finally:
-        conn.close()
+        conn.rollback()
 
 def get_admin_stats() -> dict:
     """Get system-wide statistics (admin only)"""
@@ -145,4 +146,4 @@ def get_admin_stats() -> dict:
             'total_users': total_users
         }
     finally:
-        conn.close()
\ No newline at end of file
+        conn.rollback()
\ No newline at end of file
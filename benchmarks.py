@@ -0,0 +1,705 @@
+"""
+Local benchmarks for the mailer and the pixel tracker
+
+Run a single benchmark with:
+    python benchmarks.py <name> [options]
+"""
+import argparse
+import http.client
+import logging
+import os
+import re
+import socket
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# SMTP replies to commands that need no special handling
+SMTP_OK_COMMANDS = ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP')
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal SMTP conversation that accepts every login and message
+    """
+    def reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def is_rejected(self, raw):
+        addresses = re.findall(r'<([^>]*)>', raw.decode('ascii', 'replace'))
+        return bool(self.server.rejected.intersection(addresses))
+
+    def handle(self):
+        with self.server.lock:
+            self.server.open_connections += 1
+            self.server.max_open_connections = max(self.server.max_open_connections, self.server.open_connections)
+        try:
+            self.converse()
+        finally:
+            with self.server.lock:
+                self.server.open_connections -= 1
+
+    def converse(self):
+        self.reply('220 localhost SMTP sink')
+        for raw in self.rfile:
+            command = raw.decode('ascii', 'replace').strip().split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.reply('250-localhost\r\n250-AUTH PLAIN\r\n250 OK')
+            elif command == 'AUTH':
+                self.reply('235 Authentication successful')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    data.append(data_line)
+                with self.server.lock:
+                    self.server.message_count += 1
+                    if self.server.messages is not None:
+                        self.server.messages.append(b''.join(data))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            elif command == 'RCPT' and self.is_rejected(raw):
+                self.reply('550 No such user')
+            elif command in SMTP_OK_COMMANDS:
+                self.reply('250 OK')
+            else:
+                self.reply('502 Command not implemented')
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in SMTP server used in place of the real providers
+
+    :param latency: Seconds slept before every reply to emulate network round trips
+    :param keep_messages: Keep the raw data of every received message in messages
+    :param rejected: Recipient addresses refused with a 550 reply
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, keep_messages=False, rejected=()):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPSinkHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.message_count = 0
+        self.messages = [] if keep_messages else None
+        self.rejected = set(rejected)
+        self.open_connections = 0
+        self.max_open_connections = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+def bench_smtp_pool(args):
+    """
+    Messages/sec with one SMTP login per message versus pooled sessions
+    """
+    from mailer import EmailSender
+
+    email_list = [('user{}@example.com'.format(i), 'Benchmark', '<p>Hello</p>', 'bench', None)
+                  for i in range(args.messages)]
+
+    with SMTPSink(latency=args.latency_ms / 1000.0) as sink:
+        port = sink.server_address[1]
+        for label, per_connection in (('login per message', 1), ('pooled sessions', 100)):
+            sender = EmailSender('bench@example.com', 'secret', max_workers=args.workers,
+                                 smtp_host='127.0.0.1', smtp_port=port, use_tls=False,
+                                 max_messages_per_connection=per_connection)
+            start = time.time()
+            sender.send_emails_threaded(email_list)
+            elapsed = time.time() - start
+            print('{:<20} {:>8.1f} msg/s  ({} sent, {} sessions)'.format(
+                label, sender.sent_count / elapsed, sender.sent_count, sender.connections_opened))
+
+def bench_async_sender(args):
+    """
+    Messages/sec of the thread workers versus the asyncio engine
+    """
+    from mailer import create_sender
+
+    email_list = [('user{}@example.com'.format(i), 'Benchmark', '<p>Hello</p>', 'bench', None)
+                  for i in range(args.messages)]
+
+    with SMTPSink(latency=args.latency_ms / 1000.0) as sink:
+        port = sink.server_address[1]
+        for backend, options in (('threaded', {'max_workers': args.workers}),
+                                 ('async', {'max_connections': args.connections})):
+            sender = create_sender('bench@example.com', 'secret', backend=backend,
+                                   smtp_host='127.0.0.1', smtp_port=port, use_tls=False, **options)
+            start = time.time()
+            sender.send_emails(email_list)
+            elapsed = time.time() - start
+            print('{:<20} {:>8.1f} msg/s  ({} sent, {} sessions)'.format(
+                backend, sender.sent_count / elapsed, sender.sent_count, sender.connections_opened))
+
+def bench_attachments(args):
+    """
+    CPU time per message with attachments encoded per recipient versus once per campaign
+    """
+    from mailer import EmailSender
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as attachment:
+        attachment.write(os.urandom(args.attachment_kb * 1024))
+        attachment.flush()
+
+        for label, per_campaign in (('encode per message', False), ('campaign template', True)):
+            sender = EmailSender('bench@example.com', 'secret')
+            start = time.process_time()
+            for i in range(args.messages):
+                if not per_campaign:
+                    sender.attachment_cache.clear()
+                    sender.templates = {}
+                sender.build_message('user{}@example.com'.format(i), 'Benchmark', '<p>Hello</p>',
+                                     [attachment.name], 'bench')
+            elapsed = time.process_time() - start
+            print('{:<20} {:>8.3f} ms CPU/msg'.format(label, elapsed * 1000 / args.messages))
+
+def wait_for_port(port, timeout=15.0):
+    """
+    Wait until a local server accepts connections
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Server on port {} did not start'.format(port))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_load(port, path, requests, concurrency):
+    """
+    Issue GET requests from concurrent client threads
+
+    :return: Tuple of (elapsed seconds, sorted list of request latencies)
+    """
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        local = []
+        for i in counter:
+            start = time.perf_counter()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request('GET', path.format(i=i), headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0) bench'})
+            conn.getresponse().read()
+            conn.close()
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, sorted(latencies)
+
+def report_load(label, elapsed, latencies):
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print('{:<20} {:>8.1f} req/s  p50 {:.2f} ms  p99 {:.2f} ms'.format(
+        label, len(latencies) / elapsed, p50 * 1000, p99 * 1000))
+
+def serve_tracker(command, db_path, **extra_env):
+    """
+    Start a tracker server process on a free port using a scratch database
+
+    :param extra_env: Additional environment variables for the server
+    :return: Tuple of (process, port)
+    """
+    port = free_port()
+    env = dict(os.environ, TRACKING_DB_PATH=db_path, **extra_env)
+    proc = subprocess.Popen([arg.format(port=port) for arg in command], cwd=REPO_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+    except RuntimeError:
+        proc.kill()
+        raise
+    return proc, port
+
+def count_tracked_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM pixel_tracks').fetchone()[0]
+    finally:
+        conn.close()
+
+def bench_tracker(args):
+    """
+    Pixel requests/sec and p50/p99 latency of /track under gunicorn, through
+    Flask and through the WSGI fast path, and under uvicorn with the ASGI tracker
+    """
+    gunicorn = [sys.executable, '-m', 'gunicorn', '-w', str(args.server_workers),
+                '-b', '127.0.0.1:{port}', 'pixel_tracker_py2:app']
+    uvicorn = [sys.executable, '-m', 'uvicorn', '--port', '{port}', '--no-access-log',
+               '--log-level', 'warning', 'pixel_tracker_asgi:app']
+    servers = (
+        ('flask route -w {}'.format(args.server_workers), gunicorn, '0'),
+        ('fast path -w {}'.format(args.server_workers), gunicorn, '1'),
+        ('asgi (uvicorn)', uvicorn, '1'),
+    )
+    for label, command, fast_path in servers:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, 'tracking.db')
+            proc, port = serve_tracker(command, db_path, TRACKING_FAST_PATH=fast_path)
+            try:
+                elapsed, latencies = run_load(port, '/track?campaign_id=bench&sender=s@example.com&recipient=r{i}@example.com',
+                                              args.requests, args.concurrency)
+            finally:
+                proc.terminate()
+                proc.wait()
+            report_load(label, elapsed, latencies)
+            print('{} of {} hits written'.format(count_tracked_rows(db_path), args.requests))
+
+    # Handler cost alone, without sockets and worker scheduling
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ['TRACKING_DB_PATH'] = os.path.join(tmpdir, 'tracking.db')
+        from flask import Flask
+        from werkzeug.test import EnvironBuilder
+        import pixel_tracker_py2
+
+        def start_response(status, headers):
+            pass
+
+        for label, application in (('flask route', lambda environ, sr: Flask.wsgi_app(pixel_tracker_py2.app, environ, sr)),
+                                   ('fast path', pixel_tracker_py2.app.wsgi_app)):
+            latencies = []
+            for i in range(args.requests):
+                environ = EnvironBuilder(path='/track', query_string='campaign_id=bench&recipient=r{}@example.com'.format(i),
+                                         headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0) bench'}).get_environ()
+                request_start = time.perf_counter()
+                b''.join(application(environ, start_response))
+                latencies.append(time.perf_counter() - request_start)
+            latencies.sort()
+            print('{:<20} {:>8.0f} req/s  p50 {:.1f} us  p99 {:.1f} us'.format(
+                label + ' in-process', len(latencies) / sum(latencies),
+                latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6))
+        pixel_tracker_py2.tracking_writer.close()
+
+def bench_unique_opens(args):
+    """
+    HyperLogLog estimates versus exact unique counts, and merge/count latency
+    """
+    from hll import HyperLogLog
+
+    for exact in (100, 10000, args.requests * 200):
+        sketch = HyperLogLog()
+        for i in range(exact):
+            sketch.add('r{}@example.com'.format(i))
+        error = abs(sketch.count() - exact) / float(exact)
+        print('{:>10} unique  estimate {:>10}  error {:6.2%}  (bound {:.2%} at 3 sigma)'.format(
+            exact, sketch.count(), error, 3 * sketch.error_bound()))
+
+    # A 30-day campaign from 10 senders is 300 stored sketches
+    sketches = []
+    for s in range(300):
+        sketch = HyperLogLog()
+        for i in range(1000):
+            sketch.add('r{}-{}@example.com'.format(s % 30, i))
+        sketches.append(sketch.to_bytes())
+    start = time.time()
+    estimate = HyperLogLog.union(HyperLogLog.from_bytes(data) for data in sketches).count()
+    print('merge + count of 300 sketches {:.2f} ms  estimate {} of 30000'.format(
+        (time.time() - start) * 1000, estimate))
+
+def _loop_campaign_metrics(rows):
+    # The per-row loop the dashboards used before metrics.py, kept as the baseline
+    campaign_data = []
+    for stat in rows:
+        open_rate = round(float(stat[2]) / max(stat[3], 1) * 100, 2) if stat[3] > 0 else 0
+        campaign_duration = 0
+        if stat[4] and stat[5]:
+            campaign_duration = round((stat[5] - stat[4]).total_seconds() / 3600, 2)
+        campaign_data.append({
+            'Campaign ID': stat[0] or 'Unknown',
+            'Sender Email': stat[1] or 'Unknown',
+            'Unique Recipients': stat[2],
+            'Total Opens': stat[3],
+            'Open Rate (%)': open_rate,
+            'First Open': stat[4].strftime('%Y-%m-%d %H:%M:%S') if stat[4] else 'N/A',
+            'Last Open': stat[5].strftime('%Y-%m-%d %H:%M:%S') if stat[5] else 'N/A',
+            'Campaign Duration (Hours)': campaign_duration
+        })
+    total_campaigns = len(campaign_data)
+    overall = {
+        'Total Campaigns': total_campaigns,
+        'Total Unique Recipients': sum(data['Unique Recipients'] for data in campaign_data),
+        'Total Opens': sum(data['Total Opens'] for data in campaign_data),
+        'Average Open Rate (%)': round(sum(data['Open Rate (%)'] for data in campaign_data) / max(total_campaigns, 1), 2)
+    }
+    return campaign_data, overall
+
+def bench_metrics(args):
+    """
+    Vectorized dashboard metrics versus the per-row loop
+    """
+    import datetime
+    import random
+
+    import metrics
+
+    rng = random.Random(0)
+    base = datetime.datetime(2024, 1, 1)
+    rows = []
+    for i in range(args.campaigns):
+        opens = rng.randint(0, 5000)
+        first = base + datetime.timedelta(seconds=rng.randint(0, 86400 * 30)) if opens else None
+        last = first + datetime.timedelta(seconds=rng.randint(0, 86400 * 7)) if opens else None
+        rows.append(('campaign-{}'.format(i), 'sender{}@example.com'.format(i % 50),
+                     rng.randint(0, opens), opens, first, last))
+
+    # The Streamlit dashboard reads timestamps as SQLite text rather than datetimes
+    text_rows = [row[:4] + tuple(str(value) if value else None for value in row[4:]) for row in rows]
+
+    def vectorized(source=rows):
+        columns = metrics.campaign_metrics(metrics.rows_to_columns(source))
+        return columns, metrics.overall_metrics(columns)
+
+    def timed(function, repeat=5):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    loop_time, (loop_records, loop_overall) = timed(lambda: _loop_campaign_metrics(rows))
+    compute_time, (columns, overall) = timed(vectorized)
+    text_time, (_, text_overall) = timed(lambda: vectorized(text_rows))
+    records_time, records = timed(lambda: metrics.to_records(vectorized()[0]))
+    assert overall == loop_overall == text_overall and len(records) == len(loop_records)
+    # NumPy rounds half to even on the scaled value, so a tie can differ by one in the last place
+    for record, loop_record in zip(records, loop_records):
+        for name, value in loop_record.items():
+            if isinstance(value, float):
+                assert abs(record[name] - value) < 0.0101, (name, record[name], value)
+            else:
+                assert record[name] == value, (name, record[name], value)
+
+    print('{} campaigns (best of 5, numpy {})'.format(
+        args.campaigns, 'available' if metrics.np is not None else 'missing'))
+    print('  per-row loop            {:8.2f} ms'.format(loop_time * 1000))
+    print('  vectorized metrics      {:8.2f} ms  ({:.1f}x)'.format(compute_time * 1000, loop_time / compute_time))
+    print('  vectorized, text times  {:8.2f} ms  ({:.1f}x)'.format(text_time * 1000, loop_time / text_time))
+    print('  vectorized + records    {:8.2f} ms  ({:.1f}x)'.format(records_time * 1000, loop_time / records_time))
+
+# User agents seen on pixel hits, from mail clients, proxies, browsers and bots
+SAMPLE_USER_AGENTS = [
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+    'Mozilla/5.0 (iPad; CPU OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko)',
+    'Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)',
+    'YahooMailProxy; https://help.yahoo.com/kb/yahoo-mail-proxy-SLN28749.html',
+    'Mozilla/4.0 (compatible; ms-office; MSOffice 16)',
+    'Microsoft Office/16.0 (Windows NT 10.0; Microsoft Outlook 16.0.17328; Pro)',
+    'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Linux; Android 13; SM-X710) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Thunderbird/125.0',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'python-requests/2.31.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) HeadlessChrome/120.0 Safari/537.36',
+]
+
+def _substring_device_info(user_agent):
+    # The classifier pixel_tracker_py2 used before user_agents.py, kept as the baseline
+    user_agent = user_agent.lower()
+    if 'mobile' in user_agent:
+        return 'Mobile'
+    elif 'tablet' in user_agent:
+        return 'Tablet'
+    elif 'windows' in user_agent or 'macintosh' in user_agent or 'linux' in user_agent:
+        return 'Desktop'
+    return 'Unknown'
+
+def bench_user_agents(args):
+    """
+    Nanoseconds per user-agent classification, with and without the cache
+    """
+    import user_agents
+
+    for user_agent in SAMPLE_USER_AGENTS:
+        info = user_agents.classify(user_agent)
+        print('  {:<8} {:<8} {:<12} bot={!s:<5} proxy={!s:<5} {}'.format(
+            info.device, info.os, info.client, info.is_bot, info.is_proxy, user_agent[:60]))
+
+    hits = [SAMPLE_USER_AGENTS[i % len(SAMPLE_USER_AGENTS)] for i in range(args.requests * 20)]
+    for label, function in (('substring checks (old)', _substring_device_info),
+                            ('word table, uncached', user_agents._classify),
+                            ('word table + generational cache', user_agents.classify)):
+        start = time.perf_counter()
+        for user_agent in hits:
+            function(user_agent)
+        elapsed = time.perf_counter() - start
+        print('{:<26} {:8.0f} ns per classification'.format(label, elapsed / len(hits) * 1e9))
+
+def database_sizes(conn):
+    """
+    Bytes used by each table with its indexes, from the dbstat virtual table
+    """
+    sizes = {}
+    rows = conn.execute('SELECT COALESCE(m.tbl_name, s.name), SUM(s.pgsize) FROM dbstat s '
+                        'LEFT JOIN sqlite_master m ON m.name = s.name GROUP BY 1')
+    for name, size in rows:
+        sizes[name] = size
+    return sizes
+
+# Queries timed against the tracking schema before and after normalization: the
+# query on pixel_tracks, then the same question asked of pixel_events directly
+SCHEMA_QUERIES = [
+    ('campaign page',
+     'SELECT id, recipient, timestamp, ip_address, device_info FROM pixel_tracks '
+     'WHERE campaign_id = ? ORDER BY timestamp DESC, id DESC LIMIT 50',
+     None, ('campaign-7',)),
+    ('campaign first/last',
+     'SELECT MIN(timestamp), MAX(timestamp) FROM pixel_tracks WHERE campaign_id = ?',
+     'SELECT MIN(timestamp), MAX(timestamp) FROM pixel_events '
+     'WHERE campaign_ref = (SELECT id FROM campaigns WHERE campaign_id = ?)',
+     ('campaign-7',)),
+    ('campaign export',
+     'SELECT * FROM pixel_tracks WHERE campaign_id = ?',
+     None, ('campaign-7',)),
+    ('recent opens',
+     'SELECT campaign_id, recipient, timestamp FROM pixel_tracks ORDER BY timestamp DESC LIMIT 100',
+     None, ()),
+    ('opens per campaign',
+     'SELECT campaign_id, sender_email, COUNT(*), COUNT(DISTINCT recipient) '
+     'FROM pixel_tracks GROUP BY campaign_id, sender_email',
+     'SELECT campaigns.campaign_id, senders.sender_email, opens, recipients FROM '
+     '(SELECT campaign_ref, sender_ref, COUNT(*) AS opens, COUNT(DISTINCT recipient_ref) AS recipients '
+     'FROM pixel_events GROUP BY campaign_ref, sender_ref) '
+     'LEFT JOIN campaigns ON campaigns.id = campaign_ref LEFT JOIN senders ON senders.id = sender_ref',
+     ()),
+]
+
+def bench_schema(args):
+    """
+    Database size and query times of pixel_tracks as a table of strings
+    versus pixel_events with interned lookup tables
+    """
+    import datetime
+    import random
+    import shutil
+    import uuid
+
+    import lookups
+    import migrations
+    import storage
+    from tracking_writer import INSERT_EVENT_SQL, TRACK_COLUMNS
+
+    rng = random.Random(0)
+    devices = ['Desktop', 'Mobile', 'Tablet', 'Proxy', 'Unknown']
+    start_time = 1700000000.0
+
+    def make_rows(count, offset=0):
+        rows = []
+        for i in range(offset, offset + count):
+            campaign = rng.randrange(200)
+            timestamp = datetime.datetime.utcfromtimestamp(start_time + i * 0.5 + rng.random())
+            rows.append(('campaign-{}'.format(campaign), 'sender{}@example.com'.format(campaign % 20),
+                         'user{}@example.com'.format(rng.randrange(100000)),
+                         timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'), rng.choice(SAMPLE_USER_AGENTS),
+                         '10.{}.{}.{}'.format(rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+                         rng.choice(devices), None))
+        return rows
+
+    def timed(conn, query, params, repeat=5):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(query, params).fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        legacy_path = os.path.join(tmpdir, 'legacy.db')
+        normalized_path = os.path.join(tmpdir, 'normalized.db')
+
+        # The schema as it was before pixel_events: migrations 1-9
+        conn = storage.connect(legacy_path)
+        migrations.migrate(conn, migrations.TRACKING_MIGRATIONS[:9])
+        insert_sql = 'INSERT INTO pixel_tracks (id, {}) VALUES (?, {})'.format(
+            ', '.join(TRACK_COLUMNS), ', '.join('?' for _ in TRACK_COLUMNS))
+        with conn:
+            conn.executemany(insert_sql, ((str(uuid.uuid4()),) + row for row in make_rows(args.events)))
+        conn.execute('VACUUM')
+        conn.close()
+        shutil.copy(legacy_path, normalized_path)
+
+        conn = storage.connect(normalized_path)
+        start = time.perf_counter()
+        migrations.migrate(conn, migrations.TRACKING_MIGRATIONS)
+        migrate_time = time.perf_counter() - start
+        conn.execute('VACUUM')
+        conn.close()
+
+        print('{} events, migrated in {:.2f} s'.format(args.events, migrate_time))
+        sizes = {}
+        times = {}
+        for label, path in (('strings', legacy_path), ('interned', normalized_path)):
+            conn = storage.connect(path)
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            sizes[label] = database_sizes(conn)
+            sizes[label]['file'] = os.path.getsize(path)
+            for name, query, refs_query, params in SCHEMA_QUERIES:
+                if label == 'strings':
+                    times[name] = [timed(conn, query, params)]
+                else:
+                    times[name].append(timed(conn, query, params))
+                    times[name].append(timed(conn, refs_query, params) if refs_query else None)
+            conn.close()
+
+        legacy, normalized = sizes['strings'], sizes['interned']
+        lookup_bytes = sum(normalized.get(table, 0) for table, _ in lookups.LOOKUPS.values())
+        print('{:<22} {:>12} {:>12}'.format('', 'strings', 'interned'))
+        print('{:<22} {:>9.1f} MB {:>9.1f} MB'.format('database file', legacy['file'] / 1e6, normalized['file'] / 1e6))
+        print('{:<22} {:>9.1f} MB {:>9.1f} MB'.format(
+            'events + indexes', legacy['pixel_tracks'] / 1e6, normalized['pixel_events'] / 1e6))
+        print('{:<22} {:>12} {:>9.1f} MB'.format('lookup tables', '-', lookup_bytes / 1e6))
+        print('{:<22} {:>12} {:>12} {:>12}'.format('', 'table', 'view', 'pixel_events'))
+        for name, _, _, _ in SCHEMA_QUERIES:
+            before, view, refs = times[name]
+            print('{:<22} {:>9.2f} ms {:>9.2f} ms {:>12}'.format(
+                name, before * 1000, view * 1000, '{:.2f} ms'.format(refs * 1000) if refs else '-'))
+
+        # Batches of new hits, without the aggregates the tracking writer also maintains
+        rows = make_rows(args.requests, offset=args.events)
+        interner = lookups.Interner()
+        for label, path in (('strings', legacy_path), ('interned', normalized_path)):
+            conn = storage.connect(path)
+            start = time.perf_counter()
+            for offset in range(0, len(rows), 500):
+                batch = rows[offset:offset + 500]
+                with conn:
+                    if label == 'strings':
+                        conn.executemany(insert_sql, [(str(uuid.uuid4()),) + row for row in batch])
+                    else:
+                        conn.executemany(INSERT_EVENT_SQL, interner.encode(conn, batch, TRACK_COLUMNS))
+                interner.commit()
+            elapsed = time.perf_counter() - start
+            conn.close()
+            print('{:<22} {:>9.0f} hits/s inserted in batches of 500'.format(label + ' inserts', len(rows) / elapsed))
+
+def bench_event_log(args):
+    """
+    Microseconds per hit spent logging on the hit's thread: the formatted dict
+    written synchronously versus the queued NDJSON event log, then replay speed
+    """
+    import event_log
+    import migrations
+
+    # Hits as the trackers log them at capture, spread over a day and never repeating a recipient
+    events = [{
+        'captured_at': 1704067200.0 + i * 86400.0 / (args.requests * 10),
+        'query_string': 'campaign_id=campaign-{}&sender=sender%40example.com&recipient=user{}%40example.com'.format(
+            i % 20, i),
+        'user_agent': SAMPLE_USER_AGENTS[i % len(SAMPLE_USER_AGENTS)],
+        'ip_address': '10.0.{}.{}'.format(i // 256 % 256, i % 256),
+    } for i in range(args.requests * 10)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logger = logging.getLogger('bench.pixel_tracking')
+        logger.propagate = False
+        handler = logging.FileHandler(os.path.join(tmpdir, 'pixel_tracking.log'))
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s', '%Y-%m-%d %H:%M:%S'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        # main() disables INFO records for the other benchmarks
+        logging.disable(logging.NOTSET)
+
+        start = time.perf_counter()
+        for event in events:
+            logger.info('Pixel tracked: {}'.format(event))
+        sync_time = time.perf_counter() - start
+        handler.close()
+
+        log = event_log.EventLog(os.path.join(tmpdir, 'events'))
+        log.start()
+        start = time.perf_counter()
+        for event in events:
+            log.log(event)
+        queued_time = time.perf_counter() - start
+        log.stop()
+        drained_time = time.perf_counter() - start
+
+        segments = event_log.list_segments(log.log_dir)
+        print('{} hits'.format(len(events)))
+        print('  formatted dict, synchronous file   {:6.2f} us/hit'.format(sync_time / len(events) * 1e6))
+        print('  queued NDJSON (hit thread)         {:6.2f} us/hit'.format(queued_time / len(events) * 1e6))
+        print('  queued NDJSON until written + gzip {:6.2f} us/hit'.format(drained_time / len(events) * 1e6))
+        print('  log size {:.1f} MB as text, {:.1f} MB compressed NDJSON'.format(
+            os.path.getsize(handler.baseFilename) / 1e6, sum(os.path.getsize(path) for path in segments) / 1e6))
+
+        db_path = os.path.join(tmpdir, 'tracking.db')
+        migrations.migrate_tracking_db(db_path)
+        for label in ('replay into empty db', 'replay, all present'):
+            start = time.perf_counter()
+            counts = event_log.replay(segments, db_path)
+            elapsed = time.perf_counter() - start
+            print('  {:<32} {:8.0f} events/s  ({} written)'.format(label, counts['read'] / elapsed, counts['written']))
+
+BENCHMARKS = {
+    'event-log': bench_event_log,
+    'schema': bench_schema,
+    'user-agents': bench_user_agents,
+    'metrics': bench_metrics,
+    'unique-opens': bench_unique_opens,
+    'tracker': bench_tracker,
+    'attachments': bench_attachments,
+    'async-sender': bench_async_sender,
+    'smtp-pool': bench_smtp_pool,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local benchmark')
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--attachment-kb', type=int, default=1024)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--campaigns', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=500000)
+    parser.add_argument('--server-workers', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=1.0,
+                        help='simulated SMTP round trip per reply')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    # Building messages records deliveries for pixel tokens; keep them out of the real tracking.db
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ['TRACKING_DB_PATH'] = os.path.join(tmpdir, 'tracking.db')
+        os.environ['TRACKING_SECRET_PATH'] = os.path.join(tmpdir, 'tracking_secret.key')
+        BENCHMARKS[args.name](args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""
+TTL + LRU cache for dashboard aggregates, versioned by the tracking write counter
+
+Every batch the tracking writer commits bumps tracking_version.version in
+the same transaction. Cached values remember the version they were computed
+at and are recomputed once it moves, so any process reading the tracking
+database sees new hits on its next request; the TTL bounds how long a value
+can be served at all.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+BUMP_VERSION_SQL = 'UPDATE tracking_version SET version = version + 1 WHERE id = 1'
+
+SELECT_VERSION_SQL = 'SELECT version FROM tracking_version WHERE id = 1'
+
+def bump_version(conn):
+    """
+    Mark cached aggregates of a tracking database as stale
+
+    :param conn: sqlite3 connection with an open transaction
+    """
+    conn.execute(BUMP_VERSION_SQL)
+
+def get_version(conn):
+    """
+    Current write counter of a tracking database
+
+    :param conn: sqlite3 connection
+    :return: Version number
+    """
+    row = conn.execute(SELECT_VERSION_SQL).fetchone()
+    return row[0] if row else 0
+
+class TTLCache(object):
+    def __init__(self, max_entries=256, ttl=30.0):
+        """
+        Thread-safe LRU cache whose entries expire after a TTL or on a version change
+
+        :param max_entries: Entries kept before the least recently used is evicted
+        :param ttl: Seconds an entry may be served
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version=None, default=None):
+        """
+        Look up a live entry
+
+        :param key: Hashable cache key
+        :param version: Version the entry must have been stored at
+        :return: Cached value, or default on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time() or entry[1] != version:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # Reinsert to mark the entry most recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry[2]
+
+    def set(self, key, value, version=None):
+        """
+        Store a value, evicting the least recently used entry when full
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, version, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, version, compute):
+        """
+        Return the cached value or compute and store it
+
+        :param key: Hashable cache key
+        :param version: Current data version, e.g. from get_version
+        :param compute: Callable producing the value on a miss
+        :return: Cached or freshly computed value
+        """
+        missing = object()
+        value = self.get(key, version, missing)
+        if value is missing:
+            value = compute()
+            self.set(key, value, version)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Hit/miss counters
+
+        :return: Dictionary of statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0
+            }
+
+class LRUCache(object):
+    def __init__(self, max_entries=256):
+        """
+        Thread-safe LRU cache for values that never go stale, e.g. parse results
+
+        Cheaper per lookup than TTLCache, which matters on per-request paths.
+
+        :param max_entries: Entries kept before the least recently used is evicted
+        """
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Look up an entry and mark it most recently used
+
+        :param key: Hashable cache key
+        :return: Cached value, or default on a miss
+        """
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            _move_to_end(self.entries, key, value)
+            return value
+
+    def set(self, key, value):
+        """
+        Store a value, evicting the least recently used entry when full
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Hit/miss counters
+
+        :return: Dictionary of statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0
+            }
+
+class GenerationalCache(object):
+    def __init__(self, max_entries=256):
+        """
+        Thread-safe approximate LRU cache for the hottest per-request lookups
+
+        Entries live in two plain dicts, a young and an old generation. New
+        entries and old entries that are hit again go into the young one; once
+        it holds half of max_entries it becomes the old generation and the
+        previous old generation is dropped. Anything used since the last
+        rotation survives the next one, so a working set under half the size
+        always stays cached, while a hit costs one dict lookup under the lock
+        instead of LRUCache's recency update.
+
+        :param max_entries: Entries kept across both generations
+        """
+        self.max_entries = max_entries
+        self.generation_size = max(1, max_entries // 2)
+        self.lock = threading.Lock()
+        self.young = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Look up an entry, moving it to the young generation if it was old
+
+        :param key: Hashable cache key
+        :return: Cached value, or default on a miss
+        """
+        with self.lock:
+            try:
+                value = self.young[key]
+            except KeyError:
+                try:
+                    value = self.old.pop(key)
+                except KeyError:
+                    self.misses += 1
+                    return default
+                self._add(key, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Store a value in the young generation, dropping the old one when it fills up
+        """
+        with self.lock:
+            self.old.pop(key, None)
+            self._add(key, value)
+
+    def _add(self, key, value):
+        self.young[key] = value
+        if len(self.young) >= self.generation_size:
+            self.evictions += len(self.old)
+            self.old = self.young
+            self.young = {}
+
+    def clear(self):
+        with self.lock:
+            self.young.clear()
+            self.old.clear()
+
+    def stats(self):
+        """
+        Hit/miss counters
+
+        :return: Dictionary of statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.young) + len(self.old),
+                'max_entries': self.max_entries,
+                'ttl': None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0
+            }
+
+def _move_to_end(entries, key, value):
+    # OrderedDict.move_to_end is only available on Python 3
+    move_to_end = getattr(entries, 'move_to_end', None)
+    if move_to_end is not None:
+        move_to_end(key)
+    else:
+        del entries[key]
+        entries[key] = value
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(name, max_entries=256, ttl=30.0, lru=True):
+    """
+    Get a named process-wide cache, creating it on first use
+
+    Named caches outlive the objects that use them, e.g. across Streamlit reruns.
+
+    :param name: Cache name
+    :param max_entries: Size of a newly created cache
+    :param ttl: TTL of a newly created cache; None creates an LRUCache
+    :param lru: With ttl None, False creates a GenerationalCache instead of an LRUCache
+    :return: TTLCache, LRUCache or GenerationalCache
+    """
+    with _caches_lock:
+        if name not in _caches:
+            if ttl is not None:
+                _caches[name] = TTLCache(max_entries, ttl)
+            elif lru:
+                _caches[name] = LRUCache(max_entries)
+            else:
+                _caches[name] = GenerationalCache(max_entries)
+        return _caches[name]
+
+def all_stats():
+    """
+    Statistics of every named cache
+
+    :return: Dictionary of cache name to stats
+    """
+    with _caches_lock:
+        caches = dict(_caches)
+    return dict((name, cache.stats()) for name, cache in caches.items())
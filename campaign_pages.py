@@ -0,0 +1,77 @@
+"""
+Keyset pagination of a campaign's opens for the dashboards
+
+Pages are ordered newest first on (timestamp, id). A cursor holds the
+(timestamp, id) of the last row shown, and the next page seeks straight
+past it through ix_pixel_events_campaign_timestamp, whose entries end with
+the integer id, so every page costs the same and rows that tie on the
+timestamp are neither skipped nor repeated. Opens without a timestamp sort
+after all the others, ordered by id alone.
+"""
+import base64
+import json
+
+# Columns shown on the campaign details page
+DETAIL_COLUMNS = ('id', 'recipient', 'sender_email', 'timestamp', 'ip_address', 'device_info', 'location')
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(timestamp, track_id):
+    """
+    Opaque cursor pointing just past a row in (timestamp, id) order
+    """
+    return base64.urlsafe_b64encode(json.dumps([timestamp, track_id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from encode_cursor
+
+    :return: Tuple of (timestamp, id)
+    :raises ValueError: If the cursor was not made by encode_cursor
+    """
+    try:
+        timestamp, track_id = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        track_id = int(track_id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+    return timestamp, track_id
+
+def fetch_page(conn, campaign_id, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Load one page of a campaign's opens, newest first
+
+    :param conn: sqlite3 connection
+    :param campaign_id: Campaign to list
+    :param cursor: Cursor returned with the previous page, None for the first page
+    :param page_size: Rows per page
+    :return: Tuple of (rows as dictionaries of DETAIL_COLUMNS, next cursor or None)
+    """
+    select = 'SELECT {} FROM pixel_tracks WHERE campaign_id = ?'.format(', '.join(DETAIL_COLUMNS))
+    limit = page_size + 1
+    timestamp, track_id = decode_cursor(cursor) if cursor else (None, None)
+
+    rows = []
+    if not cursor:
+        rows = conn.execute(select + ' AND timestamp IS NOT NULL ORDER BY timestamp DESC, id DESC LIMIT ?',
+                            (campaign_id, limit)).fetchall()
+    elif timestamp is not None:
+        rows = conn.execute(select + ' AND timestamp <= ? AND (timestamp < ? OR id < ?) '
+                            'ORDER BY timestamp DESC, id DESC LIMIT ?',
+                            (campaign_id, timestamp, timestamp, track_id, limit)).fetchall()
+
+    # Opens without a timestamp follow once the timestamped ones run out
+    if len(rows) < limit:
+        query, params = select + ' AND timestamp IS NULL', [campaign_id]
+        if cursor and timestamp is None:
+            query += ' AND id < ?'
+            params.append(track_id)
+        params.append(limit - len(rows))
+        rows += conn.execute(query + ' ORDER BY id DESC LIMIT ?', params).fetchall()
+
+    rows = [dict(zip(DETAIL_COLUMNS, row)) for row in rows]
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+    return rows, next_cursor
@@ -1,46 +1,84 @@
+import os
 import streamlit as st
 import sqlalchemy as sa
 import pandas as pd
 from sqlalchemy.orm import sessionmaker
-from pixel_tracker_py2 import Base, PixelTrack
+from pixel_tracker_py2 import PixelTrack
 from datetime import datetime, timedelta
+import cache
+import migrations
+import metrics
+import rollups
+import snapshot
+import storage
+import timeseries
 
 class EmailTrackingDashboard:
-    def __init__(self, db_path='tracking.db'):
-        self.engine = sa.create_engine(f'sqlite:///{db_path}')
-        Base.metadata.create_all(self.engine)
+    def __init__(self, db_path=storage.TRACKING_DB_PATH, snapshot_dir=None):
+        migrations.migrate_tracking_db(db_path)
+        self.db_path = db_path
+        # Read campaign statistics from a Parquet snapshot instead of SQLite
+        self.snapshot_dir = snapshot_dir
+        self.engine = storage.create_engine(db_path)
         self.Session = sessionmaker(bind=self.engine)
+        # Process-wide, so cached results survive Streamlit reruns
+        self.cache = cache.get_cache('streamlit_dashboard', max_entries=128)
+
+    def get_tracking_version(self):
+        conn = storage.get_connection(self.db_path)
+        try:
+            return cache.get_version(conn)
+        finally:
+            conn.rollback()
 
     def get_comprehensive_tracking_summary(self):
+        if self.snapshot_dir is not None:
+            manifest = snapshot.read_manifest(self.snapshot_dir)
+            if manifest is not None:
+                return self.cache.get_or_compute((self.snapshot_dir, 'summary'), manifest['created_at'],
+                                                 self.load_snapshot_summary)
+        return self.cache.get_or_compute((self.db_path, 'summary'), self.get_tracking_version(),
+                                         self.load_tracking_summary)
+
+    def load_snapshot_summary(self):
+        # Memory-mapped Arrow table aggregated with vectorized kernels
+        table = snapshot.load_snapshot(self.snapshot_dir,
+                                       columns=['id', 'campaign_id', 'sender_email', 'recipient', 'timestamp', 'ip_address'])
+        summary = snapshot.campaign_summary(table)
+        columns = dict((name, summary.column(name).to_pandas().to_numpy()) for name in metrics.AGGREGATE_COLUMNS)
+        campaign_columns = metrics.campaign_metrics(columns)
+        
+        latest = snapshot.latest_opens(table).to_pandas()
+        detailed_df = pd.DataFrame({
+            'Campaign ID': latest['campaign_id'].astype(object).fillna('Unknown'),
+            'Recipient': latest['recipient'].fillna('Unknown'),
+            'Timestamp': latest['timestamp'],
+            'IP Address': latest['ip_address']
+        })
+        
+        return (
+            pd.DataFrame(metrics.display_columns(campaign_columns)),
+            detailed_df,
+            metrics.overall_metrics(campaign_columns)
+        )
+
+    def load_tracking_summary(self):
+        # Per-sender campaign rollups maintained at ingest, with timestamps
+        # left as text since NumPy parses that much faster than datetimes
+        conn = storage.get_connection(self.db_path)
+        try:
+            campaign_stats = conn.execute(
+                'SELECT {} FROM campaign_rollups WHERE sender_email != ?'.format(', '.join(metrics.AGGREGATE_COLUMNS)),
+                (rollups.ALL_SENDERS,)
+            ).fetchall()
+        finally:
+            conn.rollback()
+        
+        # Open rates and durations computed over whole columns
+        campaign_columns = metrics.campaign_metrics(metrics.rows_to_columns(campaign_stats))
+        
         session = self.Session()
         try:
-            # Comprehensive campaign tracking query
-            campaign_stats = session.query(
-                PixelTrack.campaign_id,
-                PixelTrack.sender_email,
-                sa.func.count(sa.distinct(PixelTrack.recipient)).label('unique_recipients'),
-                sa.func.count(PixelTrack.id).label('total_opens'),
-                sa.func.min(PixelTrack.timestamp).label('first_open'),
-                sa.func.max(PixelTrack.timestamp).label('last_open')
-            ).group_by(
-                PixelTrack.campaign_id, 
-                PixelTrack.sender_email
-            ).all()
-            
-            # Prepare DataFrame
-            campaign_data = []
-            for stat in campaign_stats:
-                campaign_data.append({
-                    'Campaign ID': stat[0] or 'Unknown',
-                    'Sender Email': stat[1] or 'Unknown',
-                    'Unique Recipients': stat[2],
-                    'Total Opens': stat[3],
-                    'Open Rate (%)': round((stat[2] / max(stat[3], 1)) * 100, 2) if stat[3] > 0 else 0,
-                    'First Open': stat[4],
-                    'Last Open': stat[5],
-                    'Campaign Duration (Hours)': round((stat[5] - stat[4]).total_seconds() / 3600, 2) if stat[5] and stat[4] else 0
-                })
-            
             # Detailed tracking data
             detailed_tracking = session.query(
                 PixelTrack.campaign_id,
@@ -58,25 +96,25 @@ class EmailTrackingDashboard:
                 } for stat in detailed_tracking
             ]
             
-            # Overall campaign metrics
-            total_campaigns = len(campaign_data)
-            total_unique_recipients = sum(data['Unique Recipients'] for data in campaign_data)
-            total_opens = sum(data['Total Opens'] for data in campaign_data)
-            avg_open_rate = sum(data['Open Rate (%)'] for data in campaign_data) / max(total_campaigns, 1)
-            
             return (
-                pd.DataFrame(campaign_data), 
+                pd.DataFrame(metrics.display_columns(campaign_columns)),
                 pd.DataFrame(detailed_data),
-                {
-                    'Total Campaigns': total_campaigns,
-                    'Total Unique Recipients': total_unique_recipients,
-                    'Total Opens': total_opens,
-                    'Average Open Rate (%)': round(avg_open_rate, 2)
-                }
+                metrics.overall_metrics(campaign_columns)
             )
         finally:
             session.close()
 
+    def get_open_timeseries(self, campaign_id=None, resolution='hour'):
+        # Pre-aggregated buckets keep this independent of the number of events
+        conn = storage.get_connection(self.db_path)
+        try:
+            series = self.cache.get_or_compute(
+                (self.db_path, 'timeseries', campaign_id, resolution), cache.get_version(conn),
+                lambda: timeseries.query_series(conn, campaign_id=campaign_id, resolution=resolution))
+        finally:
+            conn.rollback()
+        return pd.DataFrame(series, columns=['Time (UTC)', 'Opens'])
+
     def render_dashboard(self):
         st.set_page_config(layout="wide", page_title="Email Tracking Dashboard")
         
@@ -106,12 +144,29 @@ class EmailTrackingDashboard:
             st.subheader('Open Rates by Campaign')
             st.bar_chart(campaign_df.set_index('Campaign ID')['Open Rate (%)'])
         
+        # Open Trends
+        st.header('Opens Over Time')
+        col_campaign, col_resolution = st.columns(2)
+        campaign_ids = sorted(campaign_df['Campaign ID'].unique()) if not campaign_df.empty else []
+        campaign = col_campaign.selectbox('Campaign', ['All Campaigns'] + campaign_ids)
+        resolution = col_resolution.selectbox('Resolution', ['minute', 'hour', 'day'], index=1)
+        timeseries_df = self.get_open_timeseries(None if campaign == 'All Campaigns' else campaign, resolution)
+        if not timeseries_df.empty:
+            st.line_chart(timeseries_df.set_index('Time (UTC)')['Opens'])
+        
         # Detailed Tracking
         st.header('Detailed Tracking Data')
         st.dataframe(detailed_df)
+        
+        # Cache effectiveness
+        stats = self.cache.stats()
+        st.sidebar.caption('Cache: {} hits, {} misses ({:.0%} hit rate)'.format(
+            stats['hits'], stats['misses'], stats['hit_rate']))
 
 def main():
-    dashboard = EmailTrackingDashboard()
+    # DASHBOARD_SOURCE=snapshot reads the Parquet snapshot written by snapshot.py
+    snapshot_dir = snapshot.SNAPSHOT_DIR if os.environ.get('DASHBOARD_SOURCE') == 'snapshot' else None
+    dashboard = EmailTrackingDashboard(snapshot_dir=snapshot_dir)
     dashboard.render_dashboard()
 
 if __name__ == "__main__":
@@ -27,6 +27,10 @@ pip install --upgrade pip
 REM Install dependencies
 pip install -r requirements.txt
 
+REM Apply schema migrations once, before the workers start
+python migrations.py
+if errorlevel 1 exit /b 1
+
 REM Start pixel tracker in background
 start /B gunicorn -w 4 -b 0.0.0.0:8080 pixel_tracker_py2:app
 
@@ -31,7 +31,13 @@ pip install -r requirements.txt
 # Ensure tracking data directory exists
 mkdir -p tracking_logs
 
+# Apply schema migrations once, before the workers start, so long backfills
+# never run while gunicorn boots its workers
+python migrations.py
+
 # Start pixel tracker in background
+# For large open spikes run the async tracker instead:
+#   nohup uvicorn pixel_tracker_asgi:app --host 0.0.0.0 --port 8080 --no-access-log &
 nohup gunicorn -w 4 -b 0.0.0.0:8080 pixel_tracker_py2:app &
 
 # Optional: Start dashboard in background
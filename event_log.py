@@ -0,0 +1,427 @@
+"""
+Structured event log of pixel hits
+
+Every captured hit is handed to a QueueHandler as soon as the request
+arrives, before it is buffered for storage; the handler only enqueues the
+event dictionary, and a QueueListener thread encodes it as one compact JSON
+line and appends it to the process's segment, so the request path never
+formats or writes anything itself.
+
+Each process writes its own active segment, pixel_events.<pid>.ndjson, in
+EVENT_LOG_DIR. A segment is rotated once it reaches MAX_BYTES or crosses a
+ROTATE_SECONDS boundary, and when the process shuts down: it is renamed to
+pixel_events.<UTC rotation time>.<pid>.ndjson, gzip-compressed, and the oldest
+compressed segments beyond BACKUP_COUNT are deleted. Active segments left
+by a crashed process stay uncompressed but are still replayed.
+
+Logged hits can be replayed into the tracking database, e.g. after writes
+were lost or hits were dropped by a full buffer. Replay classifies each
+captured hit the way the trackers do, so prefetches, forged tokens and
+repeats within the dedupe window stay out, and skips hits already present
+(same campaign, recipient and timestamp):
+    python event_log.py replay [--db PATH] [--since TIMESTAMP] [SEGMENT ...]
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    # Python 2 has neither; these follow the Python 3 interface
+    class QueueHandler(logging.Handler):
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def prepare(self, record):
+            return record
+
+        def emit(self, record):
+            try:
+                self.queue.put_nowait(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener(object):
+        _sentinel = None
+
+        def __init__(self, queue, *handlers):
+            self.queue = queue
+            self.handlers = handlers
+            self._thread = None
+
+        def start(self):
+            self._thread = threading.Thread(target=self._monitor)
+            self._thread.daemon = True
+            self._thread.start()
+
+        def _monitor(self):
+            while True:
+                record = self.queue.get()
+                if record is self._sentinel:
+                    break
+                for handler in self.handlers:
+                    handler.handle(record)
+
+        def stop(self):
+            self.queue.put_nowait(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+import storage
+
+EVENT_LOG_DIR = os.environ.get('TRACKING_EVENT_LOG_DIR', os.path.join(storage.BASE_DIR, 'tracking_logs'))
+
+# Segment size and age limits before rotation, and compressed segments kept
+MAX_BYTES = int(os.environ.get('TRACKING_EVENT_LOG_MAX_BYTES', 64 * 1024 * 1024))
+ROTATE_SECONDS = int(os.environ.get('TRACKING_EVENT_LOG_ROTATE_SECONDS', 3600))
+BACKUP_COUNT = int(os.environ.get('TRACKING_EVENT_LOG_BACKUPS', 24 * 14))
+
+LOG_NAME = 'pixel_events'
+
+# Events replayed per write transaction
+REPLAY_BATCH_SIZE = 500
+
+_SEGMENT = re.compile(r'\.(\d{8}T\d{6}-\d{6})\.(\d+)\.ndjson(?:\.gz)?$')
+
+class NDJSONFormatter(logging.Formatter):
+    """
+    One compact JSON object per line; None values are left out
+    """
+    def format(self, record):
+        event = record.msg
+        if not isinstance(event, dict):
+            event = {'message': record.getMessage()}
+        return json.dumps(dict((key, value) for key, value in event.items() if value is not None),
+                          separators=(',', ':'))
+
+class RotatingNDJSONHandler(logging.FileHandler):
+    def __init__(self, log_dir=EVENT_LOG_DIR, name=LOG_NAME, max_bytes=MAX_BYTES,
+                 interval=ROTATE_SECONDS, backup_count=BACKUP_COUNT):
+        """
+        Append to this process's segment, rotating by size and time into gzip files
+
+        :param log_dir: Directory of the segments
+        :param name: Segment name prefix
+        :param max_bytes: Segment size that triggers rotation; 0 disables it
+        :param interval: Seconds per segment, aligned to UTC boundaries; 0 disables it
+        :param backup_count: Compressed segments kept; 0 keeps all of them
+        """
+        self.log_dir = log_dir
+        self.name_prefix = name
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.rollover_at = None
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        path = os.path.join(log_dir, '{}.{}.ndjson'.format(name, os.getpid()))
+        logging.FileHandler.__init__(self, path, delay=True)
+        self.setFormatter(NDJSONFormatter())
+
+    def _next_rollover(self, now):
+        return (int(now) // self.interval + 1) * self.interval if self.interval else None
+
+    def emit(self, record):
+        now = time.time()
+        if self.rollover_at is None:
+            self.rollover_at = self._next_rollover(now)
+        if self.stream is not None and (
+                (self.rollover_at is not None and now >= self.rollover_at) or
+                (self.max_bytes and self.stream.tell() >= self.max_bytes)):
+            self.do_rollover(now)
+        logging.FileHandler.emit(self, record)
+
+    def do_rollover(self, now=None):
+        """
+        Close the active segment, then compress it and prune old segments
+        """
+        now = time.time() if now is None else now
+        self.rollover_at = self._next_rollover(now)
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if not os.path.exists(self.baseFilename) or not os.path.getsize(self.baseFilename):
+            return
+        # Microseconds keep names unique and sortable when segments fill up quickly
+        stamp = '{}-{:06d}'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)), int(now % 1 * 1e6))
+        rotated = os.path.join(self.log_dir, '{}.{}.{}.ndjson'.format(self.name_prefix, stamp, os.getpid()))
+        os.rename(self.baseFilename, rotated)
+        try:
+            with open(rotated, 'rb') as source:
+                with gzip.open(rotated + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+            os.remove(rotated)
+        except (IOError, OSError) as e:
+            logging.error('Error compressing event log segment: {}'.format(e))
+        self.prune()
+
+    def prune(self):
+        """
+        Delete the oldest compressed segments beyond backup_count
+        """
+        if not self.backup_count:
+            return
+        segments = list_segments(self.log_dir, self.name_prefix, active=False)
+        for path in segments[:-self.backup_count]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.error('Error removing event log segment: {}'.format(e))
+
+class EventLog(object):
+    def __init__(self, log_dir=EVENT_LOG_DIR, name=LOG_NAME, **handler_options):
+        """
+        Asynchronous event log: QueueHandler on the calling thread, QueueListener writing segments
+
+        :param log_dir: Directory of the segments
+        :param name: Segment name prefix, also used for the logger name
+        :param handler_options: max_bytes, interval and backup_count for RotatingNDJSONHandler
+        """
+        self.log_dir = log_dir
+        self.name = name
+        self.handler_options = handler_options
+        self.logger = logging.getLogger('tracking_events.{}'.format(name))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.lock = threading.Lock()
+        self.queue = None
+        self.handler = None
+        self.listener = None
+        self.pid = None
+
+    def start(self):
+        """
+        Start the listener thread, again after a fork since threads do not survive it
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = queue.Queue()
+            self.handler = RotatingNDJSONHandler(self.log_dir, self.name, **self.handler_options)
+            self.listener = QueueListener(self.queue, self.handler)
+            self.listener.start()
+            self.logger.handlers = [_EventQueueHandler(self.queue)]
+
+    def log(self, event):
+        """
+        Queue one event for writing
+
+        :param event: Dictionary of JSON-serializable values
+        """
+        if self.pid != os.getpid():
+            self.start()
+        # logger.info would also walk the stack to find the caller, which costs more than the rest
+        self.logger.handle(self.logger.makeRecord(self.logger.name, logging.INFO, '', 0, event, None, None))
+
+    def stop(self):
+        """
+        Write every queued event and close the active segment; registered to run at shutdown
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.logger.handlers = []
+            self.listener.stop()
+            # Hand the segment over for compression rather than leaving it active
+            self.handler.acquire()
+            try:
+                self.handler.do_rollover()
+            finally:
+                self.handler.release()
+            self.handler.close()
+            self.pid = None
+
+class _EventQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The listener formats the event; the stock prepare would format it here
+        return record
+
+_event_log = None
+_event_log_lock = threading.Lock()
+
+def get_event_log():
+    """
+    Process-wide event log in EVENT_LOG_DIR
+    """
+    global _event_log
+    if _event_log is None:
+        with _event_log_lock:
+            if _event_log is None:
+                _event_log = EventLog()
+    return _event_log
+
+def log_event(event):
+    """
+    Queue an event on the process-wide event log
+
+    :param event: Dictionary of JSON-serializable values
+    """
+    get_event_log().log(event)
+
+def list_segments(log_dir=EVENT_LOG_DIR, name=LOG_NAME, active=True):
+    """
+    Paths of the segments in a log directory
+
+    :param active: Include the segments processes are still appending to
+    :return: List of paths, compressed segments in rotation order first
+    """
+    rotated = sorted((match.group(1), path) for path, match in (
+        (path, _SEGMENT.search(path)) for path in glob.glob(os.path.join(log_dir, name + '.*.ndjson*')))
+        if match is not None)
+    paths = [path for _, path in rotated]
+    if active:
+        paths.extend(sorted(path for path in glob.glob(os.path.join(log_dir, name + '.*.ndjson'))
+                            if _SEGMENT.search(path) is None))
+    return paths
+
+def read_events(path):
+    """
+    Events of one segment, skipping lines that are not valid JSON, e.g. a line cut off by a crash
+
+    :param path: Segment path, gzip-compressed if it ends with .gz
+    :return: Generator of event dictionaries
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for line in f:
+            try:
+                event = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(event, dict):
+                yield event
+
+def replay(paths, db_path=storage.TRACKING_DB_PATH, since=None, dry_run=False):
+    """
+    Write logged hits that are missing from the database
+
+    :param paths: Segment paths
+    :param db_path: Path to the tracking database
+    :param since: Only replay hits at or after this stored timestamp text
+    :param dry_run: Count missing hits without writing them
+    :return: Dictionary with read, skipped, present, duplicate and written counts
+    """
+    import proxy_filter
+    import tracking_tokens
+    from tracking_writer import TrackingWriter
+
+    # Configured like the trackers' own filter, from the same environment
+    hit_filter = proxy_filter.HitFilter()
+    deliveries = tracking_tokens.DeliveryResolver(db_path)
+    counts = {'read': 0, 'skipped': 0, 'present': 0, 'duplicate': 0, 'written': 0}
+    writer = None if dry_run else TrackingWriter(db_path, dedupe_window=hit_filter.dedupe_window)
+    conn = storage.connect(db_path)
+    try:
+        batch = []
+        for path in paths:
+            for event in read_events(path):
+                counts['read'] += 1
+                row = _replay_row(event, hit_filter, deliveries)
+                if row is None or not row[3] or (since and row[3] < since):
+                    counts['skipped'] += 1
+                    continue
+                batch.append(row)
+                if len(batch) >= REPLAY_BATCH_SIZE:
+                    _replay_batch(conn, writer, batch, counts)
+                    batch = []
+        if batch:
+            _replay_batch(conn, writer, batch, counts)
+    finally:
+        conn.close()
+        if writer is not None:
+            writer.close()
+    return counts
+
+def _replay_row(event, hit_filter, deliveries):
+    """
+    Row to store for a logged event, or None if the trackers would not store it
+    """
+    import tracking_hits
+    from tracking_writer import TRACK_COLUMNS
+
+    hit_item = tracking_hits.hit_item_of(event)
+    if hit_item is None:
+        # Segments written before hits were logged at capture hold classified hits
+        return tuple(event.get(column) for column in TRACK_COLUMNS) if event.get('stored') else None
+    try:
+        return tracking_hits.process_hit(hit_item, hit_filter, deliveries)
+    except Exception as e:
+        logging.error('Error replaying pixel hit: {}'.format(e))
+        return None
+
+def _replay_batch(conn, writer, rows, counts):
+    """
+    Write the rows of a batch that the database does not have yet
+    """
+    present = set()
+    campaigns = {}
+    for row in rows:
+        campaigns.setdefault(row[0], []).append(row[3])
+    for campaign_id, timestamps in campaigns.items():
+        query = ('SELECT recipient, timestamp FROM pixel_tracks WHERE campaign_id {} ? '
+                 'AND timestamp BETWEEN ? AND ?').format('IS' if campaign_id is None else '=')
+        for recipient, timestamp in conn.execute(query, (campaign_id, min(timestamps), max(timestamps))):
+            present.add((campaign_id, recipient, timestamp))
+    conn.rollback()
+
+    missing = []
+    for row in rows:
+        key = (row[0], row[2], row[3])
+        if key in present:
+            counts['present'] += 1
+        else:
+            present.add(key)
+            missing.append(row)
+    if not missing:
+        return
+    if writer is None:
+        counts['written'] += len(missing)
+        return
+    duplicates = writer.duplicate_count
+    written = writer.write(missing)
+    duplicates = writer.duplicate_count - duplicates
+    if written + duplicates != len(missing):
+        raise RuntimeError('Replay stopped: {} of {} hits written'.format(written, len(missing)))
+    counts['written'] += written
+    counts['duplicate'] += duplicates
+
+def main():
+    parser = argparse.ArgumentParser(description='Pixel hit event log')
+    subparsers = parser.add_subparsers(dest='command')
+    replay_parser = subparsers.add_parser('replay', help='write logged hits missing from the database')
+    replay_parser.add_argument('segments', nargs='*', help='segments to replay; all in --log-dir by default')
+    replay_parser.add_argument('--db', default=storage.TRACKING_DB_PATH, help='tracking database path')
+    replay_parser.add_argument('--log-dir', default=EVENT_LOG_DIR, help='event log directory')
+    replay_parser.add_argument('--since', help="only hits at or after this UTC time, e.g. '2024-01-31 00:00:00'")
+    replay_parser.add_argument('--dry-run', action='store_true', help='count missing hits without writing them')
+    args = parser.parse_args()
+    if args.command != 'replay':
+        parser.error('choose a command')
+
+    import migrations
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    migrations.migrate_tracking_db(args.db)
+    paths = args.segments or list_segments(args.log_dir)
+    counts = replay(paths, args.db, since=args.since, dry_run=args.dry_run)
+    print('{}: {} events in {} segments, {} not stored hits, {} already present, {} repeats collapsed, {} {}'.format(
+        args.db, counts['read'], len(paths), counts['skipped'], counts['present'], counts['duplicate'],
+        counts['written'], 'missing' if args.dry_run else 'written'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Streaming CSV/NDJSON export of tracking events
+
+Rows are read from a SQLite cursor in batches and encoded chunk by chunk, so
+memory use does not depend on how many events are exported.
+
+Export from the command line with:
+    python export.py [--campaign-id ID] [--format csv|ndjson] [--gzip] [--output FILE]
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+import zlib
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import storage
+
+EXPORT_COLUMNS = ('id', 'campaign_id', 'sender_email', 'recipient', 'timestamp',
+                  'user_agent', 'ip_address', 'device_info', 'location')
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Rows fetched from SQLite and encoded per chunk
+BATCH_SIZE = 1000
+
+_text_type = type(u'')
+
+def iter_rows(conn, campaign_id=None, batch_size=BATCH_SIZE, stats=None):
+    """
+    Stream pixel_tracks rows from a cursor
+
+    :param conn: sqlite3 connection
+    :param campaign_id: Export one campaign, or every event if None
+    :param batch_size: Rows fetched per round trip
+    :param stats: Optional dictionary whose 'rows' count is updated as rows are read
+    :return: Generator of lists of row tuples in EXPORT_COLUMNS order
+    """
+    query = 'SELECT {} FROM pixel_tracks'.format(', '.join(EXPORT_COLUMNS))
+    params = ()
+    if campaign_id is not None:
+        query += ' WHERE campaign_id = ?'
+        params = (campaign_id,)
+    cursor = conn.execute(query, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if stats is not None:
+                stats['rows'] = stats.get('rows', 0) + len(rows)
+            yield rows
+    finally:
+        cursor.close()
+
+def _csv_value(value):
+    # Python 2's csv module only writes byte strings
+    if bytes is str and isinstance(value, _text_type):
+        return value.encode('utf-8')
+    return value
+
+def iter_csv(batches):
+    """
+    Encode row batches as CSV text, starting with a header line
+
+    :param batches: Iterable of lists of row tuples
+    :return: Generator of CSV chunks
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows([[_csv_value(value) for value in row] for row in rows])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def iter_ndjson(batches):
+    """
+    Encode row batches as newline-delimited JSON objects
+
+    :param batches: Iterable of lists of row tuples
+    :return: Generator of NDJSON chunks
+    """
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+
+def gzip_chunks(chunks, level=6):
+    """
+    Compress a stream of text chunks into a single gzip stream
+
+    :param chunks: Iterable of text chunks
+    :param level: zlib compression level
+    :return: Generator of gzip-compressed byte chunks
+    """
+    # wbits 31 makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        if isinstance(chunk, _text_type):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_export(conn, campaign_id=None, fmt='csv', compress=False, batch_size=BATCH_SIZE, stats=None):
+    """
+    Stream an export of tracking events
+
+    :param conn: sqlite3 connection
+    :param campaign_id: Export one campaign, or every event if None
+    :param fmt: 'csv' or 'ndjson'
+    :param compress: Gzip the output
+    :param batch_size: Rows per chunk
+    :param stats: Optional dictionary receiving the exported row count
+    :return: Generator of text chunks, or byte chunks when compressed
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format {!r}'.format(fmt))
+    batches = iter_rows(conn, campaign_id, batch_size, stats)
+    chunks = iter_csv(batches) if fmt == 'csv' else iter_ndjson(batches)
+    return gzip_chunks(chunks) if compress else chunks
+
+def main():
+    parser = argparse.ArgumentParser(description='Export tracking events')
+    parser.add_argument('--db', default=storage.TRACKING_DB_PATH, help='tracking database path')
+    parser.add_argument('--campaign-id', help='export a single campaign')
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+    parser.add_argument('--gzip', action='store_true', help='gzip the output')
+    parser.add_argument('--output', help='output file (default: stdout)')
+    args = parser.parse_args()
+
+    conn = storage.connect(args.db)
+    stats = {'rows': 0}
+    if args.output:
+        out = open(args.output, 'wb')
+    else:
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+    start = time.time()
+    try:
+        for chunk in iter_export(conn, args.campaign_id, args.format, args.gzip, stats=stats):
+            if isinstance(chunk, _text_type):
+                chunk = chunk.encode('utf-8')
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+        conn.close()
+
+    elapsed = time.time() - start
+    sys.stderr.write('Exported {} rows in {:.2f}s ({:.0f} rows/s)\n'.format(
+        stats['rows'], elapsed, stats['rows'] / max(elapsed, 1e-9)))
+
+if __name__ == '__main__':
+    main()
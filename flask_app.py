@@ -47,23 +47,27 @@ import logging
 import threading
 import Queue
 import pytz
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, stream_with_context
 from werkzeug.utils import secure_filename
 import datetime
 import sqlite3
-from mailer import EmailSender, read_file_lines
-
-# Tracking domain configuration
-TRACKING_DOMAIN = os.environ.get('TRACKING_DOMAIN', 'http://45.141.122.177:8080')
+import cache
+import campaign_pages
+import export
+import migrations
+import metrics
+import rollups
+import storage
+from mailer import DEFAULT_BACKEND, PIXEL_TAG, create_sender, iter_email_list, iter_file_lines, iter_recipients
 
 # Create declarative base and session
 Base = declarative_base()
 
 # Define the PixelTrack class
 class PixelTrack(Base):
-    __tablename__ = 'pixel_tracks'
+    __tablename__ = 'pixel_tracks'  # View over pixel_events and its lookup tables
     
-    id = sa.Column(sa.String, primary_key=True)
+    id = sa.Column(sa.Integer, primary_key=True)
     campaign_id = sa.Column(sa.String)
     sender_email = sa.Column(sa.String)
     recipient = sa.Column(sa.String)
@@ -71,10 +75,21 @@ class PixelTrack(Base):
     ip_address = sa.Column(sa.String)
     device_info = sa.Column(sa.String)
 
+# Campaign totals kept up to date by the tracking writer
+class CampaignRollup(Base):
+    __tablename__ = 'campaign_rollups'
+    
+    campaign_id = sa.Column(sa.String, primary_key=True)
+    sender_email = sa.Column(sa.String, primary_key=True)
+    unique_recipients = sa.Column(sa.Integer)
+    total_opens = sa.Column(sa.Integer)
+    first_open = sa.Column(sa.DateTime)
+    last_open = sa.Column(sa.DateTime)
+
 # Create engine and session
 try:
-    engine = sa.create_engine('sqlite:///tracking.db')
-    Base.metadata.create_all(engine)
+    migrations.migrate_tracking_db(storage.TRACKING_DB_PATH)
+    engine = storage.create_engine(storage.TRACKING_DB_PATH)
     Session = sessionmaker(bind=engine)
 except Exception as e:
     print("Database initialization failed: {}".format(e))
@@ -89,86 +104,25 @@ if not os.path.exists(app.config['UPLOAD_FOLDER']):
 # India timezone
 INDIA_TZ = pytz.timezone('Asia/Kolkata')
 
-# Add contextmanager import
-from contextlib import contextmanager
+# Bounded pool of tracking database connections shared by request threads
+db_pool = storage.ConnectionPool(storage.TRACKING_DB_PATH, max_connections=5)
 
-class DatabaseConnectionPool:
-    def __init__(self, max_connections=5):
-        """
-        Initialize database connection pool
-        """
-        self.max_connections = max_connections
-        self.connections = []
-    
-    @contextmanager
-    def get_connection(self):
-        """
-        Context manager for database connections
-        Simplified for Python 2.7 compatibility
-        """
-        # Check if we have available connections
-        if not self.connections:
-            # Create a new connection if under max limit
-            if len(self.connections) < self.max_connections:
-                conn = sqlite3.connect('tracking.db')
-                self.connections.append(conn)
-            else:
-                # Reuse an existing connection
-                conn = self.connections[0]
-        else:
-            # Get the first available connection
-            conn = self.connections[0]
-        
-        try:
-            yield conn
-        except Exception as e:
-            print 'Database connection error: {}'.format(e)
-            # Remove problematic connection
-            if conn in self.connections:
-                self.connections.remove(conn)
-        finally:
-            # Do not close the connection, just return it to the pool
-            if conn not in self.connections:
-                self.connections.append(conn)
-    
-    def close_all_connections(self):
-        """
-        Close all database connections
-        """
-        for conn in self.connections:
-            try:
-                conn.close()
-            except Exception as e:
-                print 'Error closing connection: {}'.format(e)
-        
-        # Clear the connections list
-        self.connections = []
+# Dashboard aggregates, recomputed when the tracking writer commits a batch
+dashboard_cache = cache.get_cache('dashboard', max_entries=256)
 
-# Initialize the connection pool
-db_pool = DatabaseConnectionPool()
+def get_tracking_version():
+    """
+    Current tracking write counter, used to version cached aggregates
+    """
+    with db_pool.get_connection() as conn:
+        return cache.get_version(conn)
 
 def create_tracking_database():
     """
-    Create tracking database and table if not exists
+    Create tracking database and bring its schema up to date
     """
     try:
-        with db_pool.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Create table if not exists
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pixel_tracks (
-                id TEXT PRIMARY KEY,
-                campaign_id TEXT,
-                sender_email TEXT,
-                recipient TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                ip_address TEXT,
-                user_agent TEXT
-            )
-            ''')
-            
-            conn.commit()
+        migrations.migrate_tracking_db(storage.TRACKING_DB_PATH)
         return True
     except Exception as e:
         print('Error creating tracking database: {}'.format(e))
@@ -224,10 +178,6 @@ def send_emails():
             recipients_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(recipients_file.filename))
             recipients_file.save(recipients_path)
             
-            # Read recipients
-            with open(recipients_path, 'r') as f:
-                recipients = [line.strip() for line in f if line.strip()]
-            
             # Get form data
             subject = request.form['subject']
             body = request.form['body']
@@ -248,28 +198,26 @@ def send_emails():
             now = datetime.datetime.now(INDIA_TZ)
             campaign_id = now.strftime("%d %b %Y")  # Exactly as requested
             
-            # Prepare tracking pixel
-            email_list = []
-            for recipient in recipients:
-                tracking_pixel = '<img src="{}/track?campaign_id={}&sender={}&recipient={}" width="1" height="1" style="display:none;">'.format(
-                    TRACKING_DOMAIN, campaign_id, account_creds[0], recipient
-                )
-                full_body = body + '\n\n' + tracking_pixel
-                
-                # Handle attachments
-                attachments = request.files.getlist('attachments')
-                attachment_paths = []
-                for attachment in attachments:
-                    if attachment.filename:
-                        attachment_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(attachment.filename))
-                        attachment.save(attachment_path)
-                        attachment_paths.append(attachment_path)
-                
-                email_list.append((recipient, subject, full_body, campaign_id, attachment_paths or None))
+            # Handle attachments
+            attachments = request.files.getlist('attachments')
+            attachment_paths = []
+            for attachment in attachments:
+                if attachment.filename:
+                    attachment_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(attachment.filename))
+                    attachment.save(attachment_path)
+                    attachment_paths.append(attachment_path)
+            
+            # Add tracking pixel once; the sender fills in each recipient's pixel URL
+            full_body = body + '\n\n' + PIXEL_TAG
+            
+            # Stream recipients from the uploaded file, optionally followed by a first name for {{first_name}}
+            recipients = iter_recipients(iter_file_lines(recipients_path))
+            email_list = iter_email_list(recipients, subject, full_body, campaign_id, attachment_paths or None)
             
             # Send emails
-            sender = EmailSender(account_creds[0], account_creds[1])
-            results = sender.send_emails_threaded(email_list)
+            sender = create_sender(account_creds[0], account_creds[1],
+                                   backend=request.form.get('backend', DEFAULT_BACKEND))
+            summary = sender.send_emails(email_list, keep_results=False)
             
             # Clean up uploaded files
             os.remove(accounts_path)
@@ -277,11 +225,7 @@ def send_emails():
             for path in attachment_paths:
                 os.remove(path)
             
-            # Count results
-            successful = sum(1 for result in results if result[0])
-            failed = len(results) - successful
-            
-            flash('Campaign sent! {} emails sent successfully, {} failed.'.format(successful, failed), 'success')
+            flash('Campaign sent! {} emails sent successfully, {} failed.'.format(summary.sent, summary.failed), 'success')
             return redirect(url_for('index'))
         
         except Exception as e:
@@ -291,55 +235,27 @@ def send_emails():
     # GET request: show send emails page
     return render_template('send_emails.html')
 
-@app.route('/dashboard')
-def dashboard():
+def load_dashboard_data():
     """
-    Comprehensive campaign tracking dashboard
+    Compute campaign, detailed and overall metrics for the dashboard
     """
     session = Session()
     try:
         # Campaign-level metrics
         campaign_metrics = session.query(
-            PixelTrack.campaign_id,
-            PixelTrack.sender_email,
-            sa.func.count(sa.func.distinct(PixelTrack.recipient)).label('unique_recipients'),
-            sa.func.count(PixelTrack.id).label('total_opens'),
-            sa.func.min(PixelTrack.timestamp).label('first_open'),
-            sa.func.max(PixelTrack.timestamp).label('last_open')
-        ).group_by(
-            PixelTrack.campaign_id, 
-            PixelTrack.sender_email
+            CampaignRollup.campaign_id,
+            CampaignRollup.sender_email,
+            CampaignRollup.unique_recipients,
+            CampaignRollup.total_opens,
+            CampaignRollup.first_open,
+            CampaignRollup.last_open
+        ).filter(
+            CampaignRollup.sender_email != rollups.ALL_SENDERS
         ).all()
         
-        # Prepare campaign data
-        campaign_data = []
-        for stat in campaign_metrics:
-            campaign_id = stat[0] or 'Unknown'
-            sender_email = stat[1] or 'Unknown'
-            unique_recipients = stat[2]
-            total_opens = stat[3]
-            first_open = stat[4]
-            last_open = stat[5]
-            
-            # Calculate open rate
-            open_rate = round(float(unique_recipients) / max(total_opens, 1) * 100, 2) if total_opens > 0 else 0
-            
-            # Calculate campaign duration
-            campaign_duration = 0
-            if first_open and last_open:
-                duration_seconds = (last_open - first_open).total_seconds()
-                campaign_duration = round(duration_seconds / 3600, 2)
-            
-            campaign_data.append({
-                'Campaign ID': campaign_id,
-                'Sender Email': sender_email,
-                'Unique Recipients': unique_recipients,
-                'Total Opens': total_opens,
-                'Open Rate (%)': open_rate,
-                'First Open': first_open.strftime('%Y-%m-%d %H:%M:%S') if first_open else 'N/A',
-                'Last Open': last_open.strftime('%Y-%m-%d %H:%M:%S') if last_open else 'N/A',
-                'Campaign Duration (Hours)': campaign_duration
-            })
+        # Open rates and durations for every campaign row at once
+        campaign_columns = metrics.campaign_metrics(metrics.rows_to_columns(campaign_metrics))
+        campaign_data = metrics.to_records(campaign_columns)
         
         # Detailed tracking data
         detailed_tracking = session.query(
@@ -360,66 +276,152 @@ def dashboard():
                 'Device': stat[4] or 'Unknown'
             })
         
-        # Overall metrics
-        total_campaigns = len(campaign_data)
-        total_unique_recipients = sum([data['Unique Recipients'] for data in campaign_data])
-        total_opens = sum([data['Total Opens'] for data in campaign_data])
-        avg_open_rate = sum([data['Open Rate (%)'] for data in campaign_data]) / max(total_campaigns, 1)
-        
-        return render_template('campaign_dashboard.html', 
-            campaign_metrics=campaign_data, 
-            detailed_tracking=detailed_data,
-            overall_metrics={
-                'Total Campaigns': total_campaigns,
-                'Total Unique Recipients': total_unique_recipients,
-                'Total Opens': total_opens,
-                'Average Open Rate (%)': round(avg_open_rate, 2)
-            }
-        )
+        return {
+            'campaign_metrics': campaign_data,
+            'detailed_tracking': detailed_data,
+            'overall_metrics': metrics.overall_metrics(campaign_columns)
+        }
+    finally:
+        session.close()
+
+@app.route('/dashboard')
+def dashboard():
+    """
+    Comprehensive campaign tracking dashboard
+    """
+    try:
+        data = dashboard_cache.get_or_compute(('dashboard',), get_tracking_version(), load_dashboard_data)
+        return render_template('campaign_dashboard.html', **data)
     except Exception as e:
         # Log the error
         print 'Dashboard generation error: {}'.format(e)
         return render_template('error.html', error=str(e))
-    finally:
-        session.close()
+
+def parse_timestamp(value):
+    """
+    Parse a stored UTC timestamp into an India timezone datetime
+    """
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            timestamp = datetime.datetime.strptime(value, fmt)
+            return pytz.utc.localize(timestamp).astimezone(INDIA_TZ)
+        except ValueError:
+            pass
+    return None
+
+def get_page_size():
+    """
+    Page size requested by the client, clamped to campaign_pages.MAX_PAGE_SIZE
+    """
+    try:
+        page_size = int(request.args.get('page_size', campaign_pages.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        page_size = campaign_pages.DEFAULT_PAGE_SIZE
+    return max(1, min(page_size, campaign_pages.MAX_PAGE_SIZE))
+
+def load_campaign_page(campaign_id, cursor=None, page_size=campaign_pages.DEFAULT_PAGE_SIZE):
+    """
+    Load one page of a campaign's opens, newest first, with India time timestamps
+
+    :param campaign_id: Campaign to list
+    :param cursor: Cursor returned with the previous page, None for the first page
+    :param page_size: Rows per page
+    :return: Tuple of (rows, next cursor or None)
+    """
+    with db_pool.get_connection() as conn:
+        rows, next_cursor = campaign_pages.fetch_page(conn, campaign_id, cursor, page_size)
+
+    # Only the visible page is converted to India time
+    for row in rows:
+        row['timestamp'] = parse_timestamp(row['timestamp'])
+    return rows, next_cursor
+
+def get_campaign_page(campaign_id):
+    """
+    Cached page of campaign details for the current request's cursor and page size
+    """
+    cursor = request.args.get('cursor') or None
+    page_size = get_page_size()
+    return dashboard_cache.get_or_compute(
+        ('campaign_details', campaign_id, cursor, page_size),
+        get_tracking_version(),
+        lambda: load_campaign_page(campaign_id, cursor, page_size)
+    )
 
 @app.route('/campaign_details/<campaign_id>')
 def campaign_details(campaign_id):
     """
-    Detailed view for a specific campaign
+    Detailed view for a specific campaign, one page at a time
     """
     try:
-        with db_pool.get_connection() as conn:
-            # Use pandas if available
-            if pd is not None:
-                df = pd.read_sql_query(
-                    "SELECT * FROM pixel_tracks WHERE campaign_id = ?", 
-                    conn, 
-                    params=(campaign_id,)
-                )
-                
-                # Convert timestamps to India timezone
-                df['timestamp'] = pd.to_datetime(df['timestamp']).dt.tz_localize('UTC').dt.tz_convert(INDIA_TZ)
-                
-                campaign_details = df.to_dict('records')
-                
-                return render_template('campaign_details.html', 
-                                       campaign_id=campaign_id,
-                                       campaign_details=campaign_details)
-            else:
-                # Fallback for no pandas
-                cursor = conn.cursor()
-                cursor.execute("SELECT * FROM pixel_tracks WHERE campaign_id = ?", (campaign_id,))
-                columns = [column[0] for column in cursor.description]
-                campaign_details = [dict(zip(columns, row)) for row in cursor.fetchall()]
-                
-                return render_template('campaign_details.html', 
-                                       campaign_id=campaign_id,
-                                       campaign_details=campaign_details)
+        campaign_details, next_cursor = get_campaign_page(campaign_id)
+        return render_template('campaign_details.html', 
+                               campaign_id=campaign_id,
+                               campaign_details=campaign_details,
+                               next_cursor=next_cursor)
     except Exception as e:
         flash('Error retrieving campaign details: {}'.format(e), 'error')
         return redirect(url_for('dashboard'))
 
+@app.route('/api/campaign_details/<campaign_id>')
+def campaign_details_api(campaign_id):
+    """
+    JSON pages of campaign details for infinite scroll
+    """
+    try:
+        rows, next_cursor = get_campaign_page(campaign_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print 'Campaign details error: {}'.format(e)
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({
+        'campaign_id': campaign_id,
+        'rows': [dict(row, timestamp=row['timestamp'].isoformat() if row['timestamp'] else None) for row in rows],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/export/<campaign_id>')
+def export_campaign(campaign_id):
+    """
+    Stream a campaign's tracking events as CSV or NDJSON, optionally gzipped
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.EXPORT_FORMATS:
+        return jsonify({'error': 'format must be one of {}'.format(', '.join(sorted(export.EXPORT_FORMATS)))}), 400
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    
+    def generate():
+        # A dedicated connection, so a long export never holds a pooled one
+        conn = storage.connect(storage.TRACKING_DB_PATH)
+        try:
+            for chunk in export.iter_export(conn, campaign_id, fmt, compress):
+                yield chunk
+        finally:
+            conn.close()
+    
+    filename = '{}.{}{}'.format(secure_filename(campaign_id) or 'campaign', fmt, '.gz' if compress else '')
+    mimetype = 'application/gzip' if compress else export.EXPORT_FORMATS[fmt]
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)})
+
+@app.route('/metrics/db_pool')
+def db_pool_metrics():
+    """
+    Tracking database pool utilization and wait times
+    """
+    return jsonify(db_pool.metrics())
+
+@app.route('/metrics/cache')
+def cache_metrics():
+    """
+    Dashboard cache hit/miss counters
+    """
+    return jsonify(cache.all_stats())
+
 if __name__ == '__main__':
     # Create tracking database before running
     create_tracking_database()
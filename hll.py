@@ -0,0 +1,233 @@
+"""
+HyperLogLog sketches of unique opens per campaign, sender and day
+
+A sketch with precision p keeps 2**p one-byte registers, so the default
+p=12 stores 4 KB per (campaign, sender, day) no matter how many hits it has
+seen. Estimates have a relative standard error of 1.04 / sqrt(2**p), about
+1.6% at p=12; 99.7% of estimates land within three standard errors (4.9%).
+Small counts switch to linear counting and are close to exact.
+
+Sketches merge by taking the register-wise maximum, so unique opens over
+any set of senders and days come from the stored sketches alone.
+
+Rebuild from pixel_tracks with:
+    python hll.py
+"""
+import argparse
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import struct
+from collections import defaultdict
+
+import cache
+import storage
+
+# Register index bits; 2**HLL_PRECISION bytes per sketch
+HLL_PRECISION = 12
+
+# Keep sketches up to date at ingest unless disabled with TRACKING_SKETCHES=0
+SKETCHES_ENABLED = os.environ.get('TRACKING_SKETCHES', '1') != '0'
+
+# 2**-rank for every possible register value
+_INVERSE_POWERS = [2.0 ** -rank for rank in range(65)]
+
+SELECT_SKETCH_SQL = 'SELECT sketch FROM campaign_sketches WHERE campaign_id = ? AND sender_email = ? AND day = ?'
+
+REPLACE_SKETCH_SQL = ('INSERT OR REPLACE INTO campaign_sketches (campaign_id, sender_email, day, sketch) '
+                      'VALUES (?, ?, ?, ?)')
+
+def _hash64(value):
+    """
+    64-bit hash of a string, stable across processes and Python versions
+    """
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return struct.unpack('>Q', hashlib.sha1(value).digest()[:8])[0]
+
+class HyperLogLog(object):
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        """
+        Mergeable cardinality sketch
+
+        :param precision: Number of hash bits selecting a register (4-16)
+        :param registers: Existing register values, e.g. from from_bytes
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError('HyperLogLog precision must be between 4 and 16')
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+        if len(self.registers) != self.size:
+            raise ValueError('Expected {} registers, got {}'.format(self.size, len(self.registers)))
+
+    def add(self, value):
+        """
+        Add a value to the sketch
+
+        :param value: String to count
+        """
+        x = _hash64(value)
+        index = x >> (64 - self.precision)
+        rest = x & ((1 << (64 - self.precision)) - 1)
+        # Position of the first 1 bit in the remaining hash bits
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Fold another sketch of the same precision into this one
+
+        :param other: HyperLogLog sketch
+        :return: self
+        """
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    @classmethod
+    def union(cls, sketches):
+        """
+        Merge many sketches in a single pass over the registers
+
+        :param sketches: Iterable of HyperLogLog sketches of the same precision
+        :return: New merged sketch, or None if there were no sketches
+        """
+        sketches = list(sketches)
+        if not sketches:
+            return None
+        if len(set(sketch.precision for sketch in sketches)) > 1:
+            raise ValueError('Cannot merge sketches of different precision')
+        if len(sketches) == 1:
+            return cls(sketches[0].precision, sketches[0].registers)
+        return cls(sketches[0].precision, map(max, *[sketch.registers for sketch in sketches]))
+
+    def count(self):
+        """
+        Estimate the number of distinct values added
+
+        :return: Estimated cardinality
+        """
+        m = self.size
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(map(_INVERSE_POWERS.__getitem__, self.registers))
+
+        # Linear counting is more accurate while many registers are still empty
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def error_bound(self):
+        """
+        Relative standard error of count()
+        """
+        return 1.04 / math.sqrt(self.size)
+
+    def to_bytes(self):
+        return bytes(bytearray([self.precision]) + self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytearray(data)
+        return cls(data[0], data[1:])
+
+def update_sketches(conn, hits):
+    """
+    Add a batch of new hits to the stored sketches
+
+    :param conn: sqlite3 connection with an open transaction
+    :param hits: Iterable of (campaign_id, sender_email, recipient, timestamp) tuples
+    """
+    groups = defaultdict(set)
+    for campaign_id, sender_email, recipient, timestamp in hits:
+        if recipient is None:
+            continue
+        day = str(timestamp)[:10] if timestamp is not None else ''
+        groups[(campaign_id or '', sender_email or '', day)].add(recipient)
+
+    for key, recipients in groups.items():
+        row = conn.execute(SELECT_SKETCH_SQL, key).fetchone()
+        sketch = HyperLogLog.from_bytes(row[0]) if row else HyperLogLog()
+        for recipient in recipients:
+            sketch.add(recipient)
+        conn.execute(REPLACE_SKETCH_SQL, key + (sqlite3.Binary(sketch.to_bytes()),))
+
+def rebuild_sketches(conn):
+    """
+    Recompute every sketch from pixel_tracks
+
+    :param conn: sqlite3 connection with an open transaction
+    """
+    conn.execute('DELETE FROM campaign_sketches')
+    cursor = conn.execute('SELECT DISTINCT campaign_id, sender_email, recipient, SUBSTR(timestamp, 1, 10) '
+                          'FROM pixel_tracks WHERE recipient IS NOT NULL')
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        update_sketches(conn, rows)
+
+def estimate_unique(conn, campaign_id=None, sender_email=None, start_day=None, end_day=None):
+    """
+    Estimate unique recipients by merging the matching sketches
+
+    :param conn: sqlite3 connection
+    :param campaign_id: Restrict to one campaign
+    :param sender_email: Restrict to one sender
+    :param start_day: First day included, as YYYY-MM-DD
+    :param end_day: Last day included, as YYYY-MM-DD
+    :return: Merged HyperLogLog sketch, or None if nothing matched
+    """
+    conditions, params = [], []
+    for column, operator, value in (('campaign_id', '=', campaign_id), ('sender_email', '=', sender_email),
+                                    ('day', '>=', start_day), ('day', '<=', end_day)):
+        if value is not None:
+            conditions.append('{} {} ?'.format(column, operator))
+            params.append(value)
+    query = 'SELECT sketch FROM campaign_sketches'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    return HyperLogLog.union(HyperLogLog.from_bytes(row[0]) for row in conn.execute(query, params))
+
+def campaign_estimates(conn):
+    """
+    Estimated unique recipients of every campaign
+
+    :param conn: sqlite3 connection
+    :return: Dictionary of campaign_id to estimated unique recipients
+    """
+    sketches = defaultdict(list)
+    for campaign_id, data in conn.execute('SELECT campaign_id, sketch FROM campaign_sketches'):
+        sketches[campaign_id].append(HyperLogLog.from_bytes(data))
+    return dict((campaign_id, HyperLogLog.union(group).count()) for campaign_id, group in sketches.items())
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild unique-open sketches from pixel_tracks')
+    parser.add_argument('--db', default=storage.TRACKING_DB_PATH, help='tracking database path')
+    args = parser.parse_args()
+
+    import migrations
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    migrations.migrate_tracking_db(args.db)
+    conn = storage.connect(args.db)
+    try:
+        with conn:
+            rebuild_sketches(conn)
+            cache.bump_version(conn)
+        count = conn.execute('SELECT COUNT(*) FROM campaign_sketches').fetchone()[0]
+        print('{}: rebuilt {} sketches'.format(args.db, count))
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
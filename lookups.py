@@ -0,0 +1,180 @@
+"""
+Interned lookup tables for the strings repeated on every pixel event
+
+pixel_events stores an integer rowid and integer references into the
+campaigns, senders, recipients, user_agents and devices tables instead of a
+UUID and the strings themselves. The pixel_tracks view joins the strings
+back, so dashboards, rollup rebuilds and export keep reading pixel_tracks
+unchanged; an INSTEAD OF trigger on the view accepts inserts from writers
+that still target pixel_tracks.
+"""
+from collections import OrderedDict
+
+import cache
+
+# Value column of each lookup table: (lookup table, reference column in pixel_events)
+LOOKUPS = OrderedDict([
+    ('campaign_id', ('campaigns', 'campaign_ref')),
+    ('sender_email', ('senders', 'sender_ref')),
+    ('recipient', ('recipients', 'recipient_ref')),
+    ('user_agent', ('user_agents', 'user_agent_ref')),
+    ('device_info', ('devices', 'device_ref')),
+])
+
+# Columns of the pixel_tracks view, in order
+VIEW_COLUMNS = ('id', 'campaign_id', 'sender_email', 'recipient', 'timestamp',
+                'user_agent', 'ip_address', 'device_info', 'location', 'delivery_id')
+
+# Interned ids kept in memory per lookup table
+CACHE_SIZE = 65536
+
+# Values per IN (...) lookup, below SQLite's default bound parameter limit
+MAX_PARAMS = 500
+
+CREATE_EVENTS_SQL = '''CREATE TABLE IF NOT EXISTS pixel_events (
+    id INTEGER PRIMARY KEY,
+    campaign_ref INTEGER REFERENCES campaigns (id),
+    sender_ref INTEGER REFERENCES senders (id),
+    recipient_ref INTEGER REFERENCES recipients (id),
+    timestamp DATETIME,
+    user_agent_ref INTEGER REFERENCES user_agents (id),
+    ip_address VARCHAR,
+    device_ref INTEGER REFERENCES devices (id),
+    location VARCHAR,
+    delivery_id INTEGER REFERENCES deliveries (id)
+)'''
+
+def event_column(column):
+    """
+    Name of a pixel_tracks column in pixel_events
+    """
+    return LOOKUPS[column][1] if column in LOOKUPS else column
+
+def create_lookup_sql():
+    """
+    Statements creating the lookup tables
+    """
+    return ['CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, {} VARCHAR NOT NULL UNIQUE)'.format(table, column)
+            for column, (table, _) in LOOKUPS.items()]
+
+def create_view_sql():
+    """
+    Statement creating the pixel_tracks view over pixel_events
+    """
+    columns = []
+    for column in VIEW_COLUMNS:
+        if column in LOOKUPS:
+            columns.append('{}.{}'.format(LOOKUPS[column][0], column))
+        else:
+            columns.append('e.{}'.format(column))
+    joins = ['LEFT JOIN {0} ON {0}.id = e.{1}'.format(table, ref) for table, ref in LOOKUPS.values()]
+    return 'CREATE VIEW IF NOT EXISTS pixel_tracks AS SELECT {} FROM pixel_events e {}'.format(
+        ', '.join(columns), ' '.join(joins))
+
+def create_trigger_sql():
+    """
+    Statement routing inserts into the pixel_tracks view to pixel_events; NEW.id is ignored
+    """
+    statements = ['INSERT OR IGNORE INTO {0} ({1}) SELECT NEW.{1} WHERE NEW.{1} IS NOT NULL;'.format(table, column)
+                  for column, (table, _) in LOOKUPS.items()]
+    columns = VIEW_COLUMNS[1:]
+    values = ['(SELECT id FROM {0} WHERE {1} = NEW.{1})'.format(LOOKUPS[column][0], column)
+              if column in LOOKUPS else 'NEW.{}'.format(column) for column in columns]
+    statements.append('INSERT INTO pixel_events ({}) VALUES ({});'.format(
+        ', '.join(event_column(column) for column in columns), ', '.join(values)))
+    return 'CREATE TRIGGER IF NOT EXISTS pixel_tracks_insert INSTEAD OF INSERT ON pixel_tracks BEGIN {} END'.format(
+        ' '.join(statements))
+
+def copy_legacy_tracks(conn):
+    """
+    Migration step: intern the strings of the pixel_tracks table and copy its
+    rows into pixel_events in timestamp order, so ids follow time
+
+    :param conn: sqlite3 connection with an open transaction
+    """
+    for column, (table, _) in LOOKUPS.items():
+        conn.execute('INSERT OR IGNORE INTO {0} ({1}) SELECT DISTINCT {1} FROM pixel_tracks '
+                     'WHERE {1} IS NOT NULL'.format(table, column))
+    columns = VIEW_COLUMNS[1:]
+    values = ['{0}.id'.format(LOOKUPS[column][0]) if column in LOOKUPS else 't.{}'.format(column)
+              for column in columns]
+    joins = ['LEFT JOIN {0} ON {0}.{1} = t.{1}'.format(table, column) for column, (table, _) in LOOKUPS.items()]
+    conn.execute('INSERT INTO pixel_events ({}) SELECT {} FROM pixel_tracks t {} ORDER BY t.timestamp'.format(
+        ', '.join(event_column(column) for column in columns), ', '.join(values), ' '.join(joins)))
+
+class Interner(object):
+    def __init__(self, max_entries=CACHE_SIZE):
+        """
+        Map strings to lookup table ids for a writer, remembering recent ones
+
+        Ids interned inside a transaction are only remembered once it commits,
+        so a rolled-back batch cannot leave ids that do not exist.
+
+        :param max_entries: Ids cached per lookup table
+        """
+        self.caches = dict((column, cache.LRUCache(max_entries)) for column in LOOKUPS)
+        self.pending = []
+
+    def intern(self, conn, column, values):
+        """
+        Ids of values in a lookup table, inserting the new ones
+
+        :param conn: sqlite3 connection with an open transaction
+        :param column: Value column, a key of LOOKUPS
+        :param values: Iterable of strings; None is not interned
+        :return: Dictionary of value to id
+        """
+        table = LOOKUPS[column][0]
+        ids = {}
+        missing = []
+        for value in set(values):
+            if value is None:
+                continue
+            value_id = self.caches[column].get(value)
+            if value_id is None:
+                missing.append(value)
+            else:
+                ids[value] = value_id
+        if missing:
+            conn.executemany('INSERT OR IGNORE INTO {} ({}) VALUES (?)'.format(table, column),
+                             [(value,) for value in missing])
+            for start in range(0, len(missing), MAX_PARAMS):
+                chunk = missing[start:start + MAX_PARAMS]
+                query = 'SELECT {1}, id FROM {0} WHERE {1} IN ({2})'.format(
+                    table, column, ', '.join('?' for _ in chunk))
+                for value, value_id in conn.execute(query, chunk):
+                    ids[value] = value_id
+                    self.pending.append((column, value, value_id))
+        return ids
+
+    def encode(self, conn, rows, columns):
+        """
+        Replace the lookup columns of rows with their ids
+
+        :param conn: sqlite3 connection with an open transaction
+        :param rows: Sequence of row tuples
+        :param columns: Column name of each row position
+        :return: List of rows with the same positions
+        """
+        rows = [list(row) for row in rows]
+        for index, column in enumerate(columns):
+            if column not in LOOKUPS:
+                continue
+            ids = self.intern(conn, column, [row[index] for row in rows])
+            for row in rows:
+                row[index] = ids.get(row[index])
+        return rows
+
+    def commit(self):
+        """
+        Remember the ids interned since the last commit or rollback
+        """
+        for column, value, value_id in self.pending:
+            self.caches[column].set(value, value_id)
+        self.pending = []
+
+    def rollback(self):
+        """
+        Forget the ids interned since the last commit or rollback
+        """
+        self.pending = []
@@ -1,11 +1,17 @@
+import argparse
 import datetime
+import functools
+import hashlib
 import smtplib
 import os
+import re
 import threading
 import uuid
 import json
 import sys
 import signal
+import time
+from collections import OrderedDict, namedtuple
 
 # Debug print
 print("Python Version:", sys.version)
@@ -16,9 +22,16 @@ try:
 except ImportError:
     import Queue as queue
 
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
 from threading import Thread
 import logging
 
+import tracking_tokens
+
 # Attempt to import email MIME modules with fallback
 try:
     from email.mime.multipart import MIMEMultipart
@@ -29,6 +42,7 @@ except ImportError:
     from email.MIMEMultipart import MIMEMultipart
     from email.MIMEText import MIMEText
     from email.MIMEApplication import MIMEApplication
+from email.header import Header
 
 # Debug print
 print("Modules imported successfully!")
@@ -43,6 +57,32 @@ logging.basicConfig(
 # Global flag for interruption
 STOP_THREADS = False
 
+# SMTP host and port per email provider domain
+SMTP_SETTINGS = {
+    'gmail.com': ('smtp.gmail.com', 587),
+    'yahoo.com': ('smtp.mail.yahoo.com', 587),
+    'hotmail.com': ('smtp.live.com', 587),
+    'outlook.com': ('smtp.live.com', 587),
+    'aol.com': ('smtp.aol.com', 587)
+}
+
+# Tracking pixel added to campaign bodies; the URL is filled in per recipient
+TRACKING_DOMAIN = os.environ.get('TRACKING_DOMAIN', 'http://45.141.122.177:8080')
+PIXEL_TAG = '<img src="{{pixel_url}}" width="1" height="1" style="display:none;">'
+
+# Merge tags such as {{first_name}} substituted per recipient
+MERGE_TAG_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+# Loose address check applied while streaming recipient lists
+EMAIL_PATTERN = re.compile(r'^[^@\s,;<>]+@[^@\s,;<>]+\.[^@\s,;<>]+$')
+
+# Emails whose pixel tokens are issued together in one database transaction
+PIXEL_TOKEN_BATCH = 500
+
+# Sending engines selectable from the CLI and the web routes
+SENDER_BACKENDS = ('threaded', 'async')
+DEFAULT_BACKEND = os.environ.get('MAILER_BACKEND', 'threaded')
+
 def signal_handler(signum, frame):
     """
     Handle keyboard interrupt and other signals
@@ -52,55 +92,665 @@ def signal_handler(signum, frame):
     print("\n\nInterrupt received. Stopping email sending...")
     sys.exit(0)
 
+class PooledConnection(object):
+    def __init__(self, smtp):
+        """
+        Authenticated SMTP session tracked by the connection pool
+        
+        :param smtp: Logged in SMTP connection object
+        """
+        self.smtp = smtp
+        self.message_count = 0
+        self.last_used = time.time()
+
+class SMTPConnectionPool(object):
+    def __init__(self, connect, max_size=5, max_messages_per_connection=100, health_check_interval=30):
+        """
+        Pool of authenticated SMTP sessions shared by the worker threads
+        
+        :param connect: Callable returning a new logged in SMTP connection
+        :param max_size: Maximum number of open sessions
+        :param max_messages_per_connection: Messages sent before a session is recycled
+        :param health_check_interval: Idle seconds after which a session is checked with NOOP
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.max_messages_per_connection = max_messages_per_connection
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.idle = []
+        self.opened_count = 0
+
+    def _is_healthy(self, conn):
+        """
+        Check an idle session with NOOP before handing it out again
+        
+        :param conn: PooledConnection to check
+        :return: True if the session can be reused
+        """
+        if time.time() - conn.last_used < self.health_check_interval:
+            return True
+        try:
+            return conn.smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        """
+        Close a session, ignoring errors from an already dropped connection
+        """
+        try:
+            conn.smtp.quit()
+        except Exception:
+            try:
+                conn.smtp.close()
+            except Exception:
+                pass
+
+    def acquire(self):
+        """
+        Check out a session, reusing an idle one when it is still healthy
+        
+        :return: PooledConnection object
+        """
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    break
+                if self._is_healthy(conn):
+                    return conn
+                self._close(conn)
+
+            conn = PooledConnection(self.connect())
+            with self.lock:
+                self.opened_count += 1
+            return conn
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        """
+        Return a session to the pool
+        
+        :param conn: PooledConnection previously returned by acquire
+        :param discard: Close the session instead of keeping it
+        """
+        try:
+            if discard or conn.message_count >= self.max_messages_per_connection:
+                self._close(conn)
+            else:
+                conn.last_used = time.time()
+                with self.lock:
+                    self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """
+        Close all idle sessions
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self._close(conn)
+
+class AttachmentCache(object):
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        Serialized attachment parts shared by every message of a campaign
+        
+        :param max_bytes: Maximum total size of cached parts; least recently
+                          used parts are evicted beyond it
+        """
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.parts = OrderedDict()
+        self.size = 0
+
+    def _encode(self, filepath):
+        """
+        Read and base64 encode an attachment file
+        
+        :param filepath: Path to the file
+        :return: Serialized MIME part text
+        """
+        filename = os.path.basename(filepath)
+        with open(filepath, 'rb') as file:
+            part = MIMEApplication(file.read(), Name=filename)
+        part['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        return part.as_string()
+
+    def get(self, filepath):
+        """
+        Get the serialized MIME part for an attachment, encoding it on first use
+        
+        :param filepath: Path to the file
+        :return: Serialized MIME part text, or None if the file does not exist
+        """
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+
+        # Modified files get a new key so stale parts are never reused
+        key = (filepath, stat.st_mtime, stat.st_size)
+        with self.lock:
+            part = self.parts.pop(key, None)
+            if part is not None:
+                self.parts[key] = part
+                return part
+
+        part = self._encode(filepath)
+        if len(part) > self.max_bytes:
+            return part
+
+        with self.lock:
+            if key not in self.parts:
+                self.parts[key] = part
+                self.size += len(part)
+            while self.size > self.max_bytes:
+                _, evicted = self.parts.popitem(last=False)
+                self.size -= len(evicted)
+        return part
+
+    def clear(self):
+        """
+        Drop all cached parts
+        """
+        with self.lock:
+            self.parts.clear()
+            self.size = 0
+
+def is_ascii(text):
+    """
+    Check whether text can be sent without a MIME charset
+    """
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+def build_pixel_urls(campaign_id, sender, recipients):
+    """
+    Build the tracking pixel URLs for many recipients of a campaign
+    
+    The URLs carry signed delivery tokens, all recorded in one transaction;
+    if the tracking database cannot be written, they fall back to
+    URL-encoded query parameters.
+    
+    :param campaign_id: Unique campaign identifier
+    :param sender: Email address the messages are sent from
+    :param recipients: List of recipient email addresses
+    :return: Dictionary of recipient to pixel URL
+    """
+    try:
+        tokens = tracking_tokens.issue_tokens(campaign_id, sender, recipients)
+    except Exception as e:
+        logging.error('Error issuing pixel tokens: {}'.format(e))
+        tokens = {}
+
+    urls = {}
+    for recipient in recipients:
+        if recipient in tokens:
+            urls[recipient] = '{}/track?t={}'.format(TRACKING_DOMAIN, tokens[recipient])
+        else:
+            urls[recipient] = '{}/track?{}'.format(TRACKING_DOMAIN, urlencode(
+                [('campaign_id', campaign_id), ('sender', sender), ('recipient', recipient)]))
+    return urls
+
+def build_pixel_url(campaign_id, sender, recipient):
+    """
+    Build the tracking pixel URL for one recipient
+    
+    :param campaign_id: Unique campaign identifier
+    :param sender: Email address the message is sent from
+    :param recipient: Email address of recipient
+    :return: Pixel URL
+    """
+    return build_pixel_urls(campaign_id, sender, [recipient])[recipient]
+
+def clean_recipient(recipient):
+    """
+    Strip line breaks so a recipient cannot inject headers
+    """
+    return recipient.replace('\r', '').replace('\n', '')
+
+class MessageTemplate(object):
+    def __init__(self, from_header, subject, body, attachment_parts):
+        """
+        Message pre-rendered once per campaign with merge tags left as slots
+        
+        :param from_header: From header value
+        :param subject: Email subject, may contain merge tags
+        :param body: HTML body, may contain merge tags like {{first_name}}
+        :param attachment_parts: Serialized MIME attachment parts, or callables
+                                 returning one for parts encoded per message
+        """
+        self.boundary = '=' * 15 + uuid.uuid4().hex
+        msg = MIMEMultipart(boundary=self.boundary)
+        msg['From'] = from_header
+        msg['To'] = '{{recipient}}'
+
+        # The subject is encoded per recipient, after substitution, so merge
+        # tags never end up inside an RFC 2047 encoded word
+        self.subject_segments = self._compile(subject)
+
+        # ASCII bodies are sent 7bit so merge tags survive serialization;
+        # other bodies, and ASCII bodies given non-ASCII merge values, are
+        # encoded per recipient after substitution
+        self.encode_body = not is_ascii(body)
+        msg.attach(MIMEText('' if self.encode_body else body, 'html'))
+
+        message = msg.as_string()
+        opening = '--{}\n'.format(self.boundary)
+        closing = '--{}--'.format(self.boundary)
+        body_start = message.index(opening) + len(opening)
+        self.head_segments = self._compile(message[:body_start])
+        self.text_segments = self._compile(body)
+        # Merge tags the subject and body use, e.g. to skip issuing unused pixel tokens
+        self.merge_tags = frozenset(self.subject_segments[1::2] + self.text_segments[1::2])
+        if not self.encode_body:
+            self.body_segments = self._compile(message[body_start:message.rindex(closing)])
+
+        tail = []
+        for part in attachment_parts:
+            tail.append('--{}\n'.format(self.boundary))
+            tail.append(part)
+            tail.append('\n')
+        tail.append(closing + '\n')
+        self.tail = tail
+
+    def _compile(self, text):
+        """
+        Split text into literal chunks and merge tag names
+        
+        :param text: Text containing merge tags
+        :return: List where odd positions hold merge tag names
+        """
+        return MERGE_TAG_PATTERN.split(text)
+
+    def _fill(self, segments, fields, chunks):
+        """
+        Append segments to chunks, substituting known merge tags
+        
+        :return: False if a substituted value is not ASCII
+        """
+        ascii_only = True
+        for i, segment in enumerate(segments):
+            if i % 2:
+                value = fields.get(segment)
+                if value is None:
+                    value = '{{' + segment + '}}'
+                elif ascii_only and not is_ascii(value):
+                    ascii_only = False
+                chunks.append(value)
+            else:
+                chunks.append(segment)
+        return ascii_only
+
+    def render_subject(self, fields):
+        """
+        Render the Subject header for one recipient
+        
+        :param fields: Merge tag values
+        :return: Header line, RFC 2047 encoded if the subject is not ASCII
+        """
+        chunks = []
+        self._fill(self.subject_segments, fields, chunks)
+        subject = ''.join(chunks).replace('\r', '').replace('\n', ' ')
+        header = Header(subject, 'us-ascii' if is_ascii(subject) else 'utf-8', header_name='Subject')
+        return 'Subject: {}\n'.format(header.encode())
+
+    def render(self, fields):
+        """
+        Render the message for one recipient
+        
+        :param fields: Merge tag values, including 'recipient'
+        :return: Message text
+        """
+        chunks = [self.render_subject(fields)]
+        self._fill(self.head_segments, fields, chunks)
+        body = []
+        if self.encode_body or not self._fill(self.body_segments, fields, body):
+            body = []
+            self._fill(self.text_segments, fields, body)
+            chunks.append(MIMEText(''.join(body), 'html', 'utf-8').as_string())
+            chunks.append('\n')
+        else:
+            chunks.extend(body)
+        for chunk in self.tail:
+            chunks.append(chunk() if callable(chunk) else chunk)
+        return ''.join(chunks)
+
+# Outcome of one submitted email, reported in submission order
+SendResult = namedtuple('SendResult', ['recipient', 'success', 'error'])
+
+class SendSummary(object):
+    def __init__(self, sent, failed, results):
+        """
+        Final counts of a campaign
+        
+        :param sent: Number of emails sent
+        :param failed: Number of emails that failed or were interrupted
+        :param results: List of SendResult in submission order, empty if results were not kept
+        """
+        self.sent = sent
+        self.failed = failed
+        self.results = results
+
+    @property
+    def total(self):
+        return self.sent + self.failed
+
+class SendFuture(object):
+    def __init__(self):
+        """
+        Completion handle for a campaign sending in the background
+        """
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.summary = None
+        self.error = None
+
+    def _complete(self, summary=None, error=None):
+        """
+        Store the outcome and run the registered callbacks
+        """
+        with self.lock:
+            self.summary = summary
+            self.error = error
+            self.finished.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            logging.error('Campaign completion callback error: {}'.format(e))
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) when the campaign finishes, immediately if it already has
+        """
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the campaign to finish
+        
+        :param timeout: Seconds to wait, or None to wait indefinitely
+        :return: SendSummary object
+        """
+        if not self.finished.wait(timeout):
+            raise RuntimeError('Campaign is still sending')
+        if self.error is not None:
+            raise self.error
+        return self.summary
+
 class EmailSender(object):
-    def __init__(self, username, password, max_workers=5):
+    def __init__(self, username, password, max_workers=5, smtp_host=None, smtp_port=587,
+                 use_tls=True, max_messages_per_connection=100, attachment_cache_bytes=64 * 1024 * 1024,
+                 queue_size=None):
         """
         Initialize email sender with SMTP credentials
         
         :param username: Email address to send from
         :param password: Email account password
         :param max_workers: Maximum number of concurrent email threads
+        :param smtp_host: SMTP server, looked up from the email provider if not given
+        :param smtp_port: SMTP port used together with smtp_host
+        :param use_tls: Upgrade the connection with STARTTLS
+        :param max_messages_per_connection: Messages sent over one SMTP session before reconnecting
+        :param attachment_cache_bytes: Memory cap for encoded attachments reused across a campaign
+        :param queue_size: Maximum number of emails waiting for a worker, defaults to 4 per worker
         """
         self.username = username.strip()
         self.password = password.strip()
         self.max_workers = max_workers
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.use_tls = use_tls
         self.sent_count = 0
         self.failed_count = 0
+        self.max_messages_per_connection = max_messages_per_connection
         self.lock = threading.Lock()
-        self.queue = queue.Queue()
-        self.results = []
+        self.results = None
+        self.attachment_cache = AttachmentCache(max_bytes=attachment_cache_bytes)
+        self.templates = {}
+        self._setup_connections(queue_size)
 
-    def _get_smtp_connection(self):
+    def _setup_connections(self, queue_size):
+        """
+        Create the worker queue and the SMTP connection pool shared by the worker threads
+        
+        :param queue_size: Maximum number of emails waiting for a worker, defaults to 4 per worker
+        """
+        self.queue = queue.Queue(maxsize=queue_size or self.max_workers * 4)
+        self.pool = SMTPConnectionPool(
+            self._get_smtp_connection,
+            max_size=self.max_workers,
+            max_messages_per_connection=self.max_messages_per_connection
+        )
+
+    def _close_connections(self):
+        """
+        Log out of the pooled SMTP sessions
+        """
+        self.pool.close()
+
+    @property
+    def connections_opened(self):
+        """
+        Number of SMTP connections opened so far
+        """
+        return self.pool.opened_count
+
+    def _get_smtp_settings(self):
         """
         Determine SMTP settings based on email provider
         
-        :return: SMTP connection object
+        :return: Tuple of (host, port)
         """
+        if self.smtp_host:
+            return self.smtp_host, self.smtp_port
+
         smtp_provider = self.username.split("@")[1].lower()
-        smtp_settings = {
-            'gmail.com': ('smtp.gmail.com', 587),
-            'yahoo.com': ('smtp.mail.yahoo.com', 587),
-            'hotmail.com': ('smtp.live.com', 587),
-            'outlook.com': ('smtp.live.com', 587),
-            'aol.com': ('smtp.aol.com', 587)
-        }
 
         # Find matching SMTP settings
-        for domain, (host, port) in smtp_settings.items():
+        for domain, (host, port) in SMTP_SETTINGS.items():
             if domain in smtp_provider:
-                try:
-                    smtp = smtplib.SMTP(host, port)
-                    smtp.starttls()
-                    smtp.login(self.username, self.password)
-                    return smtp
-                except Exception as e:
-                    logging.error('SMTP connection error: {}'.format(e))
-                    raise
+                return host, port
 
         # Raise error if no matching SMTP settings found
         raise ValueError('SMTP settings not found for {}'.format(self.username))
 
-    def send_single_email(self, recipient, subject, body, campaign_id, attachments=None):
+    def _get_smtp_connection(self):
+        """
+        Open and authenticate a new SMTP connection
+        
+        :return: SMTP connection object
+        """
+        host, port = self._get_smtp_settings()
+        try:
+            smtp = smtplib.SMTP(host, port)
+            if self.use_tls:
+                smtp.starttls()
+            smtp.login(self.username, self.password)
+            return smtp
+        except Exception as e:
+            logging.error('SMTP connection error: {}'.format(e))
+            raise
+
+    def _send_message(self, recipient, message):
+        """
+        Send a serialized message over a pooled SMTP session, reconnecting
+        once if the server dropped the session
+        
+        :param recipient: Email address of recipient
+        :param message: Message text
+        """
+        for attempt in range(2):
+            conn = self.pool.acquire()
+            try:
+                conn.smtp.sendmail(self.username, recipient, message)
+            except smtplib.SMTPServerDisconnected:
+                self.pool.release(conn, discard=True)
+                if attempt:
+                    raise
+                continue
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+                # Server rejected this message but the session is still usable
+                self.pool.release(conn)
+                raise
+            except Exception:
+                self.pool.release(conn, discard=True)
+                raise
+            conn.message_count += 1
+            self.pool.release(conn)
+            return
+
+    def _get_attachment(self, filepath):
+        """
+        Get the serialized MIME part for an attachment kept out of the template
+        
+        :param filepath: Path to the file
+        :return: Serialized MIME part text
+        """
+        part = self.attachment_cache.get(filepath)
+        if part is None:
+            raise IOError('Attachment file not found - {}'.format(filepath))
+        return part
+
+    def get_template(self, subject, body, attachments=None):
+        """
+        Get the compiled message template for a campaign, compiling it on first use
+        
+        :param subject: Email subject
+        :param body: Email body text
+        :param attachments: List of file paths to attach
+        :return: MessageTemplate object
+        """
+        key = (subject, body, tuple(attachments or ()))
+        with self.lock:
+            template = self.templates.get(key)
+        if template is not None:
+            return template
+
+        # Templates hold parts up to the attachment cache cap; the rest are
+        # encoded per message so a campaign never keeps more than the cap
+        parts = []
+        budget = self.attachment_cache.max_bytes
+        for filepath in attachments or ():
+            part = self.attachment_cache.get(filepath)
+            if part is None:
+                logging.warning('Attachment file not found - {}'.format(filepath))
+                continue
+            if len(part) > budget:
+                parts.append(functools.partial(self._get_attachment, filepath))
+            else:
+                budget -= len(part)
+                parts.append(part)
+
+        from_header = '"{}" <{}>'.format(self.username.split('@')[0].capitalize(), self.username)
+        template = MessageTemplate(from_header, subject, body, parts)
+        with self.lock:
+            return self.templates.setdefault(key, template)
+
+    def build_message(self, recipient, subject, body, attachments=None, campaign_id=None, merge_fields=None):
+        """
+        Build the MIME message for one recipient
+        
+        :param recipient: Email address of recipient
+        :param subject: Email subject
+        :param body: Email body text, may contain merge tags like {{first_name}}
+        :param attachments: List of file paths to attach
+        :param campaign_id: Unique campaign identifier used for the {{pixel_url}} tag
+        :param merge_fields: Dictionary of extra merge tag values for this recipient
+        :return: Message text
+        """
+        template = self.get_template(subject, body, attachments)
+        fields = dict(merge_fields or {})
+        fields['recipient'] = clean_recipient(recipient)
+        if campaign_id is not None and 'pixel_url' not in fields and 'pixel_url' in template.merge_tags:
+            fields['pixel_url'] = build_pixel_url(campaign_id, self.username, fields['recipient'])
+        return template.render(fields)
+
+    def _needs_pixel_url(self, email_details):
+        """
+        Whether an email's template has a {{pixel_url}} tag that still needs a URL
+        """
+        if len(email_details) < 5 or email_details[3] is None:
+            return False
+        if len(email_details) > 5 and email_details[5] and 'pixel_url' in email_details[5]:
+            return False
+        _, subject, body, _, attachments = email_details[:5]
+        return 'pixel_url' in self.get_template(subject, body, attachments).merge_tags
+
+    def _add_pixel_urls(self, batch):
+        """
+        Issue the pixel tokens of a batch of emails at once and pass each URL
+        on as the {{pixel_url}} merge field, so build_message does not write
+        to the tracking database once per message
+        
+        Only emails whose template has a {{pixel_url}} tag get a token, and a
+        recipient listed twice in a campaign is issued one.
+        
+        :param batch: List of (index, email_details) pairs
+        :return: List of (index, email_details) pairs
+        """
+        tracked = [self._needs_pixel_url(email_details) for _, email_details in batch]
+        recipients = OrderedDict()
+        for (_, email_details), needs_url in zip(batch, tracked):
+            if needs_url:
+                recipients.setdefault(email_details[3], OrderedDict())[clean_recipient(email_details[0])] = None
+        if not recipients:
+            return batch
+        urls = dict((campaign_id, build_pixel_urls(campaign_id, self.username, list(group)))
+                    for campaign_id, group in recipients.items())
+
+        prepared = []
+        for (index, email_details), needs_url in zip(batch, tracked):
+            if needs_url:
+                merge_fields = dict(email_details[5] or {}) if len(email_details) > 5 else {}
+                merge_fields['pixel_url'] = urls[email_details[3]][clean_recipient(email_details[0])]
+                email_details = tuple(email_details[:5]) + (merge_fields,)
+            prepared.append((index, email_details))
+        return prepared
+
+    def _iter_batches(self, email_list, batch_size=PIXEL_TOKEN_BATCH):
+        """
+        Number emails and group them into batches whose pixel tokens are issued together
+        
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments[, merge_fields])
+        :param batch_size: Emails per batch
+        :return: Generator of lists of (index, email_details) pairs
+        """
+        batch = []
+        for item in enumerate(email_list):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield self._add_pixel_urls(batch)
+                batch = []
+        if batch:
+            yield self._add_pixel_urls(batch)
+
+    def send_single_email(self, recipient, subject, body, campaign_id, attachments=None, merge_fields=None):
         """
         Send a single email
         
@@ -109,56 +759,27 @@ class EmailSender(object):
         :param body: Email body text
         :param campaign_id: Unique campaign identifier
         :param attachments: List of file paths to attach
+        :param merge_fields: Dictionary of merge tag values for this recipient
         :return: Tuple of (success, error_message)
         """
         global STOP_THREADS
         if STOP_THREADS:
+            with self.lock:
+                self.failed_count += 1
             return False, "Sending interrupted"
 
         try:
-            # Create message
-            msg = MIMEMultipart()
-            msg['From'] = '"{}" <{}>'.format(self.username.split('@')[0].capitalize(), self.username)
-            msg['To'] = recipient
-            msg['Subject'] = subject
-
-            # Attach body
-            msg.attach(MIMEText(body, 'html'))
-
-            # Attach files
-            if attachments:
-                for filepath in attachments:
-                    if os.path.exists(filepath):
-                        with open(filepath, 'rb') as file:
-                            part = MIMEApplication(file.read(), Name=os.path.basename(filepath))
-                            part['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(filepath))
-                            msg.attach(part)
-                    else:
-                        logging.warning('Attachment file not found - {}'.format(filepath))
-
-            # Send email
-            smtp = None
-            try:
-                # Get SMTP connection
-                smtp = self._get_smtp_connection()
-                
-                # Send email
-                smtp.sendmail(self.username, recipient, msg.as_string())
-                
-                # Thread-safe increment of sent count
-                with self.lock:
-                    self.sent_count += 1
-                    logging.info('Email sent successfully to {}'.format(recipient))
-                
-                return True, None
-            
-            finally:
-                # Always close the SMTP connection
-                if smtp:
-                    try:
-                        smtp.quit()
-                    except Exception:
-                        pass
+            message = self.build_message(recipient, subject, body, attachments, campaign_id, merge_fields)
+
+            # Send email over a pooled SMTP session
+            self._send_message(recipient, message)
+
+            # Thread-safe increment of sent count
+            with self.lock:
+                self.sent_count += 1
+                logging.info('Email sent successfully to {}'.format(recipient))
+
+            return True, None
 
         except Exception as e:
             # Thread-safe increment of failed count
@@ -168,37 +789,74 @@ class EmailSender(object):
             
             return False, str(e)
 
+    def _start_campaign(self, keep_results):
+        """
+        Reset counters and results before sending a campaign
+        """
+        self.sent_count = 0
+        self.failed_count = 0
+        self.results = {} if keep_results else None
+
+    def _record(self, index, recipient, result):
+        """
+        Store the outcome of the email submitted at position index
+        """
+        if self.results is not None:
+            with self.lock:
+                self.results[index] = SendResult(recipient, result[0], result[1])
+
+    def _finish_campaign(self):
+        """
+        Release campaign resources and summarize the outcome
+        
+        :return: SendSummary object
+        """
+        # Log out of the SMTP sessions and release the campaign's templates
+        self._close_connections()
+        self.attachment_cache.clear()
+        self.templates = {}
+
+        results = []
+        if self.results is not None:
+            results = [self.results[index] for index in range(len(self.results))]
+
+        # Log summary
+        logging.info('Email sending completed. Sent: {}, Failed: {}'.format(
+            self.sent_count, self.failed_count))
+        return SendSummary(self.sent_count, self.failed_count, results)
+
     def worker(self):
         """
-        Worker thread to process email queue
+        Worker thread to process email queue until it receives a stop signal
         """
-        global STOP_THREADS
-        while not STOP_THREADS:
+        while True:
+            item = self.queue.get()
             try:
-                email_details = self.queue.get(timeout=1)
-                if email_details is None:
+                if item is None:
                     break
-                result = self.send_single_email(*email_details)
-                self.results.append(result)
+                index, email_details = item
+                try:
+                    result = self.send_single_email(*email_details)
+                except Exception as e:
+                    with self.lock:
+                        self.failed_count += 1
+                    result = (False, str(e))
+                self._record(index, email_details[0], result)
+            finally:
                 self.queue.task_done()
-            except queue.Empty:
-                continue
-            except Exception:
-                break
 
-    def send_emails_threaded(self, email_list):
+    def send_emails_threaded(self, email_list, keep_results=True):
         """
         Send multiple emails using thread pool
         
-        :param email_list: List of tuples (recipient, subject, body, campaign_id, attachments)
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments[, merge_fields]);
+                           generators are consumed lazily
+        :param keep_results: Collect a SendResult per email in submission order
+        :return: SendSummary object
         """
         global STOP_THREADS
         STOP_THREADS = False
-
-        # Reset counters and results
-        self.sent_count = 0
-        self.failed_count = 0
-        self.results = []
+        self._start_campaign(keep_results)
 
         # Create worker threads
         threads = []
@@ -208,49 +866,175 @@ class EmailSender(object):
             t.start()
             threads.append(t)
 
-        # Add emails to queue
-        for email_details in email_list:
-            if STOP_THREADS:
-                break
-            self.queue.put(email_details)
-
-        # Add stop signals
-        for _ in range(self.max_workers):
-            self.queue.put(None)
+        try:
+            # Add emails to queue, blocking while the workers catch up
+            for batch in self._iter_batches(email_list):
+                for email_details in batch:
+                    while not STOP_THREADS:
+                        try:
+                            self.queue.put(email_details, timeout=1)
+                            break
+                        except queue.Full:
+                            continue
+                    if STOP_THREADS:
+                        break
+                if STOP_THREADS:
+                    break
+        except KeyboardInterrupt:
+            STOP_THREADS = True
+        finally:
+            # Add stop signals; queued emails are still drained and recorded
+            for _ in range(self.max_workers):
+                self.queue.put(None)
 
-        # Wait for all tasks to complete or interruption
-        while not STOP_THREADS and not self.queue.empty():
+        # Wait for workers, staying responsive to interruption
+        while any(t.is_alive() for t in threads):
             try:
-                self.queue.join()
-                break
+                for t in threads:
+                    t.join(timeout=1)
             except KeyboardInterrupt:
                 STOP_THREADS = True
-                break
 
-        # Stop worker threads
-        for t in threads:
-            t.join(timeout=2)
+        return self._finish_campaign()
 
-        # Log summary
-        logging.info('Email sending completed. Sent: {}, Failed: {}'.format(
-            self.sent_count, self.failed_count))
-        return self.results
+    def send_emails(self, email_list, keep_results=True):
+        """
+        Send multiple emails with this sender's backend
+        
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments[, merge_fields])
+        :param keep_results: Collect a SendResult per email in submission order
+        :return: SendSummary object
+        """
+        return self.send_emails_threaded(email_list, keep_results)
 
-def read_file_lines(filepath):
+    def submit_emails(self, email_list, callback=None, keep_results=True):
+        """
+        Start sending a campaign in the background
+        
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments[, merge_fields])
+        :param callback: Optional callable receiving the SendFuture once the campaign finishes
+        :param keep_results: Collect a SendResult per email in submission order
+        :return: SendFuture object
+        """
+        future = SendFuture()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        def run():
+            try:
+                summary = self.send_emails(email_list, keep_results)
+            except Exception as e:
+                future._complete(error=e)
+            else:
+                future._complete(summary=summary)
+
+        t = Thread(target=run)
+        t.daemon = True
+        t.start()
+        return future
+
+def create_sender(username, password, backend=None, **kwargs):
     """
-    Read lines from a file, stripping whitespace and removing empty lines
+    Create an email sender for the given backend
+    
+    :param username: Email address to send from
+    :param password: Email account password
+    :param backend: 'threaded' for worker threads or 'async' for the asyncio engine
+    :return: EmailSender or AsyncEmailSender instance
+    """
+    backend = backend or DEFAULT_BACKEND
+    if backend == 'threaded':
+        return EmailSender(username, password, **kwargs)
+    if backend == 'async':
+        try:
+            from async_mailer import AsyncEmailSender
+        except (ImportError, SyntaxError) as e:
+            raise ValueError('Async backend is not available: {}'.format(e))
+        return AsyncEmailSender(username, password, **kwargs)
+    raise ValueError('Unknown sender backend: {}'.format(backend))
+
+def iter_file_lines(filepath):
+    """
+    Stream lines from a file, stripping whitespace and skipping empty lines
     
     :param filepath: Path to the file
-    :return: List of non-empty, stripped lines
+    :return: Generator of non-empty, stripped lines
     """
     try:
         with open(filepath, 'r') as file:
-            return [line.strip() for line in file if line.strip()]
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield line
     except Exception as e:
         logging.error('Error reading file {}: {}'.format(filepath, e))
-        return []
+
+def read_file_lines(filepath):
+    """
+    Read lines from a file, stripping whitespace and removing empty lines
+    
+    :param filepath: Path to the file
+    :return: List of non-empty, stripped lines
+    """
+    return list(iter_file_lines(filepath))
+
+def parse_recipient(line):
+    """
+    Split a recipients file line into the address and its merge fields
+    
+    :param line: Either "email" or "email,first_name"
+    :return: Tuple of (email, merge_fields)
+    """
+    email_address, _, first_name = line.partition(',')
+    merge_fields = {'first_name': first_name.strip()} if first_name.strip() else {}
+    return email_address.strip(), merge_fields
+
+def iter_recipients(lines):
+    """
+    Parse, validate and deduplicate recipient lines as they are read
+    
+    Duplicates are detected with an 8 byte digest per address, so a list of
+    millions of addresses never holds the addresses themselves in memory.
+    
+    :param lines: Iterable of "email" or "email,first_name" lines
+    :return: Generator of (email, merge_fields) tuples
+    """
+    seen = set()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        recipient, merge_fields = parse_recipient(line)
+        if not EMAIL_PATTERN.match(recipient):
+            logging.warning('Skipping invalid recipient: {}'.format(recipient))
+            continue
+        digest = hashlib.md5(recipient.lower().encode('utf-8')).digest()[:8]
+        if digest in seen:
+            continue
+        seen.add(digest)
+        yield recipient, merge_fields
+
+def iter_email_list(recipients, subject, body, campaign_id, attachments=None):
+    """
+    Pair each streamed recipient with the campaign's shared subject and body
+    
+    :param recipients: Iterable of (email, merge_fields) tuples
+    :return: Generator of (recipient, subject, body, campaign_id, attachments, merge_fields) tuples
+    """
+    for recipient, merge_fields in recipients:
+        yield recipient, subject, body, campaign_id, attachments, merge_fields
+
+def parse_args():
+    """
+    Parse command line options
+    """
+    parser = argparse.ArgumentParser(description='Send an email campaign')
+    parser.add_argument('--backend', choices=SENDER_BACKENDS, default=DEFAULT_BACKEND,
+                        help='sending engine: worker threads or asyncio')
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     try:
         # Set up signal handling only in main thread
         signal.signal(signal.SIGINT, signal_handler)  # Ctrl+C
@@ -273,10 +1057,8 @@ def main():
             print("No valid accounts found. Exiting.")
             return
         
-        # Read recipients
-        recipients = read_file_lines(recipients_file)
-        
-        if not recipients:
+        # Recipients are streamed from the file, optionally followed by a first name for {{first_name}}
+        if next(iter_recipients(iter_file_lines(recipients_file)), None) is None:
             print("No recipients found. Exiting.")
             return
         
@@ -305,14 +1087,8 @@ def main():
                 break
             attachments.append(attachment)
         
-        # Prepare tracking pixel
-        tracking_pixel = '<img src="http://45.141.122.177:8080/track?campaign_id={}" width="1" height="1" style="display:none;">'.format(campaign_id)
-        
-        # Add tracking pixel to body
-        full_body = body + '\n\n' + tracking_pixel
-        
-        # Prepare email list
-        email_list = [(recipient, subject, full_body, campaign_id, attachments or None) for recipient in recipients]
+        # Add tracking pixel to body; its URL is filled in per recipient
+        full_body = body + '\n\n' + PIXEL_TAG
         
         # Select accounts to use
         print("\nAvailable Accounts:")
@@ -331,8 +1107,9 @@ def main():
         # Send emails from selected accounts
         for username, password in selected_accounts:
             print("\nSending emails from {}".format(username))
-            sender = EmailSender(username, password)
-            sender.send_emails_threaded(email_list)
+            sender = create_sender(username, password, backend=args.backend)
+            recipients = iter_recipients(iter_file_lines(recipients_file))
+            sender.send_emails(iter_email_list(recipients, subject, full_body, campaign_id, attachments or None))
 
     except KeyboardInterrupt:
         print("\nEmail sending interrupted by user.")
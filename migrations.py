@@ -0,0 +1,322 @@
+"""
+Versioned schema migrations for tracking.db and mailer.db
+
+Each database records the last applied migration in PRAGMA user_version.
+Migrations are (version, description, steps) tuples where a step is either
+a SQL statement or a callable taking the connection; every migration runs
+in its own transaction.
+
+Run with:
+    python migrations.py [--check]
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import time
+
+import hll
+import lookups
+import rollups
+import storage
+import timeseries
+
+# Seconds a process waits for a migration running in another process, such
+# as a rollup backfill on a large database, before giving up
+LOCK_TIMEOUT = float(os.environ.get('MIGRATION_LOCK_TIMEOUT', 1800))
+
+def add_missing_columns(table, columns):
+    """
+    Build a step adding columns that older databases were created without
+
+    :param table: Table name
+    :param columns: List of (name, type) tuples
+    :return: Migration step callable
+    """
+    def step(conn):
+        existing = set(row[1] for row in conn.execute('PRAGMA table_info({})'.format(table)))
+        for name, column_type in columns:
+            if name not in existing:
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, column_type))
+    return step
+
+TRACKING_MIGRATIONS = [
+    (1, 'Create pixel_tracks', [
+        '''CREATE TABLE IF NOT EXISTS pixel_tracks (
+            id VARCHAR NOT NULL PRIMARY KEY,
+            campaign_id VARCHAR,
+            sender_email VARCHAR,
+            recipient VARCHAR,
+            timestamp DATETIME,
+            user_agent VARCHAR,
+            ip_address VARCHAR,
+            device_info VARCHAR,
+            location VARCHAR
+        )''',
+    ]),
+    (2, 'Add columns missing from older tracking databases', [
+        add_missing_columns('pixel_tracks', [
+            ('sender_email', 'TEXT'),
+            ('recipient', 'TEXT'),
+            ('timestamp', 'DATETIME'),
+            ('user_agent', 'TEXT'),
+            ('ip_address', 'TEXT'),
+            ('device_info', 'TEXT'),
+            ('location', 'TEXT'),
+        ]),
+    ]),
+    (3, 'Index pixel_tracks for dashboard queries', [
+        'CREATE INDEX IF NOT EXISTS ix_pixel_tracks_campaign_timestamp ON pixel_tracks (campaign_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS ix_pixel_tracks_campaign_recipient ON pixel_tracks (campaign_id, recipient)',
+        'CREATE INDEX IF NOT EXISTS ix_pixel_tracks_timestamp ON pixel_tracks (timestamp)',
+    ]),
+    (4, 'Create campaign rollups and backfill them from pixel_tracks', [
+        '''CREATE TABLE IF NOT EXISTS campaign_rollups (
+            campaign_id VARCHAR NOT NULL,
+            sender_email VARCHAR NOT NULL,
+            unique_recipients INTEGER NOT NULL DEFAULT 0,
+            total_opens INTEGER NOT NULL DEFAULT 0,
+            first_open DATETIME,
+            last_open DATETIME,
+            PRIMARY KEY (campaign_id, sender_email)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS campaign_recipients (
+            campaign_id VARCHAR NOT NULL,
+            sender_email VARCHAR NOT NULL,
+            recipient VARCHAR NOT NULL,
+            PRIMARY KEY (campaign_id, sender_email, recipient)
+        ) WITHOUT ROWID''',
+        rollups.rebuild_tables,
+    ]),
+    (5, 'Create unique-open sketches and backfill them from pixel_tracks', [
+        '''CREATE TABLE IF NOT EXISTS campaign_sketches (
+            campaign_id VARCHAR NOT NULL,
+            sender_email VARCHAR NOT NULL,
+            day VARCHAR NOT NULL,
+            sketch BLOB NOT NULL,
+            PRIMARY KEY (campaign_id, sender_email, day)
+        )''',
+        hll.rebuild_sketches,
+    ]),
+    (6, 'Create open-count time buckets and backfill them from pixel_tracks', [
+        '''CREATE TABLE IF NOT EXISTS open_buckets (
+            campaign_id VARCHAR NOT NULL,
+            bucket VARCHAR NOT NULL,
+            opens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (campaign_id, bucket)
+        ) WITHOUT ROWID''',
+        timeseries.rebuild_buckets,
+    ]),
+    (7, 'Create the tracking write counter used to version cached aggregates', [
+        '''CREATE TABLE IF NOT EXISTS tracking_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )''',
+        'INSERT OR IGNORE INTO tracking_version (id, version) VALUES (1, 0)',
+    ]),
+    (8, 'Extend the campaign timestamp index with id for keyset pagination', [
+        'CREATE INDEX IF NOT EXISTS ix_pixel_tracks_campaign_timestamp_id ON pixel_tracks (campaign_id, timestamp, id)',
+        'DROP INDEX IF EXISTS ix_pixel_tracks_campaign_timestamp',
+    ]),
+    (9, 'Create deliveries for signed pixel tokens and reference them from pixel_tracks', [
+        '''CREATE TABLE IF NOT EXISTS deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id VARCHAR NOT NULL,
+            sender_email VARCHAR NOT NULL,
+            recipient VARCHAR NOT NULL,
+            created_at DATETIME,
+            UNIQUE (campaign_id, sender_email, recipient)
+        )''',
+        add_missing_columns('pixel_tracks', [
+            ('delivery_id', 'INTEGER REFERENCES deliveries (id)'),
+        ]),
+    ]),
+    (10, 'Move pixel_tracks into pixel_events with interned strings behind a compatibility view',
+        lookups.create_lookup_sql() + [
+        lookups.CREATE_EVENTS_SQL,
+        lookups.copy_legacy_tracks,
+        'DROP TABLE pixel_tracks',
+        lookups.create_view_sql(),
+        lookups.create_trigger_sql(),
+        'CREATE INDEX IF NOT EXISTS ix_pixel_events_campaign_timestamp ON pixel_events (campaign_ref, timestamp)',
+        'CREATE INDEX IF NOT EXISTS ix_pixel_events_timestamp ON pixel_events (timestamp)',
+    ]),
+    (11, "Index pixel_events by recipient for the tracking writer's repeat-hit check", [
+        'CREATE INDEX IF NOT EXISTS ix_pixel_events_recipient_campaign '
+        'ON pixel_events (recipient_ref, campaign_ref, timestamp)',
+    ]),
+]
+
+MAILER_MIGRATIONS = [
+    (1, 'Create users, email_logs and tracker_logs', [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            is_admin BOOLEAN DEFAULT FALSE
+        )''',
+        '''CREATE TABLE IF NOT EXISTS email_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            campaign_id TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS tracker_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email_id INTEGER,
+            event_type TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ip_address TEXT,
+            FOREIGN KEY (email_id) REFERENCES email_logs(id)
+        )''',
+    ]),
+    (2, 'Index email_logs and tracker_logs for user statistics', [
+        'CREATE INDEX IF NOT EXISTS ix_email_logs_user_id ON email_logs (user_id)',
+        'CREATE INDEX IF NOT EXISTS ix_tracker_logs_email_event ON tracker_logs (email_id, event_type)',
+    ]),
+]
+
+# Dashboard and tracking writer queries and the index each one must use
+TRACKING_QUERY_PLANS = [
+    ('SELECT MIN(timestamp), MAX(timestamp) FROM pixel_tracks WHERE campaign_id = ?',
+     'ix_pixel_events_campaign_timestamp'),
+    ('SELECT id, timestamp FROM pixel_tracks WHERE campaign_id = ? AND timestamp <= ? AND (timestamp < ? OR id < ?) '
+     'ORDER BY timestamp DESC, id DESC LIMIT 100',
+     'ix_pixel_events_campaign_timestamp'),
+    ('SELECT id FROM pixel_tracks WHERE campaign_id = ? AND timestamp IS NULL AND id < ? ORDER BY id DESC LIMIT 100',
+     'ix_pixel_events_campaign_timestamp'),
+    ('SELECT COUNT(DISTINCT recipient) FROM pixel_tracks WHERE campaign_id = ?',
+     'ix_pixel_events_campaign_timestamp'),
+    ('SELECT campaign_id, recipient, timestamp FROM pixel_tracks ORDER BY timestamp DESC LIMIT 100',
+     'ix_pixel_events_timestamp'),
+    ('SELECT COUNT(*) FROM pixel_tracks WHERE campaign_id = ? AND recipient = ?',
+     'ix_pixel_events_recipient_campaign'),
+    ('SELECT 1 FROM pixel_events WHERE campaign_ref = ? AND recipient_ref = ? AND sender_ref IS ? '
+     'AND timestamp > ? AND timestamp < ?',
+     'ix_pixel_events_recipient_campaign'),
+]
+
+MAILER_QUERY_PLANS = [
+    ('SELECT COUNT(*) FROM email_logs WHERE user_id = ?',
+     'ix_email_logs_user_id'),
+    ("SELECT COUNT(DISTINCT t.id) FROM tracker_logs t JOIN email_logs e ON t.email_id = e.id "
+     "WHERE e.user_id = ? AND t.event_type = 'open'",
+     'ix_tracker_logs_email_event'),
+]
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def begin_immediate(conn, timeout=LOCK_TIMEOUT):
+    """
+    Start a write transaction, waiting past the connection's busy timeout
+    while another process holds the write lock
+
+    :param conn: sqlite3 connection in autocommit mode
+    :param timeout: Seconds to keep retrying before raising
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or time.time() >= deadline:
+                raise
+            logging.info('Waiting for another process to finish migrating')
+
+def migrate(conn, migrations):
+    """
+    Apply pending migrations in order
+
+    :param conn: sqlite3 connection
+    :param migrations: List of (version, description, steps) tuples
+    :return: Schema version after migrating
+    """
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, description, steps in migrations:
+            if version <= get_version(conn):
+                continue
+
+            # IMMEDIATE takes the write lock, so concurrent workers apply each
+            # migration once; the version is read again once the lock is held
+            begin_immediate(conn)
+            try:
+                if version <= get_version(conn):
+                    conn.execute('ROLLBACK')
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute('PRAGMA user_version = {}'.format(int(version)))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            logging.info('Applied migration {}: {}'.format(version, description))
+        return get_version(conn)
+    finally:
+        conn.isolation_level = isolation_level
+
+def migrate_tracking_db(db_path=storage.TRACKING_DB_PATH):
+    """
+    Bring a tracking database up to the current schema
+    """
+    conn = storage.connect(db_path)
+    try:
+        return migrate(conn, TRACKING_MIGRATIONS)
+    finally:
+        conn.close()
+
+def migrate_mailer_db(db_path=storage.MAILER_DB_PATH):
+    """
+    Bring a mailer database up to the current schema
+    """
+    conn = storage.connect(db_path)
+    try:
+        return migrate(conn, MAILER_MIGRATIONS)
+    finally:
+        conn.close()
+
+def check_query_plans(conn, query_plans):
+    """
+    Check that each query's plan uses its expected index
+
+    :param conn: sqlite3 connection to a migrated database
+    :param query_plans: List of (query, index name) tuples
+    :raises RuntimeError: If a plan does not use its index
+    """
+    for query, index in query_plans:
+        params = (None,) * query.count('?')
+        plan = ' '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params))
+        if index not in plan:
+            raise RuntimeError('Expected {} in plan for {!r}, got {!r}'.format(index, query, plan))
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply database migrations')
+    parser.add_argument('--check', action='store_true',
+                        help='verify that dashboard queries use the expected indexes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    for db_path, migrations, query_plans in (
+            (storage.TRACKING_DB_PATH, TRACKING_MIGRATIONS, TRACKING_QUERY_PLANS),
+            (storage.MAILER_DB_PATH, MAILER_MIGRATIONS, MAILER_QUERY_PLANS)):
+        conn = storage.connect(db_path)
+        try:
+            print('{}: schema version {}'.format(db_path, migrate(conn, migrations)))
+            if args.check:
+                check_query_plans(conn, query_plans)
+                print('{}: query plans use the expected indexes'.format(db_path))
+        finally:
+            conn.close()
+
+if __name__ == '__main__':
+    main()
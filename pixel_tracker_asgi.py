@@ -0,0 +1,251 @@
+"""
+Async pixel tracker for large open spikes
+
+A plain ASGI application with the same /track and /stats contract as
+pixel_tracker_py2. Request handlers never touch the database: /track logs
+the raw hit to the event log, puts it on an in-memory queue and answers with
+the precomputed pixel at once, and a single writer task drains the queue in batches, handing each
+batch to one writer thread that classifies the hits and inserts them into
+SQLite in a single transaction.
+
+Run with an ASGI server that supports the lifespan protocol, e.g.:
+    uvicorn pixel_tracker_asgi:app --host 0.0.0.0 --port 8080 --no-access-log
+"""
+import asyncio
+import calendar
+import datetime
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+import cache
+import event_log
+import migrations
+import proxy_filter
+import rollups
+import storage
+import tracking_hits
+import tracking_tokens
+from tracking_writer import TrackingWriter
+
+# Hits queued between batches; further hits are dropped until the writer catches up
+MAX_QUEUE = 100000
+
+# Hits written per transaction, and the longest a queued hit waits
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+
+STATS_SQL = ('SELECT campaign_id, unique_recipients, total_opens, first_open, last_open '
+             'FROM campaign_rollups WHERE sender_email = ?')
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+log_path = os.path.join(current_dir, 'tracking_logs', 'pixel_tracking.log')
+
+PIXEL_HEADERS = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                 for name, value in tracking_hits.PIXEL_HEADERS]
+
+JSON_HEADERS = [(b'content-type', b'application/json')]
+
+def _http_date(value):
+    """
+    Render a stored timestamp the way Flask's jsonify renders datetimes
+    """
+    if not value:
+        return None
+    parsed = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+    return formatdate(calendar.timegm(parsed.utctimetuple()), usegmt=True)
+
+class AsyncTracker(object):
+    def __init__(self, db_path=storage.TRACKING_DB_PATH, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_queue=MAX_QUEUE):
+        """
+        ASGI pixel tracker with a queue drained by a single writer task
+
+        :param db_path: Path to the tracking database
+        :param batch_size: Hits written per transaction
+        :param flush_interval: Maximum seconds a queued hit waits to be written
+        :param max_queue: Maximum queued hits
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.hit_filter = proxy_filter.HitFilter()
+        self.deliveries = tracking_tokens.DeliveryResolver(db_path)
+        self.writer = TrackingWriter(db_path, prepare=self.process_hit,
+                                     dedupe_window=self.hit_filter.dedupe_window)
+        self.stats_cache = cache.get_cache('tracker_stats', max_entries=64)
+        # One thread owns the writer's connection; /stats reads use the default pool
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.writer_task = None
+        self.dropped_count = 0
+
+    def process_hit(self, hit_item):
+        return tracking_hits.process_hit(hit_item, self.hit_filter, self.deliveries)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] == '/track':
+                await self.track(scope, send)
+            elif scope['path'] == '/stats':
+                await self.stats(send)
+            else:
+                await self.respond(send, 404, JSON_HEADERS, b'{"error": "not found"}')
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.start()
+                except Exception as e:
+                    logging.error('Tracker startup error: {}'.format(e))
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def start(self):
+        """
+        Bring the schema up to date and start the writer task
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, migrations.migrate_tracking_db, self.db_path)
+        self.queue = asyncio.Queue(self.max_queue)
+        self.writer_task = asyncio.ensure_future(self.drain())
+
+    async def stop(self):
+        """
+        Write every queued hit and stop the writer task
+        """
+        if self.writer_task is not None:
+            # None tells the writer task to finish after what is queued
+            await self.queue.put(None)
+            await self.writer_task
+            self.writer_task = None
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.writer.close)
+        await asyncio.get_running_loop().run_in_executor(self.executor, event_log.get_event_log().stop)
+        self.executor.shutdown()
+
+    async def drain(self):
+        """
+        Writer task: collect up to batch_size hits or flush_interval seconds of them per write
+        """
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            dropped, self.dropped_count = self.dropped_count, 0
+            if dropped:
+                logging.warning('Tracking queue full, dropped {} hits'.format(dropped))
+            await loop.run_in_executor(self.executor, self.writer.write, batch)
+
+    async def track(self, scope, send):
+        """
+        Queue the hit and answer with the pixel without waiting for the database
+        """
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self.respond(send, 405, JSON_HEADERS, b'{"error": "method not allowed"}')
+            return
+        user_agent = 'unknown'
+        for name, value in scope['headers']:
+            if name == b'user-agent':
+                user_agent = value.decode('latin-1')
+                break
+        client = scope.get('client')
+        hit_item = (
+            time.time(),
+            scope['query_string'].decode('latin-1'),
+            user_agent,
+            client[0] if client else None
+        )
+        # Logged first so hits dropped by a full queue can be replayed
+        tracking_hits.log_hit(hit_item)
+        try:
+            self.queue.put_nowait(hit_item)
+        except asyncio.QueueFull:
+            self.dropped_count += 1
+        await self.respond(send, 200, PIXEL_HEADERS, tracking_hits.PIXEL_GIF if scope['method'] == 'GET' else b'')
+
+    def load_tracking_stats(self):
+        """
+        Per-campaign statistics from the rollups, shaped like pixel_tracker_py2's /stats
+        """
+        conn = storage.get_connection(self.db_path)
+        try:
+            rows = conn.execute(STATS_SQL, (rollups.ALL_SENDERS,)).fetchall()
+        finally:
+            conn.rollback()
+        return [
+            {
+                'campaign_id': campaign_id or None,
+                'unique_recipients': unique_recipients,
+                'total_opens': total_opens,
+                'first_open': _http_date(first_open),
+                'last_open': _http_date(last_open)
+            } for campaign_id, unique_recipients, total_opens, first_open, last_open in rows
+        ]
+
+    def get_tracking_stats(self):
+        conn = storage.get_connection(self.db_path)
+        try:
+            version = cache.get_version(conn)
+        finally:
+            conn.rollback()
+        return self.stats_cache.get_or_compute(('stats',), version, self.load_tracking_stats)
+
+    async def stats(self, send):
+        try:
+            stats = await asyncio.get_running_loop().run_in_executor(None, self.get_tracking_stats)
+            await self.respond(send, 200, JSON_HEADERS, json.dumps(stats, sort_keys=True).encode('utf-8'))
+        except Exception as e:
+            logging.error('Error retrieving tracking stats: {}'.format(e))
+            await self.respond(send, 500, JSON_HEADERS, json.dumps({'error': str(e)}).encode('utf-8'))
+
+    @staticmethod
+    async def respond(send, status, headers, body):
+        if not any(name == b'content-length' for name, _ in headers):
+            headers = headers + [(b'content-length', str(len(body)).encode('latin-1'))]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+if not os.path.exists(os.path.dirname(log_path)):
+    os.makedirs(os.path.dirname(log_path))
+
+logging.basicConfig(
+    filename=log_path,
+    level=logging.INFO,
+    format='%(asctime)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+app = AsyncTracker()
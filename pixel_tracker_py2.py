@@ -1,24 +1,36 @@
-import base64
+import atexit
 import logging
 import os
 import json
 import datetime
-import uuid
-from flask import Flask, send_file, request, jsonify
+import time
+from flask import Flask, request, jsonify
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import OperationalError
-import io
 import pytz
 
+import cache
+import event_log
+import hll
+import migrations
+import proxy_filter
+import rollups
+import storage
+import timeseries
+import tracking_hits
+import tracking_tokens
+import user_agents
+from tracking_hits import PIXEL_GIF, PIXEL_HEADERS
+from tracking_writer import TrackingWriter
+
 # Database Setup
 Base = declarative_base()
 
 class PixelTrack(Base):
-    __tablename__ = 'pixel_tracks'
+    __tablename__ = 'pixel_tracks'  # View over pixel_events and its lookup tables
     
-    id = sa.Column(sa.String, primary_key=True)
+    id = sa.Column(sa.Integer, primary_key=True)
     campaign_id = sa.Column(sa.String)
     sender_email = sa.Column(sa.String, nullable=True)  # Make nullable for backward compatibility
     recipient = sa.Column(sa.String, nullable=True)     # Make nullable for backward compatibility
@@ -27,12 +39,23 @@ class PixelTrack(Base):
     ip_address = sa.Column(sa.String)
     device_info = sa.Column(sa.String, nullable=True)   # Make nullable for backward compatibility
     location = sa.Column(sa.String, nullable=True)      # Make nullable for backward compatibility
+    delivery_id = sa.Column(sa.Integer, nullable=True)  # Set for hits with a signed token
+
+class CampaignRollup(Base):
+    __tablename__ = 'campaign_rollups'
+
+    campaign_id = sa.Column(sa.String, primary_key=True)
+    sender_email = sa.Column(sa.String, primary_key=True)  # rollups.ALL_SENDERS for the campaign total
+    unique_recipients = sa.Column(sa.Integer)
+    total_opens = sa.Column(sa.Integer)
+    first_open = sa.Column(sa.DateTime)
+    last_open = sa.Column(sa.DateTime)
 
 # Ensure log and tracking data can be stored in the current directory
 current_dir = os.path.dirname(os.path.abspath(__file__))
 log_path = os.path.join(current_dir, 'tracking_logs', 'pixel_tracking.log')
 tracking_data_path = os.path.join(current_dir, 'tracking_logs', 'tracking_data.json')
-db_path = os.path.join(current_dir, 'tracking.db')
+db_path = storage.TRACKING_DB_PATH
 
 # Ensure tracking_logs directory exists
 if not os.path.exists(os.path.join(current_dir, 'tracking_logs')):
@@ -47,155 +70,176 @@ logging.basicConfig(
 )
 
 # Create SQLAlchemy engine and session
-engine = sa.create_engine('sqlite:///{}'.format(db_path))
+engine = storage.create_engine(db_path)
 
-def migrate_database():
-    """
-    Migrate database schema if needed
-    """
-    try:
-        # Attempt to query existing table to check schema
-        connection = engine.connect()
-        connection.execute("PRAGMA table_info(pixel_tracks)")
-        
-        # Check for new columns
-        try:
-            connection.execute("SELECT sender_email FROM pixel_tracks LIMIT 1")
-        except OperationalError:
-            # Column doesn't exist, add it
-            connection.execute("ALTER TABLE pixel_tracks ADD COLUMN sender_email TEXT")
-        
-        try:
-            connection.execute("SELECT recipient FROM pixel_tracks LIMIT 1")
-        except OperationalError:
-            connection.execute("ALTER TABLE pixel_tracks ADD COLUMN recipient TEXT")
-        
-        try:
-            connection.execute("SELECT device_info FROM pixel_tracks LIMIT 1")
-        except OperationalError:
-            connection.execute("ALTER TABLE pixel_tracks ADD COLUMN device_info TEXT")
-        
-        try:
-            connection.execute("SELECT location FROM pixel_tracks LIMIT 1")
-        except OperationalError:
-            connection.execute("ALTER TABLE pixel_tracks ADD COLUMN location TEXT")
-        
-        connection.close()
-    except Exception as e:
-        logging.error('Database migration error: {}'.format(e))
-        # If migration fails, recreate the table
-        Base.metadata.drop_all(engine)
-        Base.metadata.create_all(engine)
-
-# Create tables and migrate if needed
-migrate_database()
-Base.metadata.create_all(engine)
+# Bring the schema up to date before serving
+migrations.migrate_tracking_db(db_path)
 Session = sessionmaker(bind=engine)
 
-# Create a 1x1 transparent GIF pixel
-PIXEL_GIF = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+# Tags proxy hits and collapses prefetches and repeat opens before they are buffered
+hit_filter = proxy_filter.HitFilter()
+
+# Maps delivery ids from signed pixel tokens back to campaign, sender and recipient
+deliveries = tracking_tokens.DeliveryResolver(db_path)
+
+# Precomputed pixel response body
+PIXEL_BODY = (PIXEL_GIF,)
+
+# Set TRACKING_FAST_PATH=0 to serve /track through Flask, e.g. to compare in benchmarks
+FAST_PATH_ENABLED = os.environ.get('TRACKING_FAST_PATH', '1') != '0'
+
+# Aggregates served by /stats, recomputed when the tracking writer commits a batch
+stats_cache = cache.get_cache('tracker_stats', max_entries=64)
 
 app = Flask(__name__)
 
 def get_device_info(user_agent):
     """
-    Extract basic device information from user agent
+    Device class of a user agent: Mobile, Tablet, Desktop, Proxy, Bot or Unknown
     """
-    user_agent = user_agent.lower()
-    if 'mobile' in user_agent:
-        return 'Mobile'
-    elif 'tablet' in user_agent:
-        return 'Tablet'
-    elif 'windows' in user_agent or 'macintosh' in user_agent or 'linux' in user_agent:
-        return 'Desktop'
-    return 'Unknown'
+    return user_agents.classify(user_agent).device
 
-def track_pixel():
+def capture_hit(environ):
     """
-    Track email engagement with comprehensive data collection
+    Log and buffer the raw details of a pixel hit; parsing and filtering
+    happen on the tracking writer's thread
+
+    :param environ: WSGI environ of the pixel request
     """
-    # Generate unique tracking ID
-    track_id = str(uuid.uuid4())
-    
-    # Get campaign ID and sender from request
-    campaign_id = request.args.get('campaign_id', 'unknown')
-    sender_email = request.args.get('sender', 'unknown')
-    recipient = request.args.get('recipient', 'unknown')  # Optional recipient tracking
-    
-    # Collect tracking information
-    user_agent = request.headers.get('User-Agent', 'unknown')
-    tracking_info = {
-        'id': track_id,
-        'campaign_id': campaign_id,
-        'sender_email': sender_email,
-        'recipient': recipient,
-        'timestamp': datetime.datetime.utcnow().isoformat(),
-        'user_agent': user_agent,
-        'ip_address': request.remote_addr,
-        'device_info': get_device_info(user_agent)
-    }
-    
-    # Save to database
-    session = Session()
-    try:
-        pixel_track = PixelTrack(
-            id=track_id,
-            campaign_id=campaign_id,
-            sender_email=sender_email,
-            recipient=recipient,
-            user_agent=tracking_info['user_agent'],
-            ip_address=tracking_info['ip_address'],
-            device_info=tracking_info['device_info']
-        )
-        session.add(pixel_track)
-        session.commit()
-    except Exception as e:
-        logging.error('Database tracking error: {}'.format(e))
-        session.rollback()
-    finally:
-        session.close()
-    
-    # Log tracking
-    logging.info('Pixel tracked: {}'.format(tracking_info))
-    
-    # Return transparent pixel
-    return send_file(
-        io.BytesIO(PIXEL_GIF),
-        mimetype='image/gif'
+    hit_item = (
+        time.time(),
+        environ.get('QUERY_STRING', ''),
+        environ.get('HTTP_USER_AGENT', 'unknown'),
+        environ.get('REMOTE_ADDR')
     )
+    # Logged first so hits dropped by a full buffer can be replayed
+    tracking_hits.log_hit(hit_item)
+    tracking_writer.add(hit_item)
 
-def get_tracking_stats():
+def process_hit(hit_item):
     """
-    Provide comprehensive tracking statistics
+    Turn a captured hit into a pixel_tracks row; runs on the tracking writer's thread
+    """
+    return tracking_hits.process_hit(hit_item, hit_filter, deliveries)
+
+def track_pixel():
+    """
+    Track email engagement; the Flask route behind the WSGI fast path
+    """
+    capture_hit(request.environ)
+    return app.response_class(PIXEL_GIF, headers=PIXEL_HEADERS)
+
+def track_fast_path(wsgi_app):
+    """
+    Answer GET /track before Flask's routing, request and response machinery
+
+    :param wsgi_app: WSGI application handling every other request
+    :return: WSGI application
+    """
+    def application(environ, start_response):
+        if environ.get('PATH_INFO') == '/track' and environ.get('REQUEST_METHOD') == 'GET':
+            capture_hit(environ)
+            start_response('200 OK', list(PIXEL_HEADERS))
+            return PIXEL_BODY
+        return wsgi_app(environ, start_response)
+    return application
+
+# Registered first so the event log stops after the writer has drained its hits
+atexit.register(event_log.get_event_log().stop)
+
+# Batch pixel hits in memory and drain them when the process exits
+tracking_writer = TrackingWriter(db_path, prepare=process_hit, dedupe_window=hit_filter.dedupe_window)
+atexit.register(tracking_writer.close)
+
+def load_tracking_stats():
+    """
+    Read per-campaign statistics from the rollups
     """
     session = Session()
     try:
-        # Aggregate tracking data
-        stats = session.query(
-            PixelTrack.campaign_id,
-            sa.func.count(sa.distinct(PixelTrack.recipient)).label('unique_recipients'),
-            sa.func.count(PixelTrack.id).label('total_opens'),
-            sa.func.min(PixelTrack.timestamp).label('first_open'),
-            sa.func.max(PixelTrack.timestamp).label('last_open')
-        ).group_by(PixelTrack.campaign_id).all()
+        # Per-campaign totals maintained by the tracking writer
+        stats = session.query(CampaignRollup).filter(
+            CampaignRollup.sender_email == rollups.ALL_SENDERS
+        ).all()
         
         # Convert to list of dictionaries
         stats_list = [
             {
-                'campaign_id': stat[0],
-                'unique_recipients': stat[1],
-                'total_opens': stat[2],
-                'first_open': stat[3],
-                'last_open': stat[4]
+                'campaign_id': stat.campaign_id or None,
+                'unique_recipients': stat.unique_recipients,
+                'total_opens': stat.total_opens,
+                'first_open': stat.first_open,
+                'last_open': stat.last_open
             } for stat in stats
         ]
         
-        return jsonify(stats_list)
+        return stats_list
+    finally:
+        session.close()
+
+def get_tracking_stats():
+    """
+    Provide comprehensive tracking statistics
+    """
+    try:
+        version = cache.get_version(storage.get_connection(db_path))
+        return jsonify(stats_cache.get_or_compute(('stats',), version, load_tracking_stats))
     except Exception as e:
         logging.error('Error retrieving tracking stats: {}'.format(e))
         return jsonify({'error': str(e)}), 500
-    finally:
-        session.close()
+
+def get_unique_estimate():
+    """
+    Estimate unique opens from the HyperLogLog sketches for any campaign, sender and day range
+    """
+    try:
+        conn = storage.get_connection(db_path)
+        try:
+            sketch = hll.estimate_unique(
+                conn,
+                campaign_id=request.args.get('campaign_id'),
+                sender_email=request.args.get('sender'),
+                start_day=request.args.get('start'),
+                end_day=request.args.get('end')
+            )
+        finally:
+            conn.rollback()
+        
+        return jsonify({
+            'unique_recipients': sketch.count() if sketch else 0,
+            'relative_error': round(sketch.error_bound() if sketch else 0.0, 4)
+        })
+    except Exception as e:
+        logging.error('Error estimating unique opens: {}'.format(e))
+        return jsonify({'error': str(e)}), 500
+
+def get_open_timeseries():
+    """
+    Open counts per minute, hour or day from the pre-aggregated buckets
+    """
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in timeseries.RESOLUTIONS:
+        return jsonify({'error': 'resolution must be one of {}'.format(', '.join(sorted(timeseries.RESOLUTIONS)))}), 400
+    try:
+        conn = storage.get_connection(db_path)
+        try:
+            series = timeseries.query_series(
+                conn,
+                campaign_id=request.args.get('campaign_id'),
+                resolution=resolution,
+                start=request.args.get('start'),
+                end=request.args.get('end')
+            )
+        finally:
+            conn.rollback()
+        
+        return jsonify([{'bucket': bucket, 'opens': opens} for bucket, opens in series])
+    except Exception as e:
+        logging.error('Error retrieving open timeseries: {}'.format(e))
+        return jsonify({'error': str(e)}), 500
+
+if FAST_PATH_ENABLED:
+    app.wsgi_app = track_fast_path(app.wsgi_app)
 
 # Define routes
 @app.route('/track')
@@ -206,5 +250,24 @@ def track():
 def stats():
     return get_tracking_stats()
 
+@app.route('/stats/unique')
+def unique_stats():
+    return get_unique_estimate()
+
+@app.route('/stats/timeseries')
+def timeseries_stats():
+    return get_open_timeseries()
+
+@app.route('/metrics/cache')
+def cache_metrics():
+    return jsonify(cache.all_stats())
+
+@app.route('/metrics/hits')
+def hit_metrics():
+    stats = hit_filter.stats()
+    # Repeats from other processes are only caught by the writer
+    stats['writer_duplicate'] = tracking_writer.duplicate_count
+    return jsonify(stats)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
@@ -0,0 +1,295 @@
+"""
+Mail-proxy and prefetch detection for pixel hits
+
+Every hit is classified before it is buffered for storage:
+
+- prefetch: crawlers, HTTP libraries and link scanners (by user agent) and
+  mail security scanners (by IP range) fetching the pixel without anyone
+  opening the message
+- proxy: image proxies fetching on a recipient's behalf, e.g. Gmail's
+  GoogleImageProxy or Apple Mail Privacy Protection
+- direct: everything else
+
+In 'collapse' mode prefetch hits are dropped and repeat hits from the same
+recipient within DEDUPE_WINDOW seconds are stored once. In 'tag' mode every
+hit is stored with its device_info set to 'Proxy' or 'Bot'.
+
+HitFilter only remembers the recipients seen by its own process, so under
+several gunicorn workers or tracker processes its dedupe is best-effort: it
+saves the work of storing the repeats it sees. The window is enforced by the
+tracking writer, which checks each stored hit against the database inside
+its write transaction (see HitFilter.dedupe_window), so its 'duplicate'
+count is a lower bound and 'stored' counts hits passed to the writer.
+
+Additional IP ranges, e.g. Apple's published egress-ip-ranges.csv, are
+loaded from the CSV files listed in TRACKING_PROXY_RANGES (separated by
+os.pathsep); the first column is a CIDR and optional second and third
+columns give the kind and label.
+"""
+import binascii
+import csv
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque, namedtuple
+
+DIRECT = 'direct'
+PROXY = 'proxy'
+PREFETCH = 'prefetch'
+
+TAG = 'tag'
+COLLAPSE = 'collapse'
+
+FILTER_MODE = os.environ.get('TRACKING_PROXY_MODE', COLLAPSE)
+
+# Seconds within which repeat hits from one recipient are stored once
+DEDUPE_WINDOW = float(os.environ.get('TRACKING_DEDUPE_SECONDS', '60'))
+
+# Recipients remembered for deduplication before the oldest are forgotten
+MAX_RECENT = 100000
+
+# (CIDR, kind, label) of networks known to fetch pixels without an open
+DEFAULT_RANGES = [
+    # Gmail image proxy
+    ('66.102.0.0/20', PROXY, 'Gmail'),
+    ('66.249.80.0/20', PROXY, 'Gmail'),
+    ('64.233.160.0/19', PROXY, 'Gmail'),
+    ('72.14.192.0/18', PROXY, 'Gmail'),
+    ('74.125.0.0/16', PROXY, 'Gmail'),
+    # Apple's own network; Mail Privacy Protection mostly fetches through the
+    # relay egress ranges in Apple's egress-ip-ranges.csv, loaded separately
+    ('17.0.0.0/8', PROXY, 'Apple'),
+    # Yahoo mail proxy
+    ('98.136.0.0/14', PROXY, 'Yahoo Mail'),
+    ('74.6.0.0/16', PROXY, 'Yahoo Mail'),
+    # Exchange Online Protection / Safe Links scanners
+    ('40.92.0.0/15', PREFETCH, 'Microsoft Safe Links'),
+    ('40.107.0.0/16', PREFETCH, 'Microsoft Safe Links'),
+    ('52.100.0.0/14', PREFETCH, 'Microsoft Safe Links'),
+    ('104.47.0.0/17', PREFETCH, 'Microsoft Safe Links'),
+]
+
+HitClass = namedtuple('HitClass', ['kind', 'label', 'device_info', 'store'])
+
+_FAMILIES = {4: (socket.AF_INET, 32), 6: (socket.AF_INET6, 128)}
+
+def parse_address(address):
+    """
+    Parse an IPv4 or IPv6 address
+
+    :param address: Address string; IPv4-mapped IPv6 addresses count as IPv4
+    :return: Tuple of (IP version, integer address), or None if invalid
+    """
+    if not address:
+        return None
+    address = address.strip()
+    if address.lower().startswith('::ffff:') and '.' in address:
+        address = address[7:]
+    version = 6 if ':' in address else 4
+    try:
+        packed = socket.inet_pton(_FAMILIES[version][0], address)
+    except (socket.error, ValueError):
+        return None
+    return version, int(binascii.hexlify(packed), 16)
+
+class PrefixIndex(object):
+    def __init__(self):
+        """
+        In-memory longest-prefix-match index of IP networks
+
+        Networks are hashed per prefix length, so a lookup costs one dict
+        probe per distinct prefix length instead of a scan of every range.
+        """
+        self.tables = {4: {}, 6: {}}
+        self.lengths = {4: [], 6: []}
+
+    def add(self, cidr, value):
+        """
+        Index a network
+
+        :param cidr: Network such as '66.102.0.0/20'; a bare address is a single host
+        :param value: Value returned for addresses inside the network
+        """
+        address, _, length = cidr.strip().partition('/')
+        parsed = parse_address(address)
+        if parsed is None:
+            raise ValueError('Invalid network {!r}'.format(cidr))
+        version, network = parsed
+        bits = _FAMILIES[version][1]
+        length = int(length) if length else bits
+        if not 0 <= length <= bits:
+            raise ValueError('Invalid prefix length in {!r}'.format(cidr))
+        table = self.tables[version].setdefault(length, {})
+        table[network >> (bits - length)] = value
+        self.lengths[version] = sorted(self.tables[version], reverse=True)
+
+    def lookup(self, address):
+        """
+        Value of the most specific network containing an address
+
+        :param address: IP address string
+        :return: Indexed value, or None
+        """
+        parsed = parse_address(address)
+        if parsed is None:
+            return None
+        version, value = parsed
+        bits = _FAMILIES[version][1]
+        tables = self.tables[version]
+        for length in self.lengths[version]:
+            match = tables[length].get(value >> (bits - length))
+            if match is not None:
+                return match
+        return None
+
+    def __len__(self):
+        return sum(len(table) for tables in self.tables.values() for table in tables.values())
+
+def load_ranges(index, path):
+    """
+    Add the networks of a CSV file to an index
+
+    :param index: PrefixIndex
+    :param path: CSV file whose first column is a CIDR, optionally followed by kind and label
+    :return: Number of networks added
+    """
+    count = 0
+    label = os.path.splitext(os.path.basename(path))[0]
+    with open(path) as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            kind, row_label = PROXY, label
+            # Apple's file has location columns where ours have kind and label
+            if len(row) > 1 and row[1].strip() in (PROXY, PREFETCH):
+                kind = row[1].strip()
+                if len(row) > 2 and row[2].strip():
+                    row_label = row[2].strip()
+            try:
+                index.add(row[0], (kind, row_label))
+            except ValueError as e:
+                logging.warning('Skipping proxy range in {}: {}'.format(path, e))
+                continue
+            count += 1
+    return count
+
+def build_index(paths=None):
+    """
+    Index of the default proxy ranges plus those from CSV files
+
+    :param paths: CSV files; defaults to TRACKING_PROXY_RANGES
+    :return: PrefixIndex of (kind, label)
+    """
+    index = PrefixIndex()
+    for cidr, kind, label in DEFAULT_RANGES:
+        index.add(cidr, (kind, label))
+    if paths is None:
+        paths = [path for path in os.environ.get('TRACKING_PROXY_RANGES', '').split(os.pathsep) if path]
+    for path in paths:
+        try:
+            load_ranges(index, path)
+        except (IOError, OSError) as e:
+            logging.error('Error loading proxy ranges: {}'.format(e))
+    return index
+
+class HitFilter(object):
+    def __init__(self, index=None, mode=FILTER_MODE, window=DEDUPE_WINDOW, max_recent=MAX_RECENT):
+        """
+        Classify pixel hits and decide which ones reach storage
+
+        :param index: PrefixIndex of proxy ranges; build_index() by default
+        :param mode: 'collapse' to drop prefetches and repeat hits, 'tag' to store everything
+        :param window: Seconds within which a recipient's repeat hits are collapsed
+        :param max_recent: Recipients remembered for deduplication
+        """
+        if mode not in (TAG, COLLAPSE):
+            raise ValueError('Unknown proxy filter mode {!r}'.format(mode))
+        self.index = index if index is not None else build_index()
+        self.mode = mode
+        self.window = window
+        self.max_recent = max_recent
+        self.lock = threading.Lock()
+        self.last_seen = {}
+        self.recent = deque()
+        self.counts = {DIRECT: 0, PROXY: 0, PREFETCH: 0, 'duplicate': 0, 'stored': 0}
+
+    @property
+    def dedupe_window(self):
+        """
+        Seconds the tracking writer should dedupe stored hits over, 0 unless collapsing
+        """
+        return self.window if self.mode == COLLAPSE else 0
+
+    def classify(self, agent, ip_address):
+        """
+        Kind of a hit from its user agent and source address
+
+        :param agent: user_agents.UserAgent of the hit
+        :param ip_address: Remote address of the hit
+        :return: Tuple of (kind, label)
+        """
+        network = self.index.lookup(ip_address)
+        if agent.is_bot:
+            return PREFETCH, agent.client
+        if network is not None:
+            return network
+        if agent.is_proxy:
+            return PROXY, agent.client
+        return DIRECT, agent.client
+
+    def _seen_recently(self, key, now):
+        """
+        Record a hit and tell whether the same key was recorded within the window
+        """
+        # Forget hits that have left the window, or the oldest ones when full
+        while self.recent and (self.recent[0][0] <= now - self.window or len(self.recent) >= self.max_recent):
+            seen, old_key = self.recent.popleft()
+            if self.last_seen.get(old_key) == seen:
+                del self.last_seen[old_key]
+        if key in self.last_seen:
+            return True
+        self.last_seen[key] = now
+        self.recent.append((now, key))
+        return False
+
+    def check(self, campaign_id, sender_email, recipient, agent, ip_address, now=None):
+        """
+        Classify a hit and decide whether to store it
+
+        :param agent: user_agents.UserAgent of the hit
+        :param now: Hit time in seconds; defaults to time.time()
+        :return: HitClass with kind, label, the device_info to store and whether to store it
+        """
+        kind, label = self.classify(agent, ip_address)
+        device_info = {PROXY: 'Proxy', PREFETCH: 'Bot'}.get(kind, agent.device)
+        dedupe = self.mode == COLLAPSE and self.window > 0 and recipient and recipient != 'unknown'
+        with self.lock:
+            duplicate = False
+            if self.mode == COLLAPSE and kind == PREFETCH:
+                store = False
+            elif dedupe:
+                duplicate = self._seen_recently((campaign_id, sender_email, recipient),
+                                                time.time() if now is None else now)
+                store = not duplicate
+            else:
+                store = True
+            self.counts[kind] += 1
+            self.counts['duplicate'] += duplicate
+            self.counts['stored'] += store
+        return HitClass(kind, label, device_info, store)
+
+    def stats(self):
+        """
+        Hit counts by kind, plus duplicates collapsed and hits stored
+
+        :return: Dictionary of statistics
+        """
+        with self.lock:
+            stats = dict(self.counts)
+            stats['mode'] = self.mode
+            stats['window'] = self.window
+            stats['recent_recipients'] = len(self.last_seen)
+            stats['networks'] = len(self.index)
+            return stats
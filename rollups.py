@@ -0,0 +1,141 @@
+"""
+Incrementally maintained campaign rollups for the tracking dashboards
+
+campaign_rollups holds one row per (campaign, sender) plus one row per
+campaign under ALL_SENDERS, so dashboards read O(campaigns) rows instead of
+scanning pixel_tracks. campaign_recipients is the exact recipient set each
+rollup row counts unique recipients against.
+
+Rebuild from pixel_tracks with:
+    python rollups.py
+"""
+import argparse
+import logging
+from collections import defaultdict
+
+import cache
+import storage
+
+# Sender key of the per-campaign rows aggregated over every sender
+ALL_SENDERS = '*'
+
+INSERT_RECIPIENT_SQL = ('INSERT OR IGNORE INTO campaign_recipients (campaign_id, sender_email, recipient) '
+                        'VALUES (?, ?, ?)')
+
+INSERT_ROLLUP_SQL = ('INSERT OR IGNORE INTO campaign_rollups '
+                     '(campaign_id, sender_email, unique_recipients, total_opens, first_open, last_open) '
+                     'VALUES (?, ?, 0, 0, ?, ?)')
+
+UPDATE_ROLLUP_SQL = '''UPDATE campaign_rollups SET
+    unique_recipients = unique_recipients + ?,
+    total_opens = total_opens + ?,
+    first_open = MIN(COALESCE(first_open, ?), ?),
+    last_open = MAX(COALESCE(last_open, ?), ?)
+    WHERE campaign_id = ? AND sender_email = ?'''
+
+class _Group(object):
+    """
+    Aggregate of one batch's hits for a single rollup row
+    """
+    def __init__(self):
+        self.opens = 0
+        self.first_open = None
+        self.last_open = None
+        self.recipients = set()
+
+    def add(self, recipient, timestamp):
+        self.opens += 1
+        if recipient is not None:
+            self.recipients.add(recipient)
+        if timestamp is not None:
+            if self.first_open is None or timestamp < self.first_open:
+                self.first_open = timestamp
+            if self.last_open is None or timestamp > self.last_open:
+                self.last_open = timestamp
+
+def update_rollups(conn, hits):
+    """
+    Fold a batch of new hits into the rollup tables
+
+    Must run in the same transaction that inserts the hits so the rollups
+    never drift from pixel_tracks.
+
+    :param conn: sqlite3 connection with an open transaction
+    :param hits: Iterable of (campaign_id, sender_email, recipient, timestamp) tuples
+    """
+    groups = defaultdict(_Group)
+    for campaign_id, sender_email, recipient, timestamp in hits:
+        campaign_id = campaign_id or ''
+        groups[(campaign_id, sender_email or '')].add(recipient, timestamp)
+        groups[(campaign_id, ALL_SENDERS)].add(recipient, timestamp)
+
+    for (campaign_id, sender_email), group in groups.items():
+        # Only recipients not already in the set count towards unique_recipients
+        changes = conn.total_changes
+        conn.executemany(INSERT_RECIPIENT_SQL,
+                         [(campaign_id, sender_email, recipient) for recipient in group.recipients])
+        new_recipients = conn.total_changes - changes
+
+        conn.execute(INSERT_ROLLUP_SQL, (campaign_id, sender_email, group.first_open, group.last_open))
+        conn.execute(UPDATE_ROLLUP_SQL, (
+            new_recipients, group.opens,
+            group.first_open, group.first_open,
+            group.last_open, group.last_open,
+            campaign_id, sender_email
+        ))
+
+def rebuild_tables(conn):
+    """
+    Recompute both rollup tables from pixel_tracks
+
+    :param conn: sqlite3 connection with an open transaction
+    """
+    conn.execute('DELETE FROM campaign_recipients')
+    conn.execute('DELETE FROM campaign_rollups')
+    for sender_column in ("COALESCE(sender_email, '')", "'{}'".format(ALL_SENDERS)):
+        conn.execute('''INSERT INTO campaign_recipients (campaign_id, sender_email, recipient)
+            SELECT DISTINCT COALESCE(campaign_id, ''), {}, recipient
+            FROM pixel_tracks WHERE recipient IS NOT NULL'''.format(sender_column))
+        conn.execute('''INSERT INTO campaign_rollups
+            (campaign_id, sender_email, unique_recipients, total_opens, first_open, last_open)
+            SELECT COALESCE(campaign_id, ''), {0}, COUNT(DISTINCT recipient), COUNT(*),
+                   MIN(timestamp), MAX(timestamp)
+            FROM pixel_tracks GROUP BY COALESCE(campaign_id, ''), {0}'''.format(sender_column))
+
+def rebuild(db_path=storage.TRACKING_DB_PATH):
+    """
+    Backfill the rollups of a tracking database in one transaction
+
+    :param db_path: Path to the tracking database
+    :return: Number of rollup rows written
+    """
+    conn = storage.connect(db_path)
+    conn.isolation_level = None
+    try:
+        # IMMEDIATE blocks the tracking writer until the rebuild commits
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rebuild_tables(conn)
+            cache.bump_version(conn)
+            count = conn.execute('SELECT COUNT(*) FROM campaign_rollups').fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return count
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild campaign rollups from pixel_tracks')
+    parser.add_argument('--db', default=storage.TRACKING_DB_PATH, help='tracking database path')
+    args = parser.parse_args()
+
+    import migrations
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    migrations.migrate_tracking_db(args.db)
+    print('{}: rebuilt {} rollup rows'.format(args.db, rebuild(args.db)))
+
+if __name__ == '__main__':
+    main()
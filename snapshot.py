@@ -0,0 +1,205 @@
+"""
+Columnar Parquet snapshots of pixel_tracks for analytics
+
+A snapshot is a hive-partitioned Parquet dataset (campaign_id=.../day=...)
+with dictionary-encoded sender and device columns. It is written to a
+scratch directory and swapped in whole, so readers never see a partial
+snapshot. Readers memory-map the files and aggregate with Arrow compute
+kernels instead of building Python rows.
+
+Requires pyarrow. Take a snapshot (e.g. from cron) with:
+    python snapshot.py [--every SECONDS]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+except ImportError:
+    pa = None
+
+import export
+import storage
+
+SNAPSHOT_DIR = os.environ.get('TRACKING_SNAPSHOT_DIR', os.path.join(storage.BASE_DIR, 'tracking_snapshot'))
+
+# Written last into a finished snapshot
+MANIFEST_NAME = '_snapshot.json'
+
+# Rows converted to Arrow per record batch
+BATCH_SIZE = 100000
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError('pyarrow is required for tracking snapshots (pip install pyarrow)')
+
+def get_schema():
+    """
+    Arrow schema of snapshot files; campaign_id and day are partition keys
+    """
+    _require_pyarrow()
+    categorical = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('id', pa.int64()),
+        ('campaign_id', pa.string()),
+        ('sender_email', categorical),
+        ('recipient', pa.string()),
+        ('timestamp', pa.timestamp('us')),
+        ('user_agent', pa.string()),
+        ('ip_address', pa.string()),
+        ('device_info', categorical),
+        ('location', pa.string()),
+        ('day', pa.string()),
+    ])
+
+def get_partitioning(read=False):
+    """
+    Hive partitioning on campaign_id and day
+
+    :param read: Build the reading variant, which returns partition values dictionary-encoded
+    """
+    schema = pa.schema([('campaign_id', pa.string()), ('day', pa.string())])
+    if read:
+        return ds.partitioning(schema, flavor='hive', dictionaries='infer')
+    return ds.partitioning(schema, flavor='hive')
+
+def _to_record_batch(rows, schema):
+    """
+    Convert a batch of export rows to an Arrow record batch
+    """
+    columns = list(zip(*rows))
+    arrays = {}
+    for index, name in enumerate(export.EXPORT_COLUMNS):
+        arrays[name] = pa.array(columns[index], pa.int64() if name == 'id' else pa.string())
+    timestamps = arrays['timestamp']
+    arrays['day'] = pc.utf8_slice_codeunits(timestamps, 0, 10)
+    arrays['timestamp'] = pc.cast(timestamps, pa.timestamp('us'))
+    for name in ('sender_email', 'device_info'):
+        arrays[name] = arrays[name].dictionary_encode()
+    return pa.RecordBatch.from_arrays([arrays[field.name] for field in schema], schema=schema)
+
+def write_snapshot(db_path=storage.TRACKING_DB_PATH, snapshot_dir=SNAPSHOT_DIR, batch_size=BATCH_SIZE):
+    """
+    Write a full snapshot of pixel_tracks and swap it into place
+
+    :param db_path: Path to the tracking database
+    :param snapshot_dir: Directory the snapshot is published at
+    :param batch_size: Rows per record batch
+    :return: Number of rows written
+    """
+    _require_pyarrow()
+    schema = get_schema()
+    staging_dir = '{}.tmp-{}'.format(snapshot_dir, os.getpid())
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    # write_dataset pulls batches from its own thread, one at a time
+    conn = storage.connect(db_path, check_same_thread=False)
+    stats = {'rows': 0}
+    try:
+        batches = (_to_record_batch(rows, schema)
+                   for rows in export.iter_rows(conn, batch_size=batch_size, stats=stats))
+        ds.write_dataset(batches, staging_dir, schema=schema, format='parquet',
+                         partitioning=get_partitioning(), existing_data_behavior='error')
+    finally:
+        conn.close()
+
+    if not os.path.exists(staging_dir):
+        os.makedirs(staging_dir)
+    with open(os.path.join(staging_dir, MANIFEST_NAME), 'w') as f:
+        json.dump({'created_at': time.time(), 'rows': stats['rows']}, f)
+
+    # Swap directories so readers see either the old or the new snapshot
+    old_dir = '{}.old-{}'.format(snapshot_dir, os.getpid())
+    if os.path.exists(snapshot_dir):
+        os.rename(snapshot_dir, old_dir)
+    os.rename(staging_dir, snapshot_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return stats['rows']
+
+def read_manifest(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Metadata of the published snapshot
+
+    :return: Dictionary with created_at and rows, or None if there is no snapshot
+    """
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def load_snapshot(snapshot_dir=SNAPSHOT_DIR, columns=None, filter_expression=None):
+    """
+    Read a snapshot as an Arrow table through memory-mapped files
+
+    :param snapshot_dir: Snapshot directory
+    :param columns: Columns to read; all by default
+    :param filter_expression: Optional pyarrow.compute expression, e.g. on campaign_id or day
+    :return: pyarrow.Table
+    """
+    _require_pyarrow()
+    dataset = ds.dataset(snapshot_dir, format='parquet', partitioning=get_partitioning(read=True),
+                         filesystem=pafs.LocalFileSystem(use_mmap=True),
+                         exclude_invalid_files=True, ignore_prefixes=['.', '_'])
+    # Each file carries its own dictionaries; kernels need one per column
+    return dataset.to_table(columns=columns, filter=filter_expression).unify_dictionaries()
+
+def campaign_summary(table):
+    """
+    Per-campaign, per-sender open statistics computed with Arrow kernels
+
+    :param table: Table from load_snapshot
+    :return: pyarrow.Table with campaign_id, sender_email, unique_recipients,
+             total_opens, first_open and last_open columns
+    """
+    summary = table.group_by(['campaign_id', 'sender_email']).aggregate([
+        ('recipient', 'count_distinct'),
+        ('id', 'count'),
+        ('timestamp', 'min'),
+        ('timestamp', 'max'),
+    ])
+    return summary.rename_columns({
+        'recipient_count_distinct': 'unique_recipients',
+        'id_count': 'total_opens',
+        'timestamp_min': 'first_open',
+        'timestamp_max': 'last_open',
+    })
+
+def latest_opens(table, limit=100):
+    """
+    Most recent opens, selected without sorting the whole table
+    """
+    indices = pc.select_k_unstable(table, k=min(limit, table.num_rows),
+                                   sort_keys=[('timestamp', 'descending')])
+    return table.take(indices).sort_by([('timestamp', 'descending')])
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a Parquet snapshot of pixel_tracks')
+    parser.add_argument('--db', default=storage.TRACKING_DB_PATH, help='tracking database path')
+    parser.add_argument('--output', default=SNAPSHOT_DIR, help='snapshot directory')
+    parser.add_argument('--every', type=float, help='keep taking a snapshot every N seconds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    while True:
+        start = time.time()
+        try:
+            rows = write_snapshot(args.db, args.output)
+            logging.info('Snapshot of {} rows written to {} in {:.1f}s'.format(rows, args.output, time.time() - start))
+        except Exception as e:
+            logging.error('Snapshot error: {}'.format(e))
+            if not args.every:
+                raise
+        if not args.every:
+            break
+        time.sleep(max(0, args.every - (time.time() - start)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Database locations, overridable for deployments and benchmarks
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACKING_DB_PATH = os.environ.get('TRACKING_DB_PATH', os.path.join(BASE_DIR, 'tracking.db'))
+MAILER_DB_PATH = os.environ.get('MAILER_DB_PATH', os.path.join(BASE_DIR, 'mailer.db'))
+
+# Milliseconds a connection waits on a locked database before failing
+BUSY_TIMEOUT_MS = 5000
+
+# Applied to every connection: WAL lets the tracker workers write while
+# dashboards read, and NORMAL sync is durable across application crashes
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+    ('mmap_size', 256 * 1024 * 1024),
+)
+
+def apply_pragmas(conn):
+    """
+    Apply the standard pragmas to a DB-API sqlite3 connection
+    """
+    cursor = conn.cursor()
+    for name, value in PRAGMAS:
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+def connect(db_path=TRACKING_DB_PATH, check_same_thread=True):
+    """
+    Open a new SQLite connection with the standard pragmas
+
+    :param db_path: Path to the database file
+    :param check_same_thread: Passed to sqlite3; only disable when access is serialized
+    :return: sqlite3 connection
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000.0, check_same_thread=check_same_thread)
+    apply_pragmas(conn)
+    return conn
+
+_local = threading.local()
+
+def get_connection(db_path=TRACKING_DB_PATH):
+    """
+    Get the calling thread's connection to a database, opening it on first use
+
+    Connections are never shared between threads; callers commit or roll back
+    but do not close them.
+
+    :param db_path: Path to the database file
+    :return: sqlite3 connection owned by the current thread
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or _local.pid != os.getpid():
+        # Connections inherited across a fork must not be reused
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connections[db_path] = connect(db_path)
+    return conn
+
+def close_thread_connections():
+    """
+    Close the calling thread's connections
+    """
+    connections = getattr(_local, 'connections', None) or {}
+    for conn in connections.values():
+        conn.close()
+    _local.connections = {}
+
+class PoolTimeoutError(RuntimeError):
+    """
+    Raised when no pooled connection becomes free within the wait timeout
+    """
+
+class ConnectionPool(object):
+    def __init__(self, db_path=TRACKING_DB_PATH, max_connections=5, timeout=10.0):
+        """
+        Bounded pool of SQLite connections with exclusive checkout
+
+        A connection is used by one thread at a time, from checkout until it
+        is returned, which is what makes check_same_thread=False safe here.
+
+        :param db_path: Path to the database file
+        :param max_connections: Maximum number of open connections
+        :param timeout: Seconds to wait for a free connection before PoolTimeoutError
+        """
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.idle = []
+        self.opened = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self):
+        """
+        Check out a connection, opening one if the pool is below its limit
+
+        :return: sqlite3 connection
+        """
+        start = time.time()
+        deadline = start + self.timeout
+        with self.available:
+            while True:
+                if self.idle:
+                    conn = self.idle.pop()
+                    break
+                if self.opened < self.max_connections:
+                    self.opened += 1
+                    conn = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError('No database connection free after {}s'.format(self.timeout))
+                self.available.wait(remaining)
+
+            wait = time.time() - start
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+        if conn is None:
+            try:
+                conn = connect(self.db_path, check_same_thread=False)
+            except Exception:
+                with self.available:
+                    self.opened -= 1
+                    self.in_use -= 1
+                    self.available.notify()
+                raise
+        return conn
+
+    def release(self, conn, discard=False):
+        """
+        Return a connection to the pool, ending any transaction left open
+
+        :param conn: Connection previously returned by acquire
+        :param discard: Close the connection instead of reusing it
+        """
+        if not discard:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                discard = True
+        if discard:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+        with self.available:
+            self.in_use -= 1
+            if discard:
+                self.opened -= 1
+            else:
+                self.idle.append(conn)
+            self.available.notify()
+
+    @contextmanager
+    def get_connection(self):
+        """
+        Context manager checking out a connection for the duration of the block
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def metrics(self):
+        """
+        Pool utilization and checkout wait statistics
+
+        :return: Dictionary of metrics
+        """
+        with self.lock:
+            return {
+                'max_connections': self.max_connections,
+                'open_connections': self.opened,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'utilization': float(self.in_use) / self.max_connections,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'avg_wait_ms': self.total_wait * 1000 / max(self.checkouts, 1),
+                'max_wait_ms': self.max_wait * 1000
+            }
+
+    def close_all_connections(self):
+        """
+        Close all idle connections
+        """
+        with self.available:
+            idle, self.idle = self.idle, []
+            self.opened -= len(idle)
+        for conn in idle:
+            conn.close()
+
+def create_engine(db_path=TRACKING_DB_PATH):
+    """
+    Create a SQLAlchemy engine whose connections use the standard pragmas
+
+    :param db_path: Path to the database file
+    :return: SQLAlchemy engine
+    """
+    import sqlalchemy as sa
+
+    engine = sa.create_engine('sqlite:///{}'.format(db_path),
+                              connect_args={'timeout': BUSY_TIMEOUT_MS / 1000.0})
+
+    def on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection)
+
+    sa.event.listen(engine, 'connect', on_connect)
+    return engine
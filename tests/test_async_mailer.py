@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+pytest.importorskip('aiosmtplib')
+
+import async_mailer
+import mailer
+from benchmarks import SMTPSink
+
+def make_sender(sink, **kwargs):
+    return async_mailer.AsyncEmailSender('sender@example.com', 'secret', smtp_host='127.0.0.1',
+                                         smtp_port=sink.server_address[1], use_tls=False, **kwargs)
+
+def email_list(count):
+    return [('user{}@example.com'.format(i), 'Hello', '<p>Hi</p>', None, None) for i in range(count)]
+
+def test_connections_stay_within_the_provider_limit(monkeypatch):
+    monkeypatch.setitem(async_mailer.PROVIDER_CONCURRENCY, '127.0.0.1', 3)
+    with SMTPSink(latency=0.001) as sink:
+        sender = make_sender(sink, max_connections=10)
+        summary = sender.send_emails(email_list(60))
+        sent = sink.message_count
+
+    assert (summary.sent, summary.failed) == (60, 0)
+    assert sent == 60
+    assert sink.max_open_connections <= 3
+    assert [result.recipient for result in summary.results] == [email[0] for email in email_list(60)]
+
+def counted(emails, read):
+    for email in emails:
+        read.append(email[0])
+        yield email
+
+def test_interrupted_campaign_records_every_email_read():
+    read = []
+    with SMTPSink(latency=0.002) as sink:
+        sender = make_sender(sink, max_connections=4)
+        timer = threading.Timer(0.3, setattr, (mailer, 'STOP_THREADS', True))
+        timer.start()
+        try:
+            summary = sender.send_emails(counted(email_list(2000), read))
+        finally:
+            timer.join()
+            mailer.STOP_THREADS = False
+        sent = sink.message_count
+
+    assert 0 < summary.sent < 2000
+    assert summary.sent == sent
+    assert summary.total == len(summary.results) == len(read)
+    assert [result.recipient for result in summary.results] == read
+    assert [result.success for result in summary.results].count(True) == summary.sent
+    assert all(result.error == 'Sending interrupted' for result in summary.results if not result.success)
@@ -0,0 +1,54 @@
+import threading
+
+import cache
+
+def test_generational_cache_keeps_a_small_working_set():
+    entries = cache.GenerationalCache(max_entries=100)
+    hot = ['hot{}'.format(i) for i in range(10)]
+    for key in hot:
+        entries.set(key, key.upper())
+    for i in range(1000):
+        for key in hot:
+            assert entries.get(key) == key.upper()
+        if entries.get('cold{}'.format(i)) is None:
+            entries.set('cold{}'.format(i), i)
+
+    stats = entries.stats()
+    assert stats['entries'] <= 100
+    assert stats['hits'] == 10000
+    assert stats['misses'] == 1000
+    assert stats['evictions'] > 0
+    assert stats['hit_rate'] == 10000.0 / 11000
+
+def test_generational_cache_evicts_entries_unused_for_a_generation():
+    entries = cache.GenerationalCache(max_entries=4)
+    for key in 'abcdef':
+        entries.set(key, key)
+    assert entries.get('a') is None
+    assert entries.get('f') == 'f'
+    assert entries.stats()['entries'] <= 4
+
+def test_cache_stats_have_the_same_shape():
+    shapes = set(frozenset(entries.stats()) for entries in (cache.TTLCache(), cache.LRUCache(),
+                                                            cache.GenerationalCache()))
+    assert len(shapes) == 1
+
+def test_generational_cache_counts_every_lookup_across_threads():
+    entries = cache.GenerationalCache(max_entries=64)
+    lookups = 20000
+
+    def worker(offset):
+        for i in range(lookups):
+            key = (i + offset) % 100
+            if entries.get(key) is None:
+                entries.set(key, key + 1)
+
+    threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = entries.stats()
+    assert stats['hits'] + stats['misses'] == 4 * lookups
+    assert stats['entries'] <= 64
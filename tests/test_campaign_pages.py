@@ -0,0 +1,64 @@
+import pytest
+
+import campaign_pages
+import migrations
+import storage
+
+def make_db(tmp_path):
+    conn = storage.connect(str(tmp_path / 'tracking.db'))
+    migrations.migrate(conn, migrations.TRACKING_MIGRATIONS)
+    return conn
+
+def insert_opens(conn, campaign_id, timestamps):
+    conn.executemany('INSERT INTO pixel_tracks (campaign_id, recipient, timestamp) VALUES (?, ?, ?)',
+                     [(campaign_id, 'r{}@example.com'.format(i), timestamp) for i, timestamp in enumerate(timestamps)])
+    conn.commit()
+
+def all_pages(conn, campaign_id, page_size):
+    rows, cursor, pages = [], None, 0
+    while True:
+        page, cursor = campaign_pages.fetch_page(conn, campaign_id, cursor, page_size)
+        assert len(page) <= page_size
+        rows.extend(page)
+        pages += 1
+        if cursor is None:
+            return rows, pages
+
+# Runs of equal timestamps longer than the page sizes below, plus opens without one
+TIMESTAMPS = (['2024-03-01 10:00:00.000000'] * 9 + ['2024-03-01 09:00:00.000000'] * 4 +
+              [None] * 5 + ['2024-03-01 11:00:00.000000'] * 3 + [None, '2024-03-01 09:00:00.000000'])
+
+def expected_order(conn, campaign_id):
+    rows = conn.execute('SELECT id, timestamp FROM pixel_tracks WHERE campaign_id = ?', (campaign_id,)).fetchall()
+    stamped = sorted((row for row in rows if row[1] is not None), key=lambda row: (row[1], row[0]), reverse=True)
+    unstamped = sorted((row for row in rows if row[1] is None), reverse=True)
+    return [row[0] for row in stamped + unstamped]
+
+@pytest.mark.parametrize('page_size', [1, 2, 3, 4, 7, len(TIMESTAMPS), 100])
+def test_pages_cover_every_open_once_across_equal_timestamps(tmp_path, page_size):
+    conn = make_db(tmp_path)
+    try:
+        insert_opens(conn, 'spring', TIMESTAMPS)
+        insert_opens(conn, 'autumn', TIMESTAMPS[:5])
+        rows, pages = all_pages(conn, 'spring', page_size)
+        assert [row['id'] for row in rows] == expected_order(conn, 'spring')
+        assert pages == max(1, -(-len(TIMESTAMPS) // page_size))
+    finally:
+        conn.close()
+
+def test_empty_campaign_has_one_empty_page(tmp_path):
+    conn = make_db(tmp_path)
+    try:
+        assert campaign_pages.fetch_page(conn, 'missing') == ([], None)
+    finally:
+        conn.close()
+
+def test_cursor_round_trip():
+    for timestamp, track_id in (('2024-03-01 10:00:00.000000', 7), (None, 2 ** 40)):
+        cursor = campaign_pages.encode_cursor(timestamp, track_id)
+        assert campaign_pages.decode_cursor(cursor) == (timestamp, track_id)
+
+@pytest.mark.parametrize('cursor', ['not a cursor', 'bnVsbA==', campaign_pages.encode_cursor('2024', 'x')])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        campaign_pages.decode_cursor(cursor)
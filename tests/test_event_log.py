@@ -0,0 +1,115 @@
+import gzip
+import json
+import os
+
+import pytest
+
+import event_log
+import migrations
+import storage
+import tracking_hits
+import tracking_tokens
+
+BROWSER = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/124.0 Safari/537.36'
+CRAWLER = 'python-requests/2.31.0'
+
+# 2024-05-01 10:00:00 UTC
+START = 1714557600.0
+
+def query(campaign_id, recipient):
+    return 'campaign_id={}&sender=s%40example.com&recipient={}'.format(campaign_id, recipient.replace('@', '%40'))
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracking_tokens, '_key', b'test secret')
+    db_path = str(tmp_path / 'tracking.db')
+    migrations.migrate_tracking_db(db_path)
+    return db_path
+
+def log_hits(log_dir, hits, **handler_options):
+    log = event_log.EventLog(log_dir, **handler_options)
+    log.start()
+    for hit_item in hits:
+        log.log(dict(zip(tracking_hits.HIT_FIELDS, hit_item)))
+    log.stop()
+    return event_log.list_segments(log_dir)
+
+def stored(db_path):
+    conn = storage.connect(db_path)
+    try:
+        return conn.execute('SELECT campaign_id, recipient, timestamp, device_info FROM pixel_tracks '
+                            'ORDER BY timestamp, recipient').fetchall()
+    finally:
+        conn.close()
+
+def test_replay_rotated_segments_into_a_fresh_database(tmp_path, db_path):
+    token = tracking_tokens.issue_tokens('autumn', 's@example.com', ['t@example.com'], db_path)['t@example.com']
+    hits = []
+    for i in range(200):
+        hits.append((START + i * 90, query('spring', 'r{}@example.com'.format(i % 50)), BROWSER, '203.0.113.1'))
+    hits += [
+        # Logged out of order by another worker: a repeat within the dedupe
+        # window, a prefetch, a forged token and a token hit
+        (START + 30, query('spring', 'r0@example.com'), BROWSER, '203.0.113.1'),
+        (START + 40, query('spring', 'new@example.com'), CRAWLER, '203.0.113.1'),
+        (START + 50, 't=AAAAAAAAAAAAAAAA', BROWSER, '203.0.113.1'),
+        (START + 60, 't=' + token, BROWSER, '66.102.1.1'),
+    ]
+    log_dir = str(tmp_path / 'events')
+    segments = log_hits(log_dir, hits, max_bytes=2048, interval=0, backup_count=0)
+
+    assert len(segments) > 3 and all(path.endswith('.gz') for path in segments)
+    assert sorted(os.listdir(log_dir)) == sorted(os.path.basename(path) for path in segments)
+    with gzip.open(segments[0], 'rb') as f:
+        first = json.loads(f.readline().decode('utf-8'))
+    assert tracking_hits.hit_item_of(first) == hits[0]
+
+    counts = event_log.replay(segments, db_path)
+    assert counts == {'read': 204, 'skipped': 2, 'present': 0, 'duplicate': 1, 'written': 201}
+    rows = stored(db_path)
+    assert len(rows) == 201
+    assert ('autumn', 't@example.com', '2024-05-01 10:01:00.000000', 'Proxy') in rows
+    assert ('spring', 'r0@example.com', '2024-05-01 10:00:00.000000', 'Desktop') in rows
+    assert not any(recipient == 'new@example.com' for _, recipient, _, _ in rows)
+
+    # Replaying again, or with only part of the hits lost, never stores a hit twice
+    assert event_log.replay(segments, db_path)['written'] == 0
+    conn = storage.connect(db_path)
+    try:
+        conn.execute("DELETE FROM pixel_events WHERE id IN (SELECT id FROM pixel_tracks WHERE recipient = 'r7@example.com')")
+        conn.commit()
+    finally:
+        conn.close()
+    counts = event_log.replay(segments, db_path)
+    assert (counts['written'], counts['present']) == (4, 197)
+    assert stored(db_path) == rows
+
+def test_replay_collapses_repeats_of_hits_already_stored(tmp_path, db_path):
+    # A repeat open logged by one worker while another worker stored the first
+    segments = log_hits(str(tmp_path / 'events'), [
+        (START + 20, query('spring', 'a@example.com'), BROWSER, '203.0.113.1'),
+        (START + 500, query('spring', 'a@example.com'), BROWSER, '203.0.113.1'),
+    ], interval=0)
+    conn = storage.connect(db_path)
+    try:
+        conn.execute("INSERT INTO pixel_tracks (campaign_id, sender_email, recipient, timestamp) "
+                     "VALUES ('spring', 's@example.com', 'a@example.com', '2024-05-01 10:00:00.000000')")
+        conn.commit()
+    finally:
+        conn.close()
+
+    counts = event_log.replay(segments, db_path)
+    assert (counts['duplicate'], counts['written']) == (1, 1)
+    assert [row[2] for row in stored(db_path)] == ['2024-05-01 10:00:00.000000', '2024-05-01 10:08:20.000000']
+
+def test_replay_reads_segments_of_classified_hits(tmp_path, db_path):
+    path = str(tmp_path / 'pixel_events.20240501T100000-000000.1.ndjson')
+    with open(path, 'w') as f:
+        f.write(json.dumps({'campaign_id': 'spring', 'sender_email': 's@example.com', 'recipient': 'a@example.com',
+                            'timestamp': '2024-05-01 10:00:00.000000', 'device_info': 'Desktop', 'stored': True}))
+        f.write('\n' + json.dumps({'campaign_id': 'spring', 'recipient': 'b@example.com',
+                                   'timestamp': '2024-05-01 10:00:00.000000', 'stored': False}))
+        f.write('\n{"cut off by a cra')
+    counts = event_log.replay([path], db_path)
+    assert (counts['read'], counts['skipped'], counts['written']) == (2, 1, 1)
+    assert stored(db_path) == [('spring', 'a@example.com', '2024-05-01 10:00:00.000000', 'Desktop')]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+import export
+import migrations
+import storage
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = storage.connect(str(tmp_path / 'tracking.db'))
+    migrations.migrate(conn, migrations.TRACKING_MIGRATIONS)
+    rows = [(campaign_id, 'sender@example.com', u'r{}@exämple.com'.format(i), '2024-03-01 10:00:{:02d}.000000'.format(i % 60),
+             'Mozilla/5.0 "quoted", comma', '10.0.0.{}'.format(i % 256), None if i % 3 else 'Desktop', u'Zürich\nline')
+            for i in range(53) for campaign_id in ('spring', 'autumn')]
+    conn.executemany('INSERT INTO pixel_tracks (campaign_id, sender_email, recipient, timestamp, user_agent, '
+                     'ip_address, device_info, location) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    yield conn
+    conn.close()
+
+def query(conn, campaign_id):
+    sql = 'SELECT {} FROM pixel_tracks'.format(', '.join(export.EXPORT_COLUMNS))
+    if campaign_id is None:
+        return conn.execute(sql).fetchall()
+    return conn.execute(sql + ' WHERE campaign_id = ?', (campaign_id,)).fetchall()
+
+def as_text(value):
+    return u'' if value is None else u'{}'.format(value)
+
+@pytest.mark.parametrize('campaign_id', ['spring', None])
+@pytest.mark.parametrize('batch_size', [1, 7, 1000])
+def test_streamed_csv_matches_query(conn, campaign_id, batch_size):
+    stats = {}
+    output = ''.join(export.iter_export(conn, campaign_id, 'csv', batch_size=batch_size, stats=stats))
+    expected = query(conn, campaign_id)
+    assert stats['rows'] == len(expected)
+    parsed = list(csv.reader(io.StringIO(output, newline='')))
+    assert parsed[0] == list(export.EXPORT_COLUMNS)
+    assert parsed[1:] == [[as_text(value) for value in row] for row in expected]
+
+@pytest.mark.parametrize('campaign_id', ['spring', None])
+@pytest.mark.parametrize('batch_size', [1, 7, 1000])
+def test_streamed_ndjson_matches_query(conn, campaign_id, batch_size):
+    output = ''.join(export.iter_export(conn, campaign_id, 'ndjson', batch_size=batch_size))
+    expected = query(conn, campaign_id)
+    assert output.endswith('\n')
+    assert [json.loads(line) for line in output.splitlines()] == [dict(zip(export.EXPORT_COLUMNS, row))
+                                                                  for row in expected]
+
+@pytest.mark.parametrize('fmt', sorted(export.EXPORT_FORMATS))
+def test_gzip_export_decompresses_to_plain_export(conn, fmt):
+    plain = ''.join(export.iter_export(conn, 'spring', fmt, batch_size=7))
+    compressed = b''.join(export.iter_export(conn, 'spring', fmt, compress=True, batch_size=7))
+    assert gzip.decompress(compressed).decode('utf-8') == plain
+
+def test_unknown_format(conn):
+    with pytest.raises(ValueError):
+        export.iter_export(conn, 'spring', 'xml')
@@ -0,0 +1,84 @@
+import pytest
+
+import hll
+import migrations
+import storage
+from hll import HyperLogLog
+from tracking_writer import TrackingWriter
+
+def sketch_of(values):
+    sketch = HyperLogLog()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+def assert_close(estimate, exact, sketch):
+    assert abs(estimate - exact) <= 3 * sketch.error_bound() * exact
+
+@pytest.mark.parametrize('exact', [100, 10000, 200000])
+def test_count_within_error_bound(exact):
+    sketch = sketch_of('r{}@example.com'.format(i) for i in range(exact))
+    assert_close(sketch.count(), exact, sketch)
+
+def test_small_counts_are_close_to_exact():
+    sketch = sketch_of(['a@example.com', 'b@example.com', 'a@example.com'])
+    assert sketch.count() == 2
+
+def test_merge_and_union_estimate_the_union():
+    first = sketch_of('r{}@example.com'.format(i) for i in range(0, 30000))
+    second = sketch_of('r{}@example.com'.format(i) for i in range(20000, 50000))
+    third = sketch_of('r{}@example.com'.format(i) for i in range(45000, 60000))
+
+    union = HyperLogLog.union([first, second, third])
+    assert_close(union.count(), 60000, union)
+
+    merged = HyperLogLog.from_bytes(first.to_bytes()).merge(second).merge(third)
+    assert merged.registers == union.registers
+
+def test_merge_rejects_other_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(10))
+
+def test_writer_updates_rollups_and_sketches(tmp_path):
+    db_path = str(tmp_path / 'tracking.db')
+    migrations.migrate_tracking_db(db_path)
+    writer = TrackingWriter(db_path, sketches=True)
+
+    def hits(campaign_id, recipients, day):
+        return [(campaign_id, 'sender{}@example.com'.format(i % 3), 'r{}@example.com'.format(i),
+                 '2024-05-{} 10:{:02d}:00.000000'.format(day, i % 60), None, None, None, None)
+                for i in recipients]
+
+    # Repeat opens and recipients spread over two batches and two days
+    assert writer.write(hits('spring', range(0, 3000), '01')) == 3000
+    assert writer.write(hits('spring', range(2000, 5000), '02') + hits('autumn', range(0, 50), '02')) == 3050
+    writer.close()
+
+    conn = storage.connect(db_path)
+    try:
+        exact = dict(conn.execute('SELECT campaign_id, COUNT(DISTINCT recipient) FROM pixel_tracks '
+                                  'GROUP BY campaign_id'))
+        assert exact == {'spring': 5000, 'autumn': 50}
+
+        rollups = dict(((campaign_id, sender), (unique, opens)) for campaign_id, sender, unique, opens in conn.execute(
+            'SELECT campaign_id, sender_email, unique_recipients, total_opens FROM campaign_rollups'))
+        assert rollups[('spring', '*')] == (5000, 6000)
+        assert rollups[('autumn', '*')] == (50, 50)
+        for (campaign_id, sender), (unique, opens) in rollups.items():
+            if sender == '*':
+                continue
+            assert (unique, opens) == conn.execute(
+                'SELECT COUNT(DISTINCT recipient), COUNT(*) FROM pixel_tracks '
+                'WHERE campaign_id = ? AND sender_email = ?', (campaign_id, sender)).fetchone()
+
+        estimates = hll.campaign_estimates(conn)
+        for campaign_id, count in exact.items():
+            assert_close(estimates[campaign_id], count, HyperLogLog())
+
+        day = hll.estimate_unique(conn, campaign_id='spring', start_day='2024-05-02', end_day='2024-05-02')
+        assert_close(day.count(), 3000, day)
+
+        opens = conn.execute("SELECT SUM(opens) FROM open_buckets WHERE campaign_id = 'spring'").fetchone()[0]
+        assert opens == 6000
+    finally:
+        conn.close()
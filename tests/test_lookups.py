@@ -0,0 +1,102 @@
+import pytest
+
+import lookups
+import migrations
+import rollups
+import storage
+from tracking_writer import TrackingWriter
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / 'tracking.db')
+    migrations.migrate_tracking_db(db_path)
+    return db_path
+
+def test_inserts_through_the_view_intern_their_strings(db_path):
+    conn = storage.connect(db_path)
+    try:
+        rows = [('ignored-1', 'spring', 's@example.com', 'a@example.com', '2024-05-01 10:00:00.000000',
+                 'Mozilla/5.0', '10.0.0.1', 'Desktop', 'Pune', None),
+                ('ignored-2', 'spring', 's@example.com', 'b@example.com', '2024-05-01 10:01:00.000000',
+                 'Mozilla/5.0', None, None, None, None),
+                (None, 'autumn', None, 'a@example.com', None, None, None, None, None, None)]
+        conn.executemany('INSERT INTO pixel_tracks ({}) VALUES ({})'.format(
+            ', '.join(lookups.VIEW_COLUMNS), ', '.join('?' for _ in lookups.VIEW_COLUMNS)), rows)
+        conn.commit()
+
+        stored = conn.execute('SELECT * FROM pixel_tracks ORDER BY id').fetchall()
+        assert [row[0] for row in stored] == [1, 2, 3]
+        assert [row[1:] for row in stored] == [row[1:] for row in rows]
+
+        counts = dict((table, conn.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0])
+                      for table, _ in lookups.LOOKUPS.values())
+        assert counts == {'campaigns': 2, 'senders': 1, 'recipients': 2, 'user_agents': 1, 'devices': 1}
+        assert conn.execute('SELECT sender_ref, user_agent_ref, device_ref FROM pixel_events WHERE id = 3').fetchone() \
+            == (None, None, None)
+    finally:
+        conn.close()
+
+def test_failed_write_does_not_keep_interned_ids(db_path, monkeypatch):
+    writer = TrackingWriter(db_path)
+
+    def hit(campaign_id, recipient):
+        return (campaign_id, 's@example.com', recipient, '2024-05-01 10:00:00.000000', 'Mozilla/5.0', None, None, None)
+
+    def fail(conn, hits):
+        raise RuntimeError('disk full')
+    monkeypatch.setattr(rollups, 'update_rollups', fail)
+    assert writer.write([hit('spring', 'new@example.com')]) == 0
+    for column in lookups.LOOKUPS:
+        assert writer.interner.caches[column].stats()['entries'] == 0
+    monkeypatch.undo()
+
+    conn = storage.connect(db_path)
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM recipients').fetchone()[0] == 0
+        # Another writer takes the ids the failed batch would have used
+        conn.execute("INSERT INTO pixel_tracks (campaign_id, recipient) VALUES ('autumn', 'other@example.com')")
+        conn.commit()
+
+        assert writer.write([hit('spring', 'new@example.com')]) == 1
+        writer.close()
+        assert conn.execute('SELECT campaign_id, sender_email, recipient FROM pixel_tracks ORDER BY id').fetchall() == [
+            ('autumn', None, 'other@example.com'), ('spring', 's@example.com', 'new@example.com')]
+    finally:
+        conn.close()
+
+LEGACY_COLUMNS = ('id', 'campaign_id', 'sender_email', 'recipient', 'timestamp', 'user_agent', 'ip_address',
+                  'device_info', 'location', 'delivery_id')
+
+def test_migrating_a_populated_legacy_table(tmp_path):
+    conn = storage.connect(str(tmp_path / 'legacy.db'))
+    try:
+        legacy = [m for m in migrations.TRACKING_MIGRATIONS if m[0] < 10]
+        migrations.migrate(conn, legacy)
+        conn.execute("INSERT INTO deliveries (campaign_id, sender_email, recipient) "
+                     "VALUES ('spring', 's@example.com', 'r1@example.com')")
+        rows = [('uuid-{}'.format(i), ('spring', 'autumn')[i % 2], 's{}@example.com'.format(i % 3),
+                 'r{}@example.com'.format(i % 7), '2024-05-01 10:{:02d}:00.000000'.format((i * 37) % 60),
+                 'UA {}'.format(i % 4), '10.0.0.{}'.format(i), (None, 'Mobile', 'Desktop')[i % 3], 'Pune',
+                 1 if i == 5 else None)
+                for i in range(60)]
+        rows.append(('uuid-null', None, None, None, None, None, None, None, None, None))
+        conn.executemany('INSERT INTO pixel_tracks ({}) VALUES ({})'.format(
+            ', '.join(LEGACY_COLUMNS), ', '.join('?' for _ in LEGACY_COLUMNS)), rows)
+        rollups.rebuild_tables(conn)
+        conn.commit()
+        legacy_rollups = conn.execute('SELECT * FROM campaign_rollups ORDER BY 1, 2').fetchall()
+
+        migrations.migrate(conn, migrations.TRACKING_MIGRATIONS)
+        migrations.check_query_plans(conn, migrations.TRACKING_QUERY_PLANS)
+
+        migrated = conn.execute('SELECT * FROM pixel_tracks ORDER BY id').fetchall()
+        assert [row[0] for row in migrated] == list(range(1, len(rows) + 1))
+        assert sorted((row[1:] for row in migrated), key=repr) == sorted((row[1:] for row in rows), key=repr)
+        # Ids follow time, with the untimed row first as NULL sorts lowest
+        timestamps = [row[4] for row in migrated]
+        assert timestamps[0] is None and timestamps[1:] == sorted(timestamps[1:])
+        assert conn.execute('SELECT COUNT(*) FROM recipients').fetchone()[0] == 7
+        assert conn.execute("SELECT type FROM sqlite_master WHERE name = 'pixel_tracks'").fetchone() == ('view',)
+        assert conn.execute('SELECT * FROM campaign_rollups ORDER BY 1, 2').fetchall() == legacy_rollups
+    finally:
+        conn.close()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import email
+import threading
+from email.header import decode_header
+
+import mailer
+from benchmarks import SMTPSink
+from mailer import EmailSender
+
+def send(sink, email_list):
+    sender = EmailSender('sender@example.com', 'secret', max_workers=2, smtp_host='127.0.0.1',
+                         smtp_port=sink.server_address[1], use_tls=False)
+    return sender.send_emails_threaded(email_list)
+
+def received(sink):
+    return [email.message_from_bytes(data) for data in sink.messages]
+
+def subject_of(message):
+    return ''.join(text.decode(charset or 'ascii') if isinstance(text, bytes) else text
+                   for text, charset in decode_header(message['Subject']))
+
+def html_of(message):
+    part = message.get_payload()[0]
+    return part.get_payload(decode=True).decode(part.get_content_charset())
+
+def test_non_ascii_merge_value_in_ascii_template():
+    with SMTPSink(keep_messages=True) as sink:
+        summary = send(sink, [
+            ('jose@example.com', 'Hello {{first_name}}', '<p>Hi {{first_name}}</p>', None, None,
+             {'first_name': u'José'}),
+            ('ann@example.com', 'Hello {{first_name}}', '<p>Hi {{first_name}}</p>', None, None,
+             {'first_name': u'Ann'}),
+        ])
+
+    assert (summary.sent, summary.failed) == (2, 0)
+    messages = dict((message['To'], message) for message in received(sink))
+    assert subject_of(messages['jose@example.com']) == u'Hello José'
+    assert html_of(messages['jose@example.com']) == u'<p>Hi José</p>'
+    assert messages['ann@example.com']['Subject'] == 'Hello Ann'
+    assert html_of(messages['ann@example.com']) == u'<p>Hi Ann</p>'
+
+def test_merge_tag_in_non_ascii_subject():
+    with SMTPSink(keep_messages=True) as sink:
+        summary = send(sink, [
+            ('ann@example.com', u'Café offer for {{first_name}}', u'<p>Grüße {{first_name}}</p>', None, None,
+             {'first_name': u'Ann'}),
+        ])
+
+    assert (summary.sent, summary.failed) == (1, 0)
+    message, = received(sink)
+    assert subject_of(message) == u'Café offer for Ann'
+    assert html_of(message) == u'<p>Grüße Ann</p>'
+
+def test_attachments_over_cache_cap_are_encoded_per_message(tmp_path):
+    small = tmp_path / 'small.txt'
+    small.write_bytes(b'a' * 100)
+    large = tmp_path / 'large.bin'
+    large.write_bytes(b'b' * 4096)
+    attachments = [str(small), str(large)]
+
+    with SMTPSink(keep_messages=True) as sink:
+        sender = EmailSender('sender@example.com', 'secret', max_workers=2, smtp_host='127.0.0.1',
+                             smtp_port=sink.server_address[1], use_tls=False, attachment_cache_bytes=1024)
+        template = sender.get_template('Hello', '<p>Hi</p>', attachments)
+        kept = ''.join(chunk for chunk in template.tail if not callable(chunk))
+        assert 'small.txt' in kept and 'large.bin' not in kept
+        assert len([chunk for chunk in template.tail if callable(chunk)]) == 1
+
+        summary = sender.send_emails_threaded([
+            ('user{}@example.com'.format(i), 'Hello', '<p>Hi</p>', None, attachments) for i in range(3)])
+
+    assert (summary.sent, summary.failed) == (3, 0)
+    for message in received(sink):
+        payloads = [part.get_payload(decode=True) for part in message.get_payload()[1:]]
+        assert payloads == [b'a' * 100, b'b' * 4096]
+
+def numbered_emails(count):
+    return [('user{}@example.com'.format(i), 'Hello', '<p>Hi</p>', None, None) for i in range(count)]
+
+def test_results_keep_submission_order_and_count_failures():
+    emails = numbered_emails(200)
+    rejected = set(email[0] for email in emails[::7])
+    with SMTPSink(latency=0.0005, rejected=rejected) as sink:
+        sender = EmailSender('sender@example.com', 'secret', max_workers=8, smtp_host='127.0.0.1',
+                             smtp_port=sink.server_address[1], use_tls=False)
+        summary = sender.send_emails_threaded(iter(emails))
+        delivered = sink.message_count
+
+    assert [result.recipient for result in summary.results] == [email[0] for email in emails]
+    assert [not result.success for result in summary.results] == [email[0] in rejected for email in emails]
+    assert (summary.sent, summary.failed) == (200 - len(rejected), len(rejected))
+    assert delivered == summary.sent
+
+def test_stop_leaves_no_phantom_successes():
+    emails = numbered_emails(3000)
+    with SMTPSink(latency=0.001) as sink:
+        sender = EmailSender('sender@example.com', 'secret', max_workers=4, smtp_host='127.0.0.1',
+                             smtp_port=sink.server_address[1], use_tls=False)
+        timer = threading.Timer(0.3, setattr, (mailer, 'STOP_THREADS', True))
+        timer.start()
+        try:
+            summary = sender.send_emails_threaded(iter(emails))
+        finally:
+            timer.join()
+            mailer.STOP_THREADS = False
+        delivered = sink.message_count
+
+    assert 0 < summary.sent < len(emails)
+    assert summary.sent == delivered
+    assert summary.total == len(summary.results)
+    assert [result.recipient for result in summary.results] == [email[0] for email in emails[:summary.total]]
+    assert [result.success for result in summary.results].count(True) == summary.sent
+
+def test_submit_emails_completes_the_future():
+    finished = []
+    with SMTPSink() as sink:
+        sender = EmailSender('sender@example.com', 'secret', max_workers=2, smtp_host='127.0.0.1',
+                             smtp_port=sink.server_address[1], use_tls=False)
+        future = sender.submit_emails(numbered_emails(10), callback=finished.append)
+        summary = future.result(timeout=30)
+
+    assert future.done() and finished == [future]
+    assert (summary.sent, summary.failed, len(summary.results)) == (10, 0, 10)
@@ -0,0 +1,89 @@
+import sqlite3
+import threading
+
+import pytest
+
+import migrations
+import storage
+
+def connect(db_path, busy_timeout_ms=50):
+    conn = storage.connect(str(db_path), check_same_thread=False)
+    conn.execute('PRAGMA busy_timeout = {}'.format(busy_timeout_ms))
+    return conn
+
+def hold_write_lock(db_path):
+    conn = connect(db_path)
+    conn.isolation_level = None
+    conn.execute('BEGIN IMMEDIATE')
+    return conn
+
+def test_migrate_waits_for_a_migration_in_another_process(tmp_path):
+    db_path = tmp_path / 'tracking.db'
+    holder = hold_write_lock(db_path)
+    release = threading.Timer(0.5, holder.execute, ('COMMIT',))
+    release.start()
+
+    conn = connect(db_path)
+    try:
+        assert migrations.migrate(conn, migrations.TRACKING_MIGRATIONS) == migrations.TRACKING_MIGRATIONS[-1][0]
+    finally:
+        release.join()
+        conn.close()
+        holder.close()
+
+def test_begin_immediate_gives_up_after_timeout(tmp_path):
+    db_path = tmp_path / 'tracking.db'
+    holder = hold_write_lock(db_path)
+    conn = connect(db_path)
+    conn.isolation_level = None
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            migrations.begin_immediate(conn, timeout=0.2)
+    finally:
+        conn.close()
+        holder.execute('ROLLBACK')
+        holder.close()
+
+LEGACY_ROWS = [
+    ('a1', 'spring', '2024-03-01 10:00:00.000000'),
+    ('a2', 'spring', '2024-03-01 09:00:00.000000'),
+    ('a3', 'autumn', '2024-09-01 12:00:00.000000'),
+]
+
+def test_query_plans_on_fresh_databases(tmp_path):
+    for migration_list, query_plans in ((migrations.TRACKING_MIGRATIONS, migrations.TRACKING_QUERY_PLANS),
+                                        (migrations.MAILER_MIGRATIONS, migrations.MAILER_QUERY_PLANS)):
+        conn = connect(tmp_path / 'fresh.db')
+        try:
+            migrations.migrate(conn, migration_list)
+            migrations.check_query_plans(conn, query_plans)
+        finally:
+            conn.close()
+        (tmp_path / 'fresh.db').unlink()
+
+def test_query_plans_on_legacy_tracking_database(tmp_path):
+    # Tracking databases created before migrations existed had fewer columns
+    conn = connect(tmp_path / 'legacy.db')
+    try:
+        conn.execute('CREATE TABLE pixel_tracks (id VARCHAR NOT NULL PRIMARY KEY, campaign_id VARCHAR, '
+                     'timestamp DATETIME)')
+        conn.executemany('INSERT INTO pixel_tracks (id, campaign_id, timestamp) VALUES (?, ?, ?)', LEGACY_ROWS)
+        conn.commit()
+
+        migrations.migrate(conn, migrations.TRACKING_MIGRATIONS)
+        migrations.check_query_plans(conn, migrations.TRACKING_QUERY_PLANS)
+        rows = conn.execute('SELECT campaign_id, timestamp FROM pixel_tracks ORDER BY id').fetchall()
+        assert rows == sorted([(campaign, timestamp) for _, campaign, timestamp in LEGACY_ROWS],
+                              key=lambda row: row[1])
+    finally:
+        conn.close()
+
+def test_check_query_plans_raises_when_an_index_is_missing(tmp_path):
+    conn = connect(tmp_path / 'tracking.db')
+    try:
+        migrations.migrate(conn, migrations.TRACKING_MIGRATIONS)
+        conn.execute('DROP INDEX ix_pixel_events_timestamp')
+        with pytest.raises(RuntimeError):
+            migrations.check_query_plans(conn, migrations.TRACKING_QUERY_PLANS)
+    finally:
+        conn.close()
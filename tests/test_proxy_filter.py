@@ -0,0 +1,116 @@
+import pytest
+
+import migrations
+import proxy_filter
+import storage
+from tracking_writer import TrackingWriter
+from user_agents import UserAgent
+
+PERSON = UserAgent('Desktop', 'Windows', 'Outlook', False, False)
+CRAWLER = UserAgent('Bot', 'Unknown', 'Unknown', True, False)
+GMAIL = UserAgent('Proxy', 'Unknown', 'Gmail', False, True)
+
+def test_prefix_index_picks_the_most_specific_network():
+    index = proxy_filter.PrefixIndex()
+    index.add('10.0.0.0/8', 'wide')
+    index.add('10.1.0.0/16', 'narrow')
+    index.add('10.1.2.3', 'host')
+    index.add('2001:db8::/32', 'v6')
+    assert len(index) == 4
+    assert index.lookup('10.200.0.1') == 'wide'
+    assert index.lookup('10.1.9.9') == 'narrow'
+    assert index.lookup('10.1.2.3') == 'host'
+    assert index.lookup('::ffff:10.1.2.3') == 'host'
+    assert index.lookup('2001:db8:1::1') == 'v6'
+    assert index.lookup('2001:db9::1') is None
+    assert index.lookup('11.0.0.1') is None
+    for address in ('', None, 'not an address', '10.0.0.256'):
+        assert index.lookup(address) is None
+
+@pytest.mark.parametrize('cidr', ['10.0.0.0/33', '2001:db8::/129', 'bogus/8'])
+def test_prefix_index_rejects_invalid_networks(cidr):
+    with pytest.raises(ValueError):
+        proxy_filter.PrefixIndex().add(cidr, 'x')
+
+def test_load_ranges_reads_our_format_and_apples(tmp_path):
+    path = tmp_path / 'egress-ip-ranges.csv'
+    path.write_text(u'# comment\n172.224.224.0/27,GB,GB-EN,London,\n'
+                    u'192.0.2.0/24,prefetch,Scanner\nnot-a-network,proxy\n\n')
+    index = proxy_filter.PrefixIndex()
+    assert proxy_filter.load_ranges(index, str(path)) == 2
+    assert index.lookup('172.224.224.5') == (proxy_filter.PROXY, 'egress-ip-ranges')
+    assert index.lookup('192.0.2.7') == (proxy_filter.PREFETCH, 'Scanner')
+
+def test_default_ranges_are_labelled():
+    hit_filter = proxy_filter.HitFilter(index=proxy_filter.build_index([]))
+    assert hit_filter.classify(PERSON, '66.102.1.1') == (proxy_filter.PROXY, 'Gmail')
+    assert hit_filter.classify(PERSON, '17.1.2.3') == (proxy_filter.PROXY, 'Apple')
+    assert hit_filter.classify(PERSON, '40.92.1.1') == (proxy_filter.PREFETCH, 'Microsoft Safe Links')
+    assert hit_filter.classify(CRAWLER, '66.102.1.1') == (proxy_filter.PREFETCH, 'Unknown')
+    assert hit_filter.classify(GMAIL, '203.0.113.1') == (proxy_filter.PROXY, 'Gmail')
+    assert hit_filter.classify(PERSON, '203.0.113.1') == (proxy_filter.DIRECT, 'Outlook')
+
+def make_filter(mode, window=60):
+    return proxy_filter.HitFilter(index=proxy_filter.build_index([]), mode=mode, window=window)
+
+def test_collapse_mode_drops_prefetches_and_repeats_within_the_window():
+    hit_filter = make_filter(proxy_filter.COLLAPSE)
+    check = hit_filter.check
+    assert check('c', 's', 'r@example.com', PERSON, '203.0.113.1', now=1000).store
+    assert not check('c', 's', 'r@example.com', GMAIL, '66.102.1.1', now=1030).store
+    assert check('c', 's', 'other@example.com', PERSON, '203.0.113.1', now=1030).store
+    assert check('other', 's', 'r@example.com', PERSON, '203.0.113.1', now=1030).store
+    assert check('c', 's', 'r@example.com', PERSON, '203.0.113.1', now=1061).store
+    prefetch = check('c', 's', 'new@example.com', CRAWLER, '203.0.113.1', now=1070)
+    assert (prefetch.kind, prefetch.device_info, prefetch.store) == (proxy_filter.PREFETCH, 'Bot', False)
+    # Hits without a known recipient are never collapsed
+    assert check('c', 's', 'unknown', PERSON, '203.0.113.1', now=1080).store
+    assert check('c', 's', 'unknown', PERSON, '203.0.113.1', now=1080).store
+
+    stats = hit_filter.stats()
+    assert (stats['duplicate'], stats['stored'], stats[proxy_filter.PREFETCH]) == (1, 6, 1)
+    assert hit_filter.dedupe_window == 60
+
+def test_tag_mode_stores_every_hit_with_its_kind():
+    hit_filter = make_filter(proxy_filter.TAG)
+    hits = [hit_filter.check('c', 's', 'r@example.com', agent, address, now=1000)
+            for agent, address in ((PERSON, '203.0.113.1'), (GMAIL, '66.102.1.1'), (CRAWLER, '203.0.113.1'))]
+    assert [(hit.device_info, hit.store) for hit in hits] == [('Desktop', True), ('Proxy', True), ('Bot', True)]
+    assert hit_filter.stats()['duplicate'] == 0
+    assert hit_filter.dedupe_window == 0
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        make_filter('drop')
+
+def test_writers_in_separate_processes_store_one_hit_per_window(tmp_path):
+    db_path = str(tmp_path / 'tracking.db')
+    migrations.migrate_tracking_db(db_path)
+    # Each writer stands in for a tracker process with its own HitFilter
+    writers = [TrackingWriter(db_path, dedupe_window=60) for _ in range(2)]
+
+    def hit(recipient, second, sender='s@example.com'):
+        return ('spring', sender, recipient, '2024-05-01 10:{:02d}:{:02d}.000000'.format(*divmod(second, 60)),
+                None, None, None, None)
+
+    assert writers[0].write([hit('a@example.com', 100), hit('b@example.com', 100)]) == 2
+    # Repeats seen by the other writer, including one captured earlier and one within its own batch
+    assert writers[1].write([hit('a@example.com', 130), hit('a@example.com', 45), hit('b@example.com', 161),
+                             hit('b@example.com', 170), hit('a@example.com', 100, 'other@example.com'),
+                             hit('unknown', 100), hit('unknown', 100)]) == 4
+    assert writers[0].write([hit('a@example.com', 39)]) == 1
+    assert [writer.duplicate_count for writer in writers] == [0, 3]
+    for writer in writers:
+        writer.close()
+
+    conn = storage.connect(db_path)
+    try:
+        stored = conn.execute('SELECT recipient, sender_email, timestamp FROM pixel_tracks '
+                              'ORDER BY recipient, timestamp').fetchall()
+        assert [(recipient, timestamp[14:19]) for recipient, _, timestamp in stored] == [
+            ('a@example.com', '00:39'), ('a@example.com', '01:40'), ('a@example.com', '01:40'),
+            ('b@example.com', '01:40'), ('b@example.com', '02:41'), ('unknown', '01:40'), ('unknown', '01:40')]
+        assert conn.execute("SELECT total_opens FROM campaign_rollups WHERE campaign_id = 'spring' "
+                            "AND sender_email = '*'").fetchone()[0] == len(stored)
+    finally:
+        conn.close()
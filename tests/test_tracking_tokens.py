@@ -0,0 +1,128 @@
+import functools
+import os
+import stat
+import threading
+
+import pytest
+
+import tracking_tokens
+from benchmarks import SMTPSink
+from mailer import EmailSender, PIXEL_TAG
+from test_mailer import html_of, received
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracking_tokens, '_key', b'test secret')
+    return str(tmp_path / 'tracking.db')
+
+def test_issue_tokens_records_each_delivery_once(db_path):
+    recipients = ['r{}@example.com'.format(i) for i in range(1200)]
+    tokens = tracking_tokens.issue_tokens('spring', 'sender@example.com', recipients, db_path)
+
+    assert sorted(tokens) == sorted(recipients)
+    ids = [tracking_tokens.verify_token(token) for token in tokens.values()]
+    assert None not in ids and len(set(ids)) == len(recipients)
+
+    again = tracking_tokens.issue_tokens('spring', 'sender@example.com', recipients[:10] + ['new@example.com'],
+                                         db_path)
+    assert all(again[recipient] == tokens[recipient] for recipient in recipients[:10])
+    assert tracking_tokens.issue_token('spring', 'sender@example.com', 'r5@example.com', db_path) == tokens['r5@example.com']
+
+    resolver = tracking_tokens.DeliveryResolver(db_path)
+    assert resolver.resolve(tracking_tokens.verify_token(again['new@example.com'])) == \
+        ('spring', 'sender@example.com', 'new@example.com')
+
+def test_campaign_issues_tokens_in_batches(db_path, monkeypatch):
+    calls = []
+    issue_tokens = functools.partial(tracking_tokens.issue_tokens, db_path=db_path)
+
+    def counting_issue_tokens(campaign_id, sender_email, recipients):
+        calls.append(len(recipients))
+        return issue_tokens(campaign_id, sender_email, recipients)
+    monkeypatch.setattr(tracking_tokens, 'issue_tokens', counting_issue_tokens)
+
+    recipients = ['r{}@example.com'.format(i) for i in range(20)]
+    with SMTPSink(keep_messages=True) as sink:
+        sender = EmailSender('sender@example.com', 'secret', max_workers=2, smtp_host='127.0.0.1',
+                             smtp_port=sink.server_address[1], use_tls=False)
+        summary = sender.send_emails_threaded(
+            [(recipient, 'Hello', '<p>Hi</p>' + PIXEL_TAG, 'spring', None) for recipient in recipients])
+
+    assert (summary.sent, summary.failed) == (20, 0)
+    assert calls == [20]
+    resolver = tracking_tokens.DeliveryResolver(db_path)
+    for message in received(sink):
+        token = html_of(message).split('/track?t=')[1].split('"')[0]
+        assert resolver.resolve(tracking_tokens.verify_token(token)) == ('spring', 'sender@example.com', message['To'])
+
+@pytest.fixture
+def key_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'tracking_secret.key')
+    monkeypatch.delenv('TRACKING_SECRET', raising=False)
+    monkeypatch.setattr(tracking_tokens, 'SECRET_PATH', path)
+    monkeypatch.setattr(tracking_tokens, '_key', None)
+    return path
+
+def test_concurrent_first_uses_share_one_complete_key(key_path):
+    barrier = threading.Barrier(16)
+    keys = []
+
+    def load():
+        barrier.wait()
+        keys.append(tracking_tokens._load_key(key_path))
+
+    threads = [threading.Thread(target=load) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(keys) == 16 and len(set(keys)) == 1
+    assert len(keys[0]) == tracking_tokens.KEY_LENGTH
+    assert tracking_tokens.get_key() == keys[0]
+    assert stat.S_IMODE(os.stat(key_path).st_mode) == 0o600
+    assert os.listdir(os.path.dirname(key_path)) == ['tracking_secret.key']
+
+@pytest.mark.parametrize('content', [b'', b'c2hvcnQ='])
+def test_empty_or_truncated_key_file_is_an_error(key_path, content):
+    with open(key_path, 'wb') as f:
+        f.write(content)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            tracking_tokens.get_key()
+    assert tracking_tokens._key is None
+
+def test_tokens_only_for_templates_with_a_pixel_and_once_per_recipient(db_path, monkeypatch):
+    calls = []
+    issue_tokens = functools.partial(tracking_tokens.issue_tokens, db_path=db_path)
+
+    def recording_issue_tokens(campaign_id, sender_email, recipients):
+        calls.append((campaign_id, list(recipients)))
+        return issue_tokens(campaign_id, sender_email, recipients)
+    monkeypatch.setattr(tracking_tokens, 'issue_tokens', recording_issue_tokens)
+
+    tracked = '<p>Hi</p>' + PIXEL_TAG
+    emails = [('a@example.com', 'Hello', tracked, 'spring', None),
+              ('b@example.com', 'Hello', '<p>No pixel</p>', 'spring', None),
+              ('a@example.com', 'Hello', tracked, 'spring', None),
+              ('c@example.com', 'Hello', tracked, 'spring', None, {'pixel_url': 'https://example.com/own.gif'}),
+              ('d@example.com', 'Hello', tracked, None, None),
+              ('b@example.com', 'Hello', '<p>No pixel</p>', 'autumn', None)]
+    with SMTPSink(keep_messages=True) as sink:
+        sender = EmailSender('sender@example.com', 'secret', max_workers=2, smtp_host='127.0.0.1',
+                             smtp_port=sink.server_address[1], use_tls=False)
+        summary = sender.send_emails_threaded(emails)
+        assert sender.build_message('e@example.com', 'Hello', '<p>No pixel</p>', campaign_id='spring')
+
+    assert (summary.sent, summary.failed) == (6, 0)
+    assert calls == [('spring', ['a@example.com'])]
+    resolver = tracking_tokens.DeliveryResolver(db_path)
+    urls = {}
+    for message in received(sink):
+        html = html_of(message)
+        urls.setdefault(message['To'], []).append(html.split('src="')[1].split('"')[0] if 'src="' in html else None)
+    assert len(set(urls['a@example.com'])) == 1
+    token = urls['a@example.com'][0].split('/track?t=')[1]
+    assert resolver.resolve(tracking_tokens.verify_token(token)) == ('spring', 'sender@example.com', 'a@example.com')
+    assert urls['b@example.com'] == [None, None]
+    assert urls['c@example.com'] == ['https://example.com/own.gif']
@@ -0,0 +1,34 @@
+import pytest
+
+import user_agents
+
+@pytest.mark.parametrize('user_agent, expected', [
+    ('Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+     ('Mobile', 'iOS', 'Apple Mail', False, False)),
+    ('Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)',
+     ('Proxy', 'Unknown', 'Gmail', False, True)),
+    ('Mozilla/4.0 (compatible; ms-office; MSOffice 16)',
+     ('Unknown', 'Unknown', 'Outlook', False, False)),
+    ('Mozilla/5.0 (Windows Phone 10.0; Android 6.0.1) AppleWebKit/537.36 Chrome/52.0 Mobile Safari/537.36 Edge/15',
+     ('Mobile', 'Windows Phone', 'Browser', False, False)),
+    ('Mozilla/5.0 (Linux; Android 13; SM-X710) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36',
+     ('Tablet', 'Android', 'Browser', False, False)),
+    ('Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+     ('Bot', 'Unknown', 'Unknown', True, False)),
+    ('Go-http-client/1.1', ('Bot', 'Unknown', 'Unknown', True, False)),
+    (u'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Caf\xe9',
+     ('Desktop', 'macOS', 'Apple Mail', False, False)),
+    ('', ('Unknown', 'Unknown', 'Unknown', False, False)),
+    (None, ('Unknown', 'Unknown', 'Unknown', False, False)),
+])
+def test_classify(user_agent, expected):
+    assert tuple(user_agents.classify(user_agent)) == expected
+    assert tuple(user_agents.classify(user_agent)) == expected
+
+def test_words_are_runs_of_ascii_letters():
+    assert user_agents._words(u'windows10phone caf\xe9-ms_office') == ['windows', 'phone', 'caf', 'ms', 'office']
+
+def test_oversized_user_agents_are_not_cached():
+    user_agent = 'Mozilla/5.0 (iPhone) ' + 'x' * user_agents.MAX_LENGTH
+    assert user_agents.classify(user_agent).device == 'Mobile'
+    assert user_agents._cache.get(user_agent) is None
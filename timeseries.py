@@ -0,0 +1,155 @@
+"""
+Time-bucketed open counts per campaign for trend charts
+
+open_buckets counts opens per campaign and bucket, where a bucket is a UTC
+timestamp prefix: 'YYYY-MM-DD HH:MM' for a minute, 'YYYY-MM-DD HH' for an
+hour and 'YYYY-MM-DD' for a day. Ingest adds minute buckets; compaction rolls
+old minutes into hours and old hours into days, so a series is available at
+minute resolution for recent opens and at coarser resolutions for all of them.
+
+Compact with (e.g. hourly from cron):
+    python timeseries.py
+"""
+import argparse
+import datetime
+import logging
+from collections import Counter
+
+import cache
+import storage
+
+# Bucket prefix length and the suffix that makes it a readable timestamp
+RESOLUTIONS = {
+    'minute': (16, ''),
+    'hour': (13, ':00'),
+    'day': (10, ''),
+}
+
+# How long buckets stay at a resolution before compaction rolls them up
+MINUTE_RETENTION = datetime.timedelta(hours=48)
+HOUR_RETENTION = datetime.timedelta(days=90)
+
+INSERT_BUCKET_SQL = 'INSERT OR IGNORE INTO open_buckets (campaign_id, bucket, opens) VALUES (?, ?, 0)'
+
+UPDATE_BUCKET_SQL = 'UPDATE open_buckets SET opens = opens + ? WHERE campaign_id = ? AND bucket = ?'
+
+def _add_counts(conn, counts):
+    """
+    Increment bucket counts
+
+    :param conn: sqlite3 connection with an open transaction
+    :param counts: Dictionary of (campaign_id, bucket) to opens
+    """
+    conn.executemany(INSERT_BUCKET_SQL, list(counts))
+    conn.executemany(UPDATE_BUCKET_SQL, [(opens, campaign_id, bucket)
+                                         for (campaign_id, bucket), opens in counts.items()])
+
+def update_buckets(conn, hits):
+    """
+    Count a batch of new hits into their minute buckets
+
+    :param conn: sqlite3 connection with an open transaction
+    :param hits: Iterable of (campaign_id, sender_email, recipient, timestamp) tuples
+    """
+    length = RESOLUTIONS['minute'][0]
+    counts = Counter((campaign_id or '', str(timestamp)[:length])
+                     for campaign_id, _, _, timestamp in hits if timestamp is not None)
+    _add_counts(conn, counts)
+
+def rebuild_buckets(conn):
+    """
+    Recompute minute buckets from pixel_tracks
+
+    :param conn: sqlite3 connection with an open transaction
+    """
+    conn.execute('DELETE FROM open_buckets')
+    conn.execute('''INSERT INTO open_buckets (campaign_id, bucket, opens)
+        SELECT COALESCE(campaign_id, ''), SUBSTR(timestamp, 1, ?), COUNT(*)
+        FROM pixel_tracks WHERE timestamp IS NOT NULL
+        GROUP BY COALESCE(campaign_id, ''), SUBSTR(timestamp, 1, ?)''', (RESOLUTIONS['minute'][0],) * 2)
+
+def _roll_up(conn, source, target, cutoff):
+    """
+    Move buckets of one resolution that start before cutoff into the coarser resolution
+
+    :return: Number of buckets rolled up
+    """
+    source_length, target_length = RESOLUTIONS[source][0], RESOLUTIONS[target][0]
+    # Align the cutoff so a target bucket never mixes with source buckets left behind
+    cutoff = cutoff.strftime('%Y-%m-%d %H:%M')[:target_length]
+    rows = conn.execute('''SELECT campaign_id, SUBSTR(bucket, 1, ?), SUM(opens), COUNT(*)
+        FROM open_buckets WHERE LENGTH(bucket) = ? AND bucket < ?
+        GROUP BY campaign_id, SUBSTR(bucket, 1, ?)''',
+                        (target_length, source_length, cutoff, target_length)).fetchall()
+    _add_counts(conn, dict(((campaign_id, bucket), opens) for campaign_id, bucket, opens, _ in rows))
+    conn.execute('DELETE FROM open_buckets WHERE LENGTH(bucket) = ? AND bucket < ?', (source_length, cutoff))
+    return sum(row[3] for row in rows)
+
+def compact(conn, now=None, minute_retention=MINUTE_RETENTION, hour_retention=HOUR_RETENTION):
+    """
+    Roll minute buckets into hours and hour buckets into days once they pass their retention
+
+    :param conn: sqlite3 connection
+    :param now: Current UTC time; defaults to datetime.datetime.utcnow()
+    :param minute_retention: Age after which minute buckets become hour buckets
+    :param hour_retention: Age after which hour buckets become day buckets
+    :return: Tuple of (minute buckets, hour buckets) rolled up
+    """
+    now = now or datetime.datetime.utcnow()
+    with conn:
+        minutes = _roll_up(conn, 'minute', 'hour', now - minute_retention)
+        hours = _roll_up(conn, 'hour', 'day', now - hour_retention)
+        cache.bump_version(conn)
+    return minutes, hours
+
+def query_series(conn, campaign_id=None, resolution='hour', start=None, end=None):
+    """
+    Open counts per bucket at the requested resolution
+
+    Finer buckets are summed into the requested resolution; buckets already
+    compacted to a coarser one are not split back up.
+
+    :param conn: sqlite3 connection
+    :param campaign_id: Restrict to one campaign; all campaigns are summed otherwise
+    :param resolution: 'minute', 'hour' or 'day'
+    :param start: First bucket included, as a UTC timestamp string prefix
+    :param end: Buckets starting before this timestamp string are included
+    :return: List of (bucket timestamp, opens) tuples in time order
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError('Unknown resolution {!r}'.format(resolution))
+    length, suffix = RESOLUTIONS[resolution]
+
+    conditions, params = ['LENGTH(bucket) >= ?'], [length]
+    for condition, value in (('campaign_id = ?', campaign_id), ('bucket >= ?', start), ('bucket < ?', end)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    rows = conn.execute('''SELECT SUBSTR(bucket, 1, ?), SUM(opens) FROM open_buckets
+        WHERE {} GROUP BY SUBSTR(bucket, 1, ?) ORDER BY 1'''.format(' AND '.join(conditions)),
+                        [length] + params + [length])
+    return [(bucket + suffix, opens) for bucket, opens in rows]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact open-count buckets')
+    parser.add_argument('--db', default=storage.TRACKING_DB_PATH, help='tracking database path')
+    parser.add_argument('--minute-hours', type=float, default=MINUTE_RETENTION.total_seconds() / 3600,
+                        help='hours to keep minute buckets')
+    parser.add_argument('--hour-days', type=float, default=HOUR_RETENTION.days,
+                        help='days to keep hour buckets')
+    args = parser.parse_args()
+
+    import migrations
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    migrations.migrate_tracking_db(args.db)
+    conn = storage.connect(args.db)
+    try:
+        minutes, hours = compact(conn, minute_retention=datetime.timedelta(hours=args.minute_hours),
+                                 hour_retention=datetime.timedelta(days=args.hour_days))
+        print('{}: rolled up {} minute and {} hour buckets'.format(args.db, minutes, hours))
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
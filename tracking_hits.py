@@ -0,0 +1,118 @@
+"""
+Pixel response and hit processing shared by the WSGI and ASGI trackers
+
+Request handlers only capture (time, query string, user agent, remote
+address) and hand it to log_hit, which queues it on the structured event
+log, before buffering it; process_hit turns it into a pixel_tracks row
+later, on the thread or task that writes to SQLite. Hits dropped by a full
+buffer or lost in a crash are therefore still in the event log, and replay
+classifies them the same way.
+
+Pixel URLs carry either a signed delivery token (t) or, from messages sent
+before tokens, raw campaign_id, sender and recipient parameters. Hits with
+a bad token are dropped before any further work.
+"""
+import base64
+import datetime
+import logging
+
+try:
+    from urlparse import parse_qsl
+except ImportError:
+    from urllib.parse import parse_qsl
+
+import event_log
+import tracking_tokens
+import user_agents
+from tracking_writer import TIMESTAMP_FORMAT
+
+# Create a 1x1 transparent GIF pixel
+PIXEL_GIF = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+# Precomputed pixel response; every open must reach us, so nothing may cache it
+PIXEL_HEADERS = (
+    ('Content-Type', 'image/gif'),
+    ('Content-Length', str(len(PIXEL_GIF))),
+    ('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0, private'),
+    ('Pragma', 'no-cache'),
+    ('Expires', 'Thu, 01 Jan 1970 00:00:00 GMT'),
+)
+
+def parse_query(query_string):
+    """
+    First value of each query parameter, like request.args.get
+
+    :param query_string: Raw query string
+    :return: Dictionary of parameter name to value
+    """
+    params = {}
+    for name, value in parse_qsl(query_string):
+        if isinstance(value, bytes) and bytes is str:
+            value = value.decode('utf-8', 'replace')
+        params.setdefault(name, value)
+    return params
+
+# Event log fields of a captured hit, in hit item order
+HIT_FIELDS = ('captured_at', 'query_string', 'user_agent', 'ip_address')
+
+def log_hit(hit_item):
+    """
+    Queue a captured hit on the event log without blocking the request
+
+    :param hit_item: Tuple of (capture time, query string, user agent, remote address)
+    """
+    event_log.log_event(dict(zip(HIT_FIELDS, hit_item)))
+
+def hit_item_of(event):
+    """
+    Captured hit of an event written by log_hit
+
+    :param event: Event dictionary read from the event log
+    :return: Tuple of (capture time, query string, user agent, remote address), or None for other events
+    """
+    if not isinstance(event.get('captured_at'), (int, float)):
+        return None
+    return tuple(event.get(field) for field in HIT_FIELDS)
+
+def process_hit(hit_item, hit_filter, deliveries=None):
+    """
+    Turn a captured hit into a pixel_tracks row
+
+    :param hit_item: Tuple of (capture time, query string, user agent, remote address)
+    :param hit_filter: proxy_filter.HitFilter deciding whether the hit is stored
+    :param deliveries: tracking_tokens.DeliveryResolver for token hits
+    :return: Row in TRACK_COLUMNS order, or None if the hit is not stored
+    """
+    captured_at, query_string, user_agent, ip_address = hit_item
+    params = parse_query(query_string)
+    token = params.get('t')
+    if token is not None:
+        delivery_id = tracking_tokens.verify_token(token)
+        if delivery_id is None:
+            logging.warning('Rejected pixel hit with invalid token {!r} from {}'.format(token, ip_address))
+            return None
+        delivery = deliveries.resolve(delivery_id) if deliveries is not None else None
+        campaign_id, sender_email, recipient = delivery or ('unknown', 'unknown', 'unknown')
+    else:
+        delivery_id = None
+        campaign_id = params.get('campaign_id', 'unknown')
+        sender_email = params.get('sender', 'unknown')
+        recipient = params.get('recipient', 'unknown')  # Optional recipient tracking
+
+    agent = user_agents.classify(user_agent)
+    hit = hit_filter.check(campaign_id, sender_email, recipient, agent, ip_address, now=captured_at)
+    timestamp = datetime.datetime.utcfromtimestamp(captured_at).strftime(TIMESTAMP_FORMAT)
+
+    # Prefetches and repeat hits within the dedupe window never reach storage
+    if not hit.store:
+        return None
+    return (
+        campaign_id,
+        sender_email,
+        recipient,
+        timestamp,
+        user_agent,
+        ip_address,
+        hit.device_info,
+        delivery_id
+    )
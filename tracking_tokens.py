@@ -0,0 +1,216 @@
+"""
+Signed delivery tokens for tracking pixel URLs
+
+Each (campaign, sender, recipient) gets a row in the deliveries table, which
+the mailer records in batches ahead of building the messages, and the pixel
+URL carries only a token: the row's integer id followed by a truncated
+HMAC-SHA256 of it, URL-safe base64 encoded (15 characters for the first 16
+million deliveries). The tracker checks the signature in memory, so forged
+or mangled tokens are rejected without a database lookup, and stores the
+integer delivery id with each hit.
+
+The signing key comes from TRACKING_SECRET, or is generated once into
+tracking_secret.key next to the databases; the mailer and the tracker must
+share it.
+"""
+import base64
+import errno
+import hashlib
+import hmac
+import logging
+import os
+import struct
+import tempfile
+import threading
+
+import cache
+import storage
+
+SECRET_PATH = os.environ.get('TRACKING_SECRET_PATH', os.path.join(storage.BASE_DIR, 'tracking_secret.key'))
+
+# Bytes of the HMAC kept in each token; forging one takes 2**64 guesses
+TAG_BYTES = 8
+
+# Resolved deliveries kept in the LRU cache
+CACHE_SIZE = 65536
+
+INSERT_DELIVERY_SQL = ('INSERT OR IGNORE INTO deliveries (campaign_id, sender_email, recipient, created_at) '
+                       "VALUES (?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now'))")
+
+SELECT_DELIVERY_IDS_SQL = ('SELECT recipient, id FROM deliveries WHERE campaign_id = ? AND sender_email = ? '
+                           'AND recipient IN ({})')
+
+# Recipients per IN (...) lookup, below SQLite's default bound parameter limit
+MAX_PARAMS = 500
+
+SELECT_DELIVERY_SQL = 'SELECT campaign_id, sender_email, recipient FROM deliveries WHERE id = ?'
+
+# Length of a generated key, the base64 encoding of 32 random bytes; shorter key files are truncated
+KEY_LENGTH = 44
+
+_key = None
+_key_lock = threading.Lock()
+
+def _create_key(path):
+    """
+    Generate a key file unless another process has created one
+
+    The key is written and synced to a private temporary file that is then
+    hard-linked into place, so readers only ever see no key file or a
+    complete one, and a key created first by another process is kept.
+    """
+    fd, temp_path = tempfile.mkstemp(prefix='.tracking_secret.', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.b64encode(os.urandom(32)))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(temp_path, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    finally:
+        os.remove(temp_path)
+
+def _load_key(path):
+    """
+    Read the signing key, creating it on first use
+
+    :raises RuntimeError: If the key file is empty or truncated
+    """
+    if not os.path.exists(path):
+        _create_key(path)
+    with open(path, 'rb') as f:
+        key = f.read()
+    if len(key) < KEY_LENGTH:
+        raise RuntimeError('Tracking secret {} is empty or truncated; remove it to generate a new key, '
+                           'which invalidates pixel URLs already sent'.format(path))
+    return key
+
+def get_key():
+    """
+    Key used to sign and verify tokens
+
+    :return: Key bytes
+    :raises RuntimeError: If the key file is empty or truncated
+    """
+    global _key
+    if _key is None:
+        with _key_lock:
+            if _key is None:
+                secret = os.environ.get('TRACKING_SECRET')
+                _key = secret.encode('utf-8') if secret else _load_key(SECRET_PATH)
+    return _key
+
+def _sign(payload):
+    return hmac.new(get_key(), payload, hashlib.sha256).digest()[:TAG_BYTES]
+
+def make_token(delivery_id):
+    """
+    Sign a delivery id
+
+    :param delivery_id: Positive integer id of a deliveries row
+    :return: URL-safe token string
+    """
+    payload = struct.pack('>Q', delivery_id).lstrip(b'\0')
+    token = base64.urlsafe_b64encode(payload + _sign(payload)).rstrip(b'=')
+    return token.decode('ascii')
+
+def verify_token(token):
+    """
+    Check a token's signature without touching the database
+
+    :param token: Token from a pixel URL
+    :return: Delivery id, or None if the token is malformed or forged
+    """
+    if not token or len(token) > 24:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+    except (TypeError, ValueError):
+        return None
+    payload, tag = raw[:-TAG_BYTES], raw[-TAG_BYTES:]
+    if not 1 <= len(payload) <= 8 or not hmac.compare_digest(_sign(payload), tag):
+        return None
+    return struct.unpack('>Q', payload.rjust(8, b'\0'))[0]
+
+_migrated = set()
+
+def issue_tokens(campaign_id, sender_email, recipients, db_path=storage.TRACKING_DB_PATH):
+    """
+    Record the deliveries of many recipients in one transaction and sign
+    their ids; sending the same campaign to the same recipient again reuses
+    the row
+
+    :param campaign_id: Unique campaign identifier
+    :param sender_email: Email address the messages are sent from
+    :param recipients: Iterable of recipient email addresses
+    :param db_path: Path to the tracking database
+    :return: Dictionary of recipient to token string
+    """
+    if db_path not in _migrated:
+        import migrations
+        migrations.migrate_tracking_db(db_path)
+        _migrated.add(db_path)
+
+    recipients = list(set(recipients))
+    delivery_ids = {}
+    conn = storage.get_connection(db_path)
+    try:
+        with conn:
+            conn.executemany(INSERT_DELIVERY_SQL, [(campaign_id, sender_email, recipient)
+                                                   for recipient in recipients])
+        for start in range(0, len(recipients), MAX_PARAMS):
+            chunk = recipients[start:start + MAX_PARAMS]
+            query = SELECT_DELIVERY_IDS_SQL.format(', '.join('?' for _ in chunk))
+            delivery_ids.update(conn.execute(query, [campaign_id, sender_email] + chunk))
+    finally:
+        conn.rollback()
+    return dict((recipient, make_token(delivery_id)) for recipient, delivery_id in delivery_ids.items())
+
+def issue_token(campaign_id, sender_email, recipient, db_path=storage.TRACKING_DB_PATH):
+    """
+    Record a single delivery and sign its id
+
+    :param campaign_id: Unique campaign identifier
+    :param sender_email: Email address the message is sent from
+    :param recipient: Email address of recipient
+    :param db_path: Path to the tracking database
+    :return: Token string
+    """
+    return issue_tokens(campaign_id, sender_email, [recipient], db_path)[recipient]
+
+class DeliveryResolver(object):
+    def __init__(self, db_path=storage.TRACKING_DB_PATH, max_entries=CACHE_SIZE):
+        """
+        Look up the campaign, sender and recipient of delivery ids
+
+        Deliveries never change once recorded, so lookups are cached without expiry.
+
+        :param db_path: Path to the tracking database
+        :param max_entries: Deliveries kept in the LRU cache
+        """
+        self.db_path = db_path
+        self.cache = cache.LRUCache(max_entries)
+
+    def resolve(self, delivery_id):
+        """
+        :param delivery_id: Id from a verified token
+        :return: Tuple of (campaign_id, sender_email, recipient), or None if unknown
+        """
+        delivery = self.cache.get(delivery_id)
+        if delivery is not None:
+            return delivery
+        conn = storage.get_connection(self.db_path)
+        try:
+            delivery = conn.execute(SELECT_DELIVERY_SQL, (delivery_id,)).fetchone()
+        except Exception as e:
+            logging.error('Error resolving delivery {}: {}'.format(delivery_id, e))
+            return None
+        finally:
+            conn.rollback()
+        if delivery is not None:
+            delivery = tuple(delivery)
+            self.cache.set(delivery_id, delivery)
+        return delivery
@@ -0,0 +1,250 @@
+import datetime
+import logging
+import os
+import threading
+from collections import deque
+
+import cache
+import hll
+import lookups
+import rollups
+import storage
+import timeseries
+
+# Columns written for every tracked pixel hit, in row tuple order; ids are assigned by SQLite
+TRACK_COLUMNS = ('campaign_id', 'sender_email', 'recipient', 'timestamp',
+                 'user_agent', 'ip_address', 'device_info', 'delivery_id')
+
+INSERT_EVENT_SQL = 'INSERT INTO pixel_events ({}) VALUES ({})'.format(
+    ', '.join(lookups.event_column(column) for column in TRACK_COLUMNS), ', '.join('?' for _ in TRACK_COLUMNS))
+
+# Inserts a row unless the same sender already has a stored hit from the
+# recipient within the window around it; the NOT EXISTS check and the insert
+# run as one statement under the database write lock, so it holds across
+# every process writing to the database
+INSERT_FIRST_HIT_SQL = ('INSERT INTO pixel_events ({}) SELECT {} WHERE NOT EXISTS (SELECT 1 FROM pixel_events '
+                        'WHERE campaign_ref = ? AND recipient_ref = ? AND sender_ref IS ? '
+                        'AND timestamp > ? AND timestamp < ?)').format(
+    ', '.join(lookups.event_column(column) for column in TRACK_COLUMNS), ', '.join('?' for _ in TRACK_COLUMNS))
+
+# Timestamp format matching what SQLAlchemy stores for DateTime columns
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+def repeat_window(timestamp, seconds):
+    """
+    Timestamps bounding the dedupe window around a hit
+
+    :param timestamp: Hit timestamp in TIMESTAMP_FORMAT
+    :param seconds: Window length
+    :return: Tuple of (earliest, latest) exclusive bounds, or None if the timestamp cannot be parsed
+    """
+    try:
+        hit_time = datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        return None
+    window = datetime.timedelta(seconds=seconds)
+    return (hit_time - window).strftime(TIMESTAMP_FORMAT), (hit_time + window).strftime(TIMESTAMP_FORMAT)
+
+class TrackingWriter(object):
+    def __init__(self, db_path, batch_size=500, flush_interval=1.0, max_buffer=50000,
+                 sketches=hll.SKETCHES_ENABLED, prepare=None, dedupe_window=0):
+        """
+        Write-behind buffer batching pixel hits into SQLite
+
+        :param db_path: Path to the tracking database
+        :param batch_size: Buffered rows that trigger an immediate flush
+        :param flush_interval: Maximum seconds a row waits before being flushed
+        :param max_buffer: Maximum buffered rows; further hits are dropped until the next flush
+        :param sketches: Also maintain the HyperLogLog unique-open sketches
+        :param prepare: Optional callable run on the flush thread that turns each
+                        buffered item into a row, or None to skip it, so request
+                        threads only buffer raw hits
+        :param dedupe_window: Seconds within which a recipient's hits on a campaign
+                              are stored once, checked in the write transaction;
+                              0 stores every row
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.sketches = sketches
+        self.prepare = prepare
+        self.dedupe_window = dedupe_window
+        self.lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.buffer = deque()
+        self.written_count = 0
+        self.dropped_count = 0
+        self.duplicate_count = 0
+        self.thread = None
+        self.pid = None
+        self.closed = False
+        self.connection = None
+        self.interner = lookups.Interner()
+
+    def _ensure_thread(self):
+        """
+        Start the flush thread, again after a fork since threads do not survive it
+        """
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.connection = None
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self, row):
+        """
+        Buffer one tracking row without touching the database
+
+        :param row: Tuple of values in TRACK_COLUMNS order, or an item for prepare
+        :return: False if the buffer was full and the row was dropped
+        """
+        if self.closed:
+            return False
+        self._ensure_thread()
+        with self.lock:
+            if len(self.buffer) >= self.max_buffer:
+                self.dropped_count += 1
+                return False
+            self.buffer.append(row)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.wakeup.set()
+        return True
+
+    def _run(self):
+        """
+        Flush thread: write whenever a batch fills up or the interval elapses
+        """
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def _connect(self):
+        """
+        Get the writer's own database connection
+        """
+        if self.connection is None:
+            self.connection = storage.connect(self.db_path, check_same_thread=False)
+        return self.connection
+
+    def _prepare(self, items):
+        """
+        Convert buffered items into rows, skipping those prepare rejects or fails on
+        """
+        rows = []
+        for item in items:
+            try:
+                row = self.prepare(item)
+            except Exception as e:
+                logging.error('Error preparing tracking hit: {}'.format(e))
+                continue
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    def _insert_first_hits(self, conn, rows, encoded):
+        """
+        Insert rows one at a time, skipping repeats of a stored hit within dedupe_window
+
+        Hits without a known recipient or a parseable timestamp are always inserted.
+
+        :return: List of the rows inserted
+        """
+        inserted = []
+        for row, values in zip(rows, encoded):
+            window = None
+            if row[2] and row[2] != 'unknown':
+                window = repeat_window(row[3], self.dedupe_window)
+            if window is None:
+                conn.execute(INSERT_EVENT_SQL, values)
+            elif not conn.execute(INSERT_FIRST_HIT_SQL, list(values) + [values[0], values[2], values[1]] +
+                                  list(window)).rowcount:
+                continue
+            inserted.append(row)
+        return inserted
+
+    def _write(self, conn, rows):
+        """
+        Insert a batch of rows and fold it into the aggregates in one transaction
+
+        :return: Number of rows inserted
+        """
+        try:
+            with conn:
+                encoded = self.interner.encode(conn, rows, TRACK_COLUMNS)
+                if self.dedupe_window > 0:
+                    inserted = self._insert_first_hits(conn, rows, encoded)
+                else:
+                    conn.executemany(INSERT_EVENT_SQL, encoded)
+                    inserted = rows
+                hits = [(row[0], row[1], row[2], row[3]) for row in inserted]
+                rollups.update_rollups(conn, hits)
+                timeseries.update_buckets(conn, hits)
+                if self.sketches:
+                    hll.update_sketches(conn, hits)
+                cache.bump_version(conn)
+        except Exception:
+            self.interner.rollback()
+            raise
+        self.interner.commit()
+        self.duplicate_count += len(rows) - len(inserted)
+        return len(inserted)
+
+    def flush(self):
+        """
+        Write all buffered rows in a single batched insert
+
+        :return: Number of rows written
+        """
+        with self.write_lock:
+            with self.lock:
+                rows = list(self.buffer)
+                self.buffer.clear()
+                dropped, self.dropped_count = self.dropped_count, 0
+            if dropped:
+                logging.warning('Tracking buffer full, dropped {} hits'.format(dropped))
+            return self.write(rows)
+
+    def write(self, items):
+        """
+        Prepare and write a batch directly, bypassing the buffer
+
+        For callers that batch hits themselves, such as the ASGI tracker's
+        writer task.
+
+        :param items: Rows, or items for prepare
+        :return: Number of rows written, after any repeats were skipped
+        """
+        with self.write_lock:
+            rows = self._prepare(items) if self.prepare is not None else items
+            if not rows:
+                return 0
+
+            try:
+                written = self._write(self._connect(), rows)
+            except Exception as e:
+                logging.error('Database tracking error: {} ({} hits lost)'.format(e, len(rows)))
+                return 0
+            self.written_count += written
+            return written
+
+    def close(self):
+        """
+        Stop the flush thread and drain the buffer; registered to run at shutdown
+        """
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
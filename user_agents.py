@@ -0,0 +1,172 @@
+"""
+User-agent classification for pixel hits
+
+A user agent is lowercased and split into words (runs of ASCII letters)
+with one byte translation, and the words are intersected with a word table
+(plus a table of two-word phrases) to find the tokens of interest;
+precedence rules then pick the device, OS, mail client and whether the hit
+came from a bot or an image proxy rather than a person.
+Results are kept in a two-generation cache keyed by the user-agent string,
+since a campaign's hits repeat a small set of user agents.
+"""
+from collections import namedtuple
+
+import cache
+
+UserAgent = namedtuple('UserAgent', ['device', 'os', 'client', 'is_bot', 'is_proxy'])
+
+UNKNOWN = 'Unknown'
+
+# Longer user agents are classified by their first MAX_LENGTH characters
+MAX_LENGTH = 512
+
+# Classifications cached across both cache generations
+CACHE_SIZE = 4096
+
+# Translation keeping lowercase ASCII letters and turning every other byte into a space
+_LETTERS_ONLY = bytes(bytearray(byte if 97 <= byte <= 122 else 32 for byte in range(256)))
+
+# (token, words) pairs; a token is recorded whenever one of its words appears
+TOKEN_WORDS = [
+    # Image proxies fetch the pixel on the recipient's behalf
+    ('gmail_proxy', 'googleimageproxy'),
+    ('yahoo_proxy', 'yahoomailproxy'),
+    # Crawlers, HTTP libraries and link scanners prefetching mail content
+    ('bot', 'bot crawler spider slurp preview prefetch scanner headlesschrome phantomjs '
+            'curl wget okhttp libwww java barracuda mimecast proofpoint urldefense'),
+    ('outlook', 'outlook msoffice'),
+    ('thunderbird', 'thunderbird'),
+    ('windows', 'windows'),
+    ('ipad', 'ipad'),
+    ('iphone', 'iphone ipod'),
+    ('macos', 'macintosh mac'),
+    ('android', 'android'),
+    ('chromeos', 'cros'),
+    ('linux', 'linux'),
+    ('tablet', 'tablet kindle silk playbook'),
+    ('mobile', 'mobile mobi'),
+    ('webkit', 'applewebkit'),
+    ('browser', 'safari chrome firefox edg opr'),
+]
+
+WORD_TOKENS = dict((word, token) for token, words in TOKEN_WORDS for word in words.split())
+_TOKEN_WORDS = frozenset(WORD_TOKENS)
+
+# Token of each pair of consecutive words of interest
+PHRASE_TOKENS = {
+    ('windows', 'phone'): 'windows_phone',
+    ('ms', 'office'): 'outlook',
+    ('python', 'requests'): 'bot',
+    ('python', 'urllib'): 'bot',
+    ('go', 'http'): 'bot',
+}
+
+# First matching token decides the OS
+OS_TOKENS = [
+    ('windows_phone', 'Windows Phone'),
+    ('windows', 'Windows'),
+    ('ipad', 'iPadOS'),
+    ('iphone', 'iOS'),
+    ('macos', 'macOS'),
+    ('android', 'Android'),
+    ('chromeos', 'ChromeOS'),
+    ('linux', 'Linux'),
+]
+
+_APPLE_OSES = ('iOS', 'iPadOS', 'macOS')
+
+# Words that can start and end a phrase; pairs are only looked for when both appear
+_PHRASE_FIRST = frozenset(first for first, _ in PHRASE_TOKENS)
+_PHRASE_LAST = frozenset(last for _, last in PHRASE_TOKENS)
+
+def _words(text):
+    """
+    Words of a lowercased user agent, in order
+    """
+    if isinstance(text, bytes):
+        return text.translate(_LETTERS_ONLY).split()
+    return text.encode('latin-1', 'replace').translate(_LETTERS_ONLY).decode('ascii').split()
+
+def _scan(user_agent):
+    """
+    Names of all tokens present in a user agent
+    """
+    text = user_agent.lower()
+    words = _words(text)
+    tokens = set([WORD_TOKENS[word] for word in _TOKEN_WORDS.intersection(words)])
+    if 'bot' not in tokens and 'bot' in text:
+        for word in words:
+            if word.endswith('bot'):
+                # Googlebot, bingbot, ...
+                tokens.add('bot')
+                break
+    if not _PHRASE_FIRST.isdisjoint(words) and not _PHRASE_LAST.isdisjoint(words):
+        for phrase in zip(words, words[1:]):
+            if phrase in PHRASE_TOKENS:
+                tokens.add(PHRASE_TOKENS[phrase])
+    return tokens
+
+def _classify(user_agent):
+    """
+    Classify a user agent without the cache
+
+    :param user_agent: User-Agent header value
+    :return: UserAgent
+    """
+    tokens = _scan(user_agent[:MAX_LENGTH])
+
+    os_name = UNKNOWN
+    for token, name in OS_TOKENS:
+        if token in tokens:
+            os_name = name
+            break
+
+    is_proxy = 'gmail_proxy' in tokens or 'yahoo_proxy' in tokens
+    is_bot = 'bot' in tokens and not is_proxy
+
+    if 'gmail_proxy' in tokens:
+        client = 'Gmail'
+    elif 'yahoo_proxy' in tokens:
+        client = 'Yahoo Mail'
+    elif 'outlook' in tokens:
+        client = 'Outlook'
+    elif 'thunderbird' in tokens:
+        client = 'Thunderbird'
+    elif os_name in _APPLE_OSES and 'webkit' in tokens and 'browser' not in tokens:
+        # Apple Mail (and its privacy proxy) sends WebKit without a browser token
+        client = 'Apple Mail'
+    elif 'browser' in tokens:
+        client = 'Browser'
+    else:
+        client = UNKNOWN
+
+    if is_proxy or is_bot:
+        # The fetch says nothing about the recipient's device
+        device = 'Proxy' if is_proxy else 'Bot'
+        os_name = UNKNOWN if is_proxy else os_name
+    elif 'ipad' in tokens or 'tablet' in tokens or ('android' in tokens and 'mobile' not in tokens):
+        device = 'Tablet'
+    elif 'mobile' in tokens or 'iphone' in tokens or 'windows_phone' in tokens:
+        device = 'Mobile'
+    elif os_name != UNKNOWN:
+        device = 'Desktop'
+    else:
+        device = UNKNOWN
+    return UserAgent(device, os_name, client, is_bot, is_proxy)
+
+_cache = cache.get_cache('user_agents', max_entries=CACHE_SIZE, ttl=None, lru=False)
+
+def classify(user_agent):
+    """
+    Classify a user agent, caching the result by user-agent string
+
+    :param user_agent: User-Agent header value
+    :return: UserAgent with device, os, client, is_bot and is_proxy
+    """
+    info = _cache.get(user_agent)
+    if info is None:
+        info = _classify(user_agent or '')
+        # Oversized user agents are not cached so they cannot fill memory
+        if user_agent is not None and len(user_agent) <= MAX_LENGTH:
+            _cache.set(user_agent, info)
+    return info